@@ -0,0 +1,302 @@
+"""
+Client-side computation of the history aggregates in `util.Aggregation`.
+
+The aggregates are computed from a raw, array-backed timeseries with vectorized
+NumPy bucket operations, so the same raw window can be aggregated with many
+aggregates and spans without a server round trip for each. The per-series
+preparation (sorting, quality masks) is done once, and the per-bucket statistics
+of a span are shared by all aggregates computed for that span.
+
+Quality semantics follow the hive:
+- Samples with bad quality are excluded from the value calculations.
+- The result quality is good if all samples in the interval are good, uncertain
+  if some samples are not good, and bad | noData if the interval has no usable
+  samples. Calculated results have the calculated flag, and the last interval
+  has the partial flag if it is shorter than the span.
+- TIMEAVERAGE, TOTAL and INTERPOLATIVE interpolate linearly between samples,
+  also using samples outside the interval as bounds.
+- DURATIONGOOD/DURATIONBAD/PERCENTGOOD/PERCENTBAD treat each quality as valid
+  until the next sample (stepped).
+- STDEV and VARIANCE are sample (n-1) statistics, REGSLOPE is per second and
+  REGCONST is the regression value at the start of the interval.
+
+Requires numpy.
+"""
+__all__ = 'Aggregator', 'aggregate'
+
+from datetime import datetime, timedelta
+from functools import cached_property
+from typing import Dict, List, Sequence, Tuple
+
+from . import quality
+from .arrays import ArrayTimeseries, TIME_DTYPE, QUALITY_DTYPE
+from .util import Aggregation, Error, OPC_quality, _import_optional
+
+np = _import_optional('numpy', 'client-side aggregation')
+
+_GOOD = int(OPC_quality.good)
+_UNCERTAIN = int(OPC_quality.uncertain)
+_NODATA = quality.NODATA
+_CALCULATED = int(OPC_quality.calculated)
+_PARTIAL = int(OPC_quality.partial)
+
+
+def _reduceat(ufunc, a, idx, counts, fill=np.nan):
+    """Reduce `a` over the buckets [idx[k], idx[k+1]). Empty buckets get `fill`"""
+    if not len(a):
+        return np.full(len(counts), fill)
+    # The padding makes idx[-1] == len(a) a valid index. Its bucket is dropped
+    padded = np.append(a, a[-1])
+    out = ufunc.reduceat(padded, idx)[:-1].astype(np.float64)
+    out[counts == 0] = fill
+    return out
+
+
+class _Buckets:
+    """Internal. The samples of one series bucketed by one span. Statistics are
+    computed on first use and shared between aggregates"""
+
+    def __init__(self, series: "Aggregator", start: datetime, end: datetime, span: timedelta):
+        if span <= timedelta(0):
+            raise Error("The aggregation span must be positive")
+        origin = np.datetime64(start, 'us')
+        length = (np.datetime64(end, 'us') - origin) / np.timedelta64(1, 's')
+        step = span / timedelta(seconds=1)
+
+        self.edges = np.append(np.arange(0.0, length, step), length)
+        self.widths = np.diff(self.edges)
+        self.times = origin + (self.edges * 1e6).astype('timedelta64[us]')
+        self.partial = bool(len(self.widths)) and self.widths[-1] < step
+
+        secs = (series.time - origin) / np.timedelta64(1, 's')
+        self.t = secs
+        self.q = series.quality
+        self.good = series.good
+        self.tu = secs[series.usable]
+        self.vu = series.value[series.usable]
+        self.time_u = series.time[series.usable]
+
+        self.idx = np.searchsorted(self.t, self.edges, 'left')
+        self.idx_u = np.searchsorted(self.tu, self.edges, 'left')
+        self.count_all = np.diff(self.idx)
+        self.count = np.diff(self.idx_u)
+        good_cum = np.concatenate(([0], np.cumsum(self.good)))
+        self.count_good = np.diff(good_cum[self.idx])
+
+        bucket = np.searchsorted(self.edges, self.tu, 'right') - 1
+        self.in_range = (bucket >= 0) & (bucket < len(self.widths))
+        self.bucket = np.where(self.in_range, bucket, 0)
+
+    @property
+    def size(self):
+        return len(self.widths)
+
+    def reduce(self, ufunc, a):
+        return _reduceat(ufunc, a, self.idx_u, self.count)
+
+    def _per_sample(self, per_bucket):
+        "Spread a per-bucket array to the usable samples (0 outside the range)"
+        return np.where(self.in_range, per_bucket[self.bucket] if len(per_bucket) else 0, 0)
+
+    @cached_property
+    def quality(self):
+        q = np.where(self.count == 0, _NODATA,
+                     np.where(self.count_good == self.count_all, _GOOD | _CALCULATED, _UNCERTAIN | _CALCULATED))
+        if self.partial:
+            q[-1] |= _PARTIAL
+        return q.astype(QUALITY_DTYPE)
+
+    @cached_property
+    def sum(self):
+        return self.reduce(np.add, self.vu)
+
+    @cached_property
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum / self.count
+
+    @cached_property
+    def minimum(self):
+        return self.reduce(np.minimum, self.vu)
+
+    @cached_property
+    def maximum(self):
+        return self.reduce(np.maximum, self.vu)
+
+    @cached_property
+    def first(self):
+        return np.where(self.count > 0, self.vu[np.minimum(self.idx_u[:-1], len(self.vu) - 1)] if len(self.vu) else np.nan, np.nan)
+
+    @cached_property
+    def last(self):
+        return np.where(self.count > 0, self.vu[np.maximum(self.idx_u[1:] - 1, 0)] if len(self.vu) else np.nan, np.nan)
+
+    @cached_property
+    def variance(self):
+        dev = np.where(self.in_range, self.vu - self._per_sample(self.mean), 0.0)
+        ss = self.reduce(np.add, dev*dev)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, ss / (self.count - 1), np.nan)
+
+    def _extreme_time(self, extreme):
+        "Timestamps of the first sample in each bucket equal to `extreme`"
+        times = self.times[:-1].copy()
+        pos = np.flatnonzero(self.in_range & (self.vu == self._per_sample(extreme)))
+        buckets, first = np.unique(self.bucket[pos], return_index=True)
+        times[buckets] = self.time_u[pos[first]]
+        return times
+
+    @cached_property
+    def regression(self):
+        "Slope, constant and deviation of the least squares line in each bucket"
+        x = np.where(self.in_range, self.tu - self.edges[self.bucket] if len(self.edges) else 0, 0.0)
+        n = self.count
+        sx = self.reduce(np.add, x)
+        sxx = self.reduce(np.add, x*x)
+        sxy = self.reduce(np.add, x*self.vu)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = (n*sxy - sx*self.sum) / (n*sxx - sx*sx)
+            slope = np.where(n == 1, 0.0, slope)
+            const = (self.sum - slope*sx) / n
+            resid = np.where(self.in_range, self.vu - self._per_sample(const) - self._per_sample(slope)*x, 0.0)
+            sse = self.reduce(np.add, resid*resid)
+            dev = np.where(n > 2, np.sqrt(sse / (n - 2)), np.nan)
+        return slope, const, dev
+
+    def _integral_at(self, e):
+        """Integral of the linearly interpolated usable samples from the first sample
+        to `e` (clipped to the sample range)"""
+        t, v = self.tu, self.vu
+        ec = np.clip(e, t[0], t[-1])
+        cum = np.concatenate(([0.0], np.cumsum(np.diff(t) * (v[1:] + v[:-1]) / 2)))
+        i = np.clip(np.searchsorted(t, ec, 'right') - 1, 0, len(t) - 1)
+        return cum[i] + (ec - t[i]) * (v[i] + np.interp(ec, t, v)) / 2, ec
+
+    @cached_property
+    def timeaverage(self):
+        if not len(self.tu):
+            return np.full(self.size, np.nan)
+        integral, ec = self._integral_at(self.edges)
+        covered = np.diff(ec)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg = np.diff(integral) / covered
+        return np.where(covered > 0, avg, self.mean)
+
+    @cached_property
+    def interpolated(self):
+        if not len(self.tu):
+            return np.full(self.size, np.nan)
+        return np.interp(self.edges[:-1], self.tu, self.vu, left=np.nan, right=np.nan)
+
+    def _duration(self, state):
+        "Seconds in each bucket during which `state` (per sample, stepped) is true"
+        if not len(self.t):
+            return np.zeros(self.size)
+        t, s = self.t, state.astype(np.float64)
+        cum = np.concatenate(([0.0], np.cumsum(np.diff(t) * s[:-1])))
+        i = np.searchsorted(t, self.edges, 'right') - 1
+        ic = np.clip(i, 0, len(t) - 1)
+        at_edges = np.where(i < 0, 0.0, cum[ic] + (self.edges - t[ic]) * s[ic])
+        return np.diff(at_edges)
+
+    @cached_property
+    def duration_good(self):
+        return self._duration(self.good)
+
+    @cached_property
+    def duration_bad(self):
+        return self._duration(quality.is_bad(self.q))
+
+    @cached_property
+    def worst_quality(self):
+        return _reduceat(np.minimum, self.q & 0xff, self.idx, self.count_all)
+
+
+def _quality_only(b: _Buckets, values):
+    "Quality for aggregates that are defined for any interval with samples"
+    return values, np.where(b.count_all > 0, _GOOD | _CALCULATED, _NODATA).astype(QUALITY_DTYPE)
+
+
+# Each function returns (values, qualities, times) for all buckets. times=None means the bucket start
+_functions = {
+    Aggregation.INTERPOLATIVE: lambda b: (b.interpolated, b.quality, None),
+    Aggregation.TOTAL: lambda b: (b.timeaverage * b.widths, b.quality, None),
+    Aggregation.AVERAGE: lambda b: (b.mean, b.quality, None),
+    Aggregation.TIMEAVERAGE: lambda b: (b.timeaverage, b.quality, None),
+    Aggregation.COUNT: lambda b: (b.count.astype(np.float64), b.quality, None),
+    Aggregation.STDEV: lambda b: (np.sqrt(b.variance), b.quality, None),
+    Aggregation.MINIMUMACTUALTIME: lambda b: (b.minimum, b.quality, b._extreme_time(b.minimum)),
+    Aggregation.MINIMUM: lambda b: (b.minimum, b.quality, None),
+    Aggregation.MAXIMUMACTUALTIME: lambda b: (b.maximum, b.quality, b._extreme_time(b.maximum)),
+    Aggregation.MAXIMUM: lambda b: (b.maximum, b.quality, None),
+    Aggregation.START: lambda b: (b.first, b.quality, None),
+    Aggregation.END: lambda b: (b.last, b.quality, b.times[1:]),
+    Aggregation.DELTA: lambda b: (b.last - b.first, b.quality, None),
+    Aggregation.REGSLOPE: lambda b: (b.regression[0], b.quality, None),
+    Aggregation.REGCONST: lambda b: (b.regression[1], b.quality, None),
+    Aggregation.REGDEV: lambda b: (b.regression[2], b.quality, None),
+    Aggregation.VARIANCE: lambda b: (b.variance, b.quality, None),
+    Aggregation.RANGE: lambda b: (b.maximum - b.minimum, b.quality, None),
+    Aggregation.DURATIONGOOD: lambda b: (*_quality_only(b, b.duration_good), None),
+    Aggregation.DURATIONBAD: lambda b: (*_quality_only(b, b.duration_bad), None),
+    Aggregation.PERCENTGOOD: lambda b: (*_quality_only(b, b.duration_good / b.widths), None),
+    Aggregation.PERCENTBAD: lambda b: (*_quality_only(b, b.duration_bad / b.widths), None),
+    Aggregation.WORSTQUALITY: lambda b: (*_quality_only(b, b.worst_quality), None),
+}
+
+
+class Aggregator:
+    """
+    Compute aggregates locally from one raw timeseries. The raw series should
+    include the bounding samples before and after the period (as read by
+    `Item.read_raw_arrays`) for the interpolating aggregates to be exact at the
+    period limits.
+
+    >>> raw = item.read_raw_arrays(start, end, 100000)
+    >>> avg, mx = Aggregator(raw).compute(start, end, timedelta(minutes=1), Aggregation.AVERAGE, Aggregation.MAXIMUM)
+    """
+    def __init__(self, ts: ArrayTimeseries):
+        order = np.argsort(ts.time, kind='stable')
+        self.item_id = ts.item_id
+        self.time = ts.time.astype(TIME_DTYPE)[order]
+        try:
+            self.value = np.asarray(ts.value, dtype=np.float64)[order]
+        except (TypeError, ValueError):
+            raise Error(f"Item {ts.item_id} has non-numeric values and can't be aggregated")
+        self.quality = np.asarray(ts.quality, dtype=QUALITY_DTYPE)[order]
+        self.usable = quality.mask(self.quality, 'usable', self.value)
+        self.good = quality.isgood(self.quality)
+
+    def _compute(self, buckets: _Buckets, agg: Aggregation) -> ArrayTimeseries:
+        try:
+            func = _functions[Aggregation(agg)]
+        except KeyError:
+            raise Error(f"Aggregate {Aggregation(agg).name} can't be computed client-side")
+        values, qualities, times = func(buckets)
+        times = buckets.times[:-1] if times is None else times
+        return ArrayTimeseries(self.item_id, times, np.asarray(values, dtype=np.float64), qualities)
+
+    def compute(self, start: datetime, end: datetime, span: timedelta, *aggregation: Aggregation) -> List[ArrayTimeseries]:
+        """
+        Compute aggregates with the same arguments and result layout as `Item.read_agg`:
+        one ArrayTimeseries per aggregate, with one sample per span.
+        """
+        buckets = _Buckets(self, start, end, span)
+        return [self._compute(buckets, agg) for agg in aggregation]
+
+    def compute_many(self, start: datetime, end: datetime, spans: Sequence[timedelta],
+                     aggregations: Sequence[Aggregation]) -> Dict[Tuple[timedelta, Aggregation], ArrayTimeseries]:
+        """
+        Compute every combination of `spans` and `aggregations`. Returns a dict keyed by (span, aggregation).
+        """
+        result = {}
+        for span in spans:
+            buckets = _Buckets(self, start, end, span)
+            for agg in aggregations:
+                result[(span, Aggregation(agg))] = self._compute(buckets, agg)
+        return result
+
+
+def aggregate(ts: ArrayTimeseries, start: datetime, end: datetime, span: timedelta, *aggregation: Aggregation) -> List[ArrayTimeseries]:
+    "Compute aggregates locally from a raw timeseries. See `Aggregator.compute`"
+    return Aggregator(ts).compute(start, end, span, *aggregation)
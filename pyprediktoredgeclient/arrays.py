@@ -0,0 +1,498 @@
+"""
+Array-backed timeseries and conversion helpers between .NET arrays and NumPy arrays.
+
+NumPy is an optional dependency of pyprediktoredgeclient. This module is only
+imported by the functions that need it.
+"""
+import ctypes
+from datetime import datetime
+from typing import NamedTuple, List, Optional, Sequence
+
+import System
+from System.Runtime.InteropServices import GCHandle, GCHandleType
+
+from . import quality as _quality
+from .util import Error, Quality, Timeseries, VQT, _import_optional
+
+np = _import_optional('numpy', 'array-backed timeseries')
+
+# Ticks (100ns) between 0001-01-01 (.NET DateTime origin) and 1970-01-01
+EPOCH_TICKS = 621355968000000000
+TICKS_PER_US = 10
+
+TIME_DTYPE = 'datetime64[us]'
+QUALITY_DTYPE = np.uint32
+
+# .NET element types that can be pinned and copied with a single memmove
+_blittable = {
+    'System.Double': np.float64,
+    'System.Single': np.float32,
+    'System.Int16': np.int16,
+    'System.UInt16': np.uint16,
+    'System.Int32': np.int32,
+    'System.UInt32': np.uint32,
+    'System.Int64': np.int64,
+    'System.UInt64': np.uint64,
+    'System.Byte': np.uint8,
+}
+
+
+# DateTime stores the ticks in the low 62 bits and the DateTimeKind in the top 2 bits
+_TICKS_MASK = 0x3FFFFFFFFFFFFFFF
+# Whether DateTime[] can be pinned (not on .NET Framework). None until tried
+_pin_datetime: Optional[bool] = None
+
+
+def _element_type(net_array) -> Optional[str]:
+    try:
+        return net_array.GetType().GetElementType().FullName
+    except AttributeError:
+        return None
+
+
+def _copy_pinned(net_array, out):
+    "Copy the memory of a .NET array of value types into the NumPy array `out`"
+    if len(out):
+        handle = GCHandle.Alloc(net_array, GCHandleType.Pinned)
+        try:
+            ctypes.memmove(out.ctypes.data, handle.AddrOfPinnedObject().ToInt64(), out.nbytes)
+        finally:
+            handle.Free()
+    return out
+
+
+def _unbox_doubles(net_array):
+    """Unbox a System.Object[] holding only doubles with one Array.Copy in the .NET runtime.
+    Returns None if any element is not a double"""
+    try:
+        doubles = System.Array.CreateInstance(System.Double, len(net_array))
+        System.Array.Copy(net_array, doubles, len(net_array))
+    except Exception:
+        return None
+    return _copy_pinned(doubles, np.empty(len(net_array), dtype=np.float64))
+
+
+def net_to_numpy(net_array, dtype=None):
+    """
+    Copy a one-dimensional .NET array into a NumPy array.
+
+    Arrays of primitive value types are copied as one block of memory, and so are
+    System.Object[] arrays holding only doubles, after unboxing them in .NET. Other
+    arrays are converted element by element, to `dtype` if given, otherwise to
+    float64 if possible and to an object array if not.
+    """
+    n = len(net_array)
+    element_type = _element_type(net_array)
+    src_type = _blittable.get(element_type)
+
+    if src_type is not None:
+        out = _copy_pinned(net_array, np.empty(n, dtype=src_type))
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    if element_type == 'System.Object' and n and (dtype is None or np.dtype(dtype) == np.float64):
+        out = _unbox_doubles(net_array)
+        if out is not None:
+            return out
+    if dtype is not None:
+        return np.fromiter(net_array, dtype=dtype, count=n)
+    return values_to_numpy(net_array)
+
+
+def values_to_numpy(values):
+    """
+    Convert a sequence of sample values to a float64 array. If any of the
+    values are non-numeric (strings, arrays, None), an object array is returned.
+    """
+    n = len(values)
+    try:
+        return np.fromiter(values, dtype=np.float64, count=n)
+    except (TypeError, ValueError):
+        out = np.empty(n, dtype=object)
+        out[:] = list(values)
+        return out
+
+
+def ticks_to_numpy(ticks):
+    "Convert an int64 array of .NET ticks to a datetime64[us] array"
+    ticks = np.asarray(ticks, dtype=np.int64)
+    return ((ticks - EPOCH_TICKS) // TICKS_PER_US).astype(TIME_DTYPE)
+
+
+def numpy_to_ticks(times):
+    "Convert an array of datetime64 values to an int64 array of .NET ticks"
+    us = np.asarray(times).astype(TIME_DTYPE).astype(np.int64)
+    return us * TICKS_PER_US + EPOCH_TICKS
+
+
+def net_ticks(net_times):
+    """Copy the ticks of a .NET DateTime[] into an int64 array. The array is copied as one
+    block where the runtime allows pinning it, otherwise element by element"""
+    global _pin_datetime
+    n = len(net_times)
+    if _pin_datetime is not False and n and _element_type(net_times) == 'System.DateTime':
+        try:
+            data = _copy_pinned(net_times, np.empty(n, dtype=np.uint64))
+            _pin_datetime = True
+            return (data & np.uint64(_TICKS_MASK)).astype(np.int64)
+        except Exception:
+            _pin_datetime = False
+    return np.fromiter((t.Ticks for t in net_times), dtype=np.int64, count=n)
+
+
+def net_times_to_numpy(net_times):
+    "Convert a .NET DateTime[] to a datetime64[us] array"
+    return ticks_to_numpy(net_ticks(net_times))
+
+
+def numpy_times_to_net(times):
+    "Convert an array of datetime64 values to a .NET DateTime[]"
+    return System.Array[System.DateTime]([System.DateTime(int(t)) for t in numpy_to_ticks(times)])
+
+
+def to_datetime64(times):
+    """
+    Convert a datetime, a sequence of datetimes, a datetime64 array or a
+    pandas DatetimeIndex to a datetime64[us] array. Timezone aware pandas
+    timestamps are converted to UTC.
+    """
+    tz = getattr(times, 'tz', None)
+    if tz is not None:
+        times = times.tz_convert('UTC').tz_localize(None)
+    if isinstance(times, datetime):
+        return np.datetime64(times, 'us')
+    return np.asarray(times, dtype=TIME_DTYPE)
+
+
+class ArrayTimeseries(NamedTuple):
+    """
+    A timeseries for one item stored as three parallel NumPy arrays:
+    time (datetime64[us]), value (float64 or object) and quality (uint32).
+    """
+    item_id: str
+    time: 'np.ndarray'
+    value: 'np.ndarray'
+    quality: 'np.ndarray'
+
+    def __repr__(self):
+        return f"<Apis.ArrayTimeseries: '{self.item_id}', len={len(self.time)}>"
+
+    @property
+    def size(self):
+        "The number of samples in the timeseries"
+        return len(self.time)
+
+    @staticmethod
+    def empty(item_id: str) -> "ArrayTimeseries":
+        return ArrayTimeseries(item_id, np.empty(0, dtype=TIME_DTYPE), np.empty(0, dtype=np.float64), np.empty(0, dtype=QUALITY_DTYPE))
+
+    @staticmethod
+    def from_hive_TS(item_id, raw_ts) -> "ArrayTimeseries":
+        "Create an ArrayTimeseries directly from the arrays of a hive timeseries result"
+        return ArrayTimeseries(
+            item_id,
+            net_times_to_numpy(raw_ts.Timestamps),
+            net_to_numpy(raw_ts.Values),
+            net_to_numpy(raw_ts.Qualities, QUALITY_DTYPE))
+
+    @staticmethod
+    def from_timeseries(ts: Timeseries) -> "ArrayTimeseries":
+        "Create an ArrayTimeseries from a list based Timeseries"
+        return ArrayTimeseries(
+            ts.item_id,
+            np.array([vqt.time for vqt in ts.ts], dtype=TIME_DTYPE),
+            values_to_numpy([vqt.value for vqt in ts.ts]),
+            np.fromiter((int(vqt.quality) for vqt in ts.ts), dtype=QUALITY_DTYPE, count=len(ts.ts)))
+
+    def select(self, index) -> "ArrayTimeseries":
+        "Return the samples selected by `index` (a slice, boolean mask or index array)"
+        return ArrayTimeseries(self.item_id, self.time[index], self.value[index], self.quality[index])
+
+    def filter(self, quality_policy: str = 'good') -> "ArrayTimeseries":
+        "Return the samples kept by `quality_policy`: 'good', 'usable' (not bad, not NaN) or 'all'. See `quality.mask`"
+        if quality_policy == 'all':
+            return self
+        return self.select(_quality.mask(self.quality, quality_policy, self.value))
+
+    def to_timeseries(self) -> Timeseries:
+        "Convert to a list based Timeseries"
+        times = self.time.astype(TIME_DTYPE).tolist()
+        ts = [VQT(v, Quality(q), t) for v, q, t in zip(self.value.tolist(), self.quality.tolist(), times)]
+        return Timeseries(self.item_id, None, ts)
+
+
+def _same(x, y) -> bool:
+    "Internal. True if two sample values are equal, NaN's and arrays included"
+    if x is y:
+        return True
+    try:
+        return bool(x == y) or (x != x and y != y)
+    except (TypeError, ValueError):
+        return np.array_equal(x, y)
+
+
+def _repeated(prev, page) -> int:
+    """Internal. The number of samples at the start of `page` repeating the samples at the end of
+    `prev`. Both are (time, value, quality) arrays, with the time as datetime64 or .NET ticks"""
+    if prev is None or not len(page[0]):
+        return 0
+    tail = [a[np.searchsorted(prev[0], page[0][0]):] for a in prev]
+    k = min(len(tail[0]), len(page[0]))
+    same = (tail[0][:k] == page[0][:k]) & (tail[2][:k] == page[2][:k])
+    v, w = tail[1][:k], page[1][:k]
+    if v.dtype.kind == 'f' and w.dtype.kind == 'f':
+        same &= (v == w) | (np.isnan(v) & np.isnan(w))
+    else:
+        same &= np.fromiter((_same(x, y) for x, y in zip(v, w)), dtype=bool, count=k)
+    return k if same.all() else int(np.argmin(same))
+
+
+def _raw_pages(read, start: datetime, end: datetime, page_size: int):
+    """
+    Internal. Generator of raw history pages of at most `page_size` samples, read with
+    `read(start, size)` returning (time, value, quality) arrays with the time as datetime64
+    or .NET ticks.
+
+    Each read starts at the last timestamp of the previous page (truncated to milliseconds
+    by the hive), and only the samples repeating the end of the previous page are dropped,
+    so samples sharing a timestamp are kept. A full page without new samples (more than
+    `size` samples share its timestamps) is read again with twice the size. The reading
+    stops at the first page with fewer samples than requested.
+    """
+    prev, size = None, page_size
+    while start < end:
+        page = read(start, size)
+        count = len(page[0])
+        skip = _repeated(prev, page)
+        for i in range(skip, count, page_size):
+            yield tuple(a[i:i + page_size] for a in page)
+        if count < size:
+            break
+        if skip == count:
+            size *= 2
+            continue
+        prev, size = page, page_size
+        last = page[0][-1]
+        start = (last if last.dtype.kind == 'M' else ticks_to_numpy(last)).item()
+
+
+def concat(item_id: str, parts: Sequence[ArrayTimeseries]) -> ArrayTimeseries:
+    "Concatenate several time-ordered ArrayTimeseries parts for the same item"
+    parts = [p for p in parts if p.size]
+    if not parts:
+        return ArrayTimeseries.empty(item_id)
+    if len(parts) == 1:
+        return parts[0]._replace(item_id=item_id)
+    return ArrayTimeseries(
+        item_id,
+        np.concatenate([p.time for p in parts]),
+        np.concatenate([p.value for p in parts]),
+        np.concatenate([p.quality for p in parts]))
+
+
+def union_index(series: Sequence[ArrayTimeseries]):
+    "Return the sorted union of all timestamps in `series`"
+    if not series:
+        return np.empty(0, dtype=TIME_DTYPE)
+    return np.unique(np.concatenate([s.time.astype(TIME_DTYPE) for s in series]))
+
+
+def to_frame(series: List[ArrayTimeseries], quality: bool = False):
+    """
+    Build a wide, timestamp-indexed pandas DataFrame with one column per item.
+    Timestamps missing for an item are NaN (None for non-numeric items).
+
+    Arguments:
+    series: The timeseries to include as columns
+    quality: If True, the columns are a MultiIndex (item_id, 'value'|'quality')
+             and the quality columns hold nullable unsigned integers.
+    """
+    pd = _import_optional('pandas', 'DataFrame support')
+
+    index = union_index(series)
+    n = len(index)
+    data = {}
+    for s in series:
+        pos = np.searchsorted(index, s.time.astype(TIME_DTYPE))
+        if s.value.dtype == object:
+            col = np.full(n, None, dtype=object)
+        else:
+            col = np.full(n, np.nan, dtype=np.float64)
+        col[pos] = s.value
+
+        if not quality:
+            data[s.item_id] = col
+            continue
+
+        qual = np.zeros(n, dtype=QUALITY_DTYPE)
+        mask = np.ones(n, dtype=bool)
+        qual[pos] = s.quality
+        mask[pos] = False
+        data[(s.item_id, 'value')] = col
+        data[(s.item_id, 'quality')] = pd.arrays.IntegerArray(qual, mask)
+
+    frame = pd.DataFrame(data, index=pd.DatetimeIndex(index, name='time'))
+    if quality:
+        frame.columns = pd.MultiIndex.from_tuples(frame.columns, names=['item_id', 'field'])
+    return frame
+
+
+def from_frame(frame, quality=None):
+    """
+    Split a wide DataFrame (as produced by `to_frame`) into a list of
+    ArrayTimeseries, dropping missing values. If the frame has no quality
+    columns, `quality` (default: good) is used for every sample.
+    """
+    pd = _import_optional('pandas', 'DataFrame support')
+
+    times = to_datetime64(pd.DatetimeIndex(frame.index))
+    default_q = int(Quality() if quality is None else Quality.factory(quality))
+
+    if isinstance(frame.columns, pd.MultiIndex):
+        item_ids = list(dict.fromkeys(frame.columns.get_level_values(0)))
+        columns = [(i, frame[(i, 'value')], frame.get((i, 'quality'))) for i in item_ids]
+    else:
+        columns = [(str(c), frame[c], None) for c in frame.columns]
+
+    result = []
+    for item_id, values, quals in columns:
+        keep = ~pd.isna(values).to_numpy()
+        if quals is None:
+            q = np.full(int(keep.sum()), default_q, dtype=QUALITY_DTYPE)
+        else:
+            q = quals.to_numpy(dtype=QUALITY_DTYPE, na_value=default_q)[keep]
+        vals = values.to_numpy()[keep]
+        result.append(ArrayTimeseries(str(item_id), times[keep], vals, q))
+    return result
+
+
+_ALIGN_METHODS = ('previous', 'linear', 'nearest')
+
+
+class AlignedSeries(NamedTuple):
+    """
+    Several timeseries on a common time grid. `value` and `quality` are 2-D arrays
+    with one row per grid point and one column per item. `quality` is None if
+    the qualities were not requested.
+    """
+    item_ids: List[str]
+    time: 'np.ndarray'
+    value: 'np.ndarray'
+    quality: Optional['np.ndarray']
+
+    def __repr__(self):
+        return f"<Apis.AlignedSeries: {len(self.item_ids)} items x {len(self.time)} points>"
+
+    def to_frame(self):
+        "Return the values as a pandas DataFrame indexed by time, with one column per item"
+        pd = _import_optional('pandas', 'DataFrame support')
+        return pd.DataFrame(self.value, index=pd.DatetimeIndex(self.time, name='time'), columns=self.item_ids)
+
+
+def _grid(series: Sequence[ArrayTimeseries], freq, start, end):
+    "A regular grid with step `freq`, from `start` (floored to a multiple of `freq`) to `end`"
+    step = np.timedelta64(freq, 'us')
+    if step <= np.timedelta64(0, 'us'):
+        raise Error("The alignment frequency must be positive")
+    used = [s.time for s in series if s.size]
+    if start is None:
+        if not used:
+            return np.empty(0, dtype=TIME_DTYPE)
+        start = min(t[0] for t in used)
+        start = start - (start - np.datetime64(0, 'us')) % step
+    if end is None:
+        end = max(t[-1] for t in used) if used else start
+    start, end = np.datetime64(start, 'us'), np.datetime64(end, 'us')
+    return np.arange(start, end + np.timedelta64(1, 'us'), step)
+
+
+def align(series: Sequence[ArrayTimeseries], grid=None, freq=None, start=None, end=None,
+          method: str = 'previous', quality_policy: str = 'usable', max_gap=None,
+          dtype=np.float64, quality: bool = True) -> AlignedSeries:
+    """
+    Resample several timeseries with irregular timestamps onto a common time grid.
+    Each series is resampled with vectorized binary searches of the grid in its
+    timestamps, directly into preallocated 2-D output arrays, so the memory use is
+    the output plus a few temporary arrays of the grid size. The series must be
+    time ordered.
+
+    Arguments:
+    series: The timeseries, ArrayTimeseries or list based Timeseries
+    grid: The grid timestamps (datetimes, datetime64 array or DatetimeIndex), or
+    freq: The grid step as a timedelta. The grid then runs from `start` (default: the first
+          sample, floored to a multiple of `freq` since 1970-01-01) to `end` (default: the last sample)
+    method: 'previous' (the last sample at or before the grid point), 'linear' (linear interpolation
+            between the surrounding samples) or 'nearest' (the closest sample)
+    quality_policy: Which samples are used. 'usable' skips bad samples and NaN values,
+                    'good' uses only good samples and 'all' uses every sample
+    max_gap: Optional timedelta. Grid points further than this from the sample used (for 'linear':
+             between the surrounding samples) get no value
+    dtype: The dtype of the value array, i.e. float32 to halve the memory use
+    quality: If False, the quality array is not built
+
+    Grid points without a value are NaN, with quality bad | noData. The quality of other points
+    is the quality of the sample used, or for 'linear' the worse of the two samples.
+    """
+    if method not in _ALIGN_METHODS:
+        raise Error(f"Invalid alignment method '{method}'. Expected one of {', '.join(_ALIGN_METHODS)}")
+    if quality_policy not in _quality.POLICIES:
+        raise Error(f"Invalid quality policy '{quality_policy}'. Expected one of {', '.join(_quality.POLICIES)}")
+    series = [s.to_arrays() if isinstance(s, Timeseries) else s for s in series]
+    if grid is not None:
+        grid = to_datetime64(grid)
+    elif freq is not None:
+        grid = _grid(series, freq, start, end)
+    else:
+        raise Error("Either grid or freq must be given")
+
+    g = grid.astype(TIME_DTYPE).astype(np.int64)
+    gap = None if max_gap is None else np.timedelta64(max_gap, 'us').astype(np.int64)
+    n = len(g)
+    values = np.full((n, len(series)), np.nan, dtype=dtype)
+    quals = np.full((n, len(series)), _quality.NODATA, dtype=QUALITY_DTYPE) if quality else None
+
+    for col, s in enumerate(series):
+        v, q = s.value, s.quality
+        if method == 'linear' and v.dtype == object:
+            raise Error(f"Linear alignment of non-numeric item {s.item_id}")
+        keep = None if quality_policy == 'all' else _quality.mask(q, quality_policy, v)
+        t = s.time.astype(TIME_DTYPE).astype(np.int64)
+        if keep is not None and not keep.all():
+            t, v, q = t[keep], v[keep], q[keep]
+        k = len(t)
+        if not k or not n:
+            continue
+
+        if method == 'nearest':
+            right = np.searchsorted(t, g, 'left')
+            lo, hi = np.clip(right - 1, 0, k - 1), np.clip(right, 0, k - 1)
+            dist_lo, dist_hi = np.abs(g - t[lo]), np.abs(t[hi] - g)
+            idx = np.where(dist_hi < dist_lo, hi, lo)
+            ok = np.ones(n, dtype=bool) if gap is None else np.minimum(dist_lo, dist_hi) <= gap
+            col_values, col_quality = v[idx], q[idx]
+        else:
+            pos = np.searchsorted(t, g, 'right') - 1
+            idx = np.clip(pos, 0, k - 1)
+            ok = pos >= 0
+            if method == 'previous':
+                if gap is not None:
+                    ok &= g - t[idx] <= gap
+                col_values, col_quality = v[idx], q[idx]
+            else:
+                nxt = np.minimum(idx + 1, k - 1)
+                span = t[nxt] - t[idx]
+                ok &= (pos < k - 1) | (g == t[-1])
+                if gap is not None:
+                    ok &= span <= gap
+                frac = np.divide(g - t[idx], span, out=np.zeros(n), where=span > 0)
+                col_values = v[idx] + (v[nxt] - v[idx]) * frac
+                q0, q1 = q[idx], q[nxt]
+                col_quality = np.where((frac == 0) | (_quality.status(q0) <= _quality.status(q1)), q0, q1)
+
+        try:
+            values[ok, col] = col_values[ok]
+        except (TypeError, ValueError):
+            raise Error(f"The values of {s.item_id} can't be converted to {np.dtype(dtype)}")
+        if quals is not None:
+            quals[ok, col] = col_quality[ok]
+
+    return AlignedSeries([s.item_id for s in series], grid.astype(TIME_DTYPE), values, quals)
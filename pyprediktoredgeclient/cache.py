@@ -0,0 +1,300 @@
+"""
+In-process cache for history reads.
+
+History is cached per (item, aggregation, span, interval alignment) as
+time-aligned segments. A read only fetches the parts of the requested period
+that are not covered by cached segments, and the result is merged from the
+segments. Memory use is bounded by size with least-recently-used eviction of
+segments. The part of a fetched period within `fresh_period` of the present time
+is stored as a separate segment, which expires after a short time-to-live so recent
+data is re-read instead of served stale. The older part is kept until evicted.
+
+Cached reads return the same samples as uncached reads, with these exceptions:
+- Raw reads don't include the bounding values before and after the period.
+- Values changed in the history database after they were cached (i.e. older
+  than `fresh_period` when read) are served from the cache until `invalidate`.
+
+Requires numpy.
+"""
+__all__ = 'HistoryCache',
+
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Tuple
+
+from . import arrays
+from .arrays import ArrayTimeseries
+from .util import Aggregation, _import_optional
+
+np = _import_optional('numpy', 'the history cache')
+
+RAW = -1        # The aggregation key used for raw history
+
+
+class _Segment:
+    __slots__ = 'start', 'end', 'data', 'expires'
+
+    def __init__(self, start, end, data: ArrayTimeseries, expires: Optional[float]):
+        self.start = start
+        self.end = end
+        self.data = data
+        self.expires = expires
+
+    @property
+    def nbytes(self):
+        return self.data.time.nbytes + self.data.value.nbytes + self.data.quality.nbytes
+
+    def valid(self, now):
+        return self.expires is None or self.expires > now
+
+
+class CacheStats(NamedTuple):
+    segments: int
+    nbytes: int
+    hits: int
+    misses: int
+    evictions: int
+
+
+_EPOCH = np.datetime64(0, 'us')
+
+
+def _floor(t, step, origin=_EPOCH):
+    "Floor the datetime64 `t` to `origin` plus a multiple of the timedelta64 `step`"
+    return t - (t - origin) % step
+
+
+def _ceil(t, step, origin=_EPOCH):
+    f = _floor(t, step, origin)
+    return f if f == t else f + step
+
+
+def _copy(ts: ArrayTimeseries) -> ArrayTimeseries:
+    "A copy of `ts` that shares no memory with it"
+    return ArrayTimeseries(ts.item_id, ts.time.copy(), ts.value.copy(), ts.quality.copy())
+
+
+def _period(times, start, end) -> slice:
+    "The slice of the sorted `times` in [start, end). Slicing returns views, not copies"
+    return slice(np.searchsorted(times, start, 'left'), np.searchsorted(times, end, 'left'))
+
+
+class HistoryCache:
+    """
+    A size-bounded LRU cache of history segments.
+
+    Arguments:
+    max_bytes: The maximum size of the cached arrays
+    ttl: The time-to-live of segments ending less than `fresh_period` before now
+    fresh_period: Segments ending later than now - `fresh_period` expire after `ttl`
+    raw_alignment: Raw history is fetched in periods aligned to multiples of this interval
+
+    Aggregated history is cached in whole intervals starting at the requested start
+    time, and reused by requests whose start is a whole number of spans away. A
+    partial last interval (when the period is not a multiple of the span) is read
+    from the hive on every request, as it would change when the period is extended.
+    """
+    def __init__(self, max_bytes: int = 256*1024*1024, ttl: timedelta = timedelta(seconds=5),
+                 fresh_period: timedelta = timedelta(minutes=5), raw_alignment: timedelta = timedelta(minutes=1),
+                 page_size: int = 10000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl.total_seconds()
+        self.fresh_period = np.timedelta64(fresh_period, 'us')
+        self.raw_alignment = np.timedelta64(raw_alignment, 'us')
+        self.page_size = page_size
+
+        self._segments = {}             # key -> sorted list of _Segment
+        self._lru = OrderedDict()       # (key, segment start) -> _Segment
+        self._nbytes = 0
+        self._hits = self._misses = self._evictions = 0
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f"<Apis.HistoryCache: {self.stats}>"
+
+    @property
+    def stats(self) -> CacheStats:
+        return CacheStats(len(self._lru), self._nbytes, self._hits, self._misses, self._evictions)
+
+    def clear(self):
+        "Remove all cached segments"
+        with self._lock:
+            for (key, _), seg in self._lru.items():
+                self._discard(key, seg)
+            self._segments.clear()
+            self._lru.clear()
+            self._nbytes = 0
+
+    def invalidate(self, item_id: str):
+        "Remove all cached segments for an item"
+        with self._lock:
+            for key in [k for k in self._segments if k[0] == item_id]:
+                for seg in self._segments.pop(key):
+                    self._drop(key, seg)
+
+    # Segment bookkeeping. Must be called with the lock held
+
+    def _new_segment(self, key, start, end, data: ArrayTimeseries, expires: Optional[float]) -> _Segment:
+        "Create the segment for new data. Subclasses may store the data elsewhere"
+        return _Segment(start, end, data, expires)
+
+    def _discard(self, key, seg: _Segment):
+        "Called when a segment is removed from the cache"
+
+    def _drop(self, key, seg):
+        if self._lru.pop((key, seg.start), None) is not None:
+            self._nbytes -= seg.nbytes
+            self._discard(key, seg)
+
+    def _valid_segments(self, key, now):
+        segs = self._segments.get(key, [])
+        expired = [s for s in segs if not s.valid(now)]
+        for seg in expired:
+            segs.remove(seg)
+            self._drop(key, seg)
+        return segs
+
+    def _gaps(self, key, start, end, now) -> List[Tuple]:
+        "The parts of [start, end) not covered by valid segments"
+        gaps = []
+        pos = start
+        for seg in self._valid_segments(key, now):
+            if seg.end <= pos or seg.start >= end:
+                continue
+            if seg.start > pos:
+                gaps.append((pos, seg.start))
+            pos = max(pos, seg.end)
+        if pos < end:
+            gaps.append((pos, end))
+        return gaps
+
+    def _store(self, key, start, end, data: ArrayTimeseries, step=None, origin=_EPOCH):
+        """Store the parts of `data` in [start, end) that are not already cached. The
+        parts after now - `fresh_period` (floored to the `step` grid) expire after `ttl`"""
+        now = time.monotonic()
+        split = np.datetime64(datetime.utcnow(), 'us') - self.fresh_period
+        if step is not None:
+            split = _floor(split, step, origin)
+        with self._lock:
+            for a, b in self._gaps(key, start, end, now):
+                for a2, b2, expires in ((a, min(b, split), None), (max(a, split), b, now + self.ttl)):
+                    if a2 >= b2:
+                        continue
+                    part = _copy(data.select(_period(data.time, a2, b2)))     # Don't keep the fetched page alive
+                    seg = self._new_segment(key, a2, b2, part, expires)
+                    segs = self._segments.setdefault(key, [])
+                    segs.insert(bisect.bisect([s.start for s in segs], a2), seg)
+                    self._lru[(key, a2)] = seg
+                    self._nbytes += seg.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes and self._lru:
+            (key, _), seg = self._lru.popitem(last=False)
+            self._nbytes -= seg.nbytes
+            self._segments[key].remove(seg)
+            self._evictions += 1
+            self._discard(key, seg)
+
+    def _lookup(self, key, item_id, start, end) -> ArrayTimeseries:
+        """The cached samples in [start, end). The result never shares writeable memory with
+        the segments, so callers can't change the cache. Read-only views are returned as they are"""
+        with self._lock:
+            parts = []
+            for seg in self._valid_segments(key, time.monotonic()):
+                if seg.end <= start or seg.start >= end:
+                    continue
+                self._lru.move_to_end((key, seg.start))
+                part = seg.data.select(_period(seg.data.time, start, end))
+                if part.size:
+                    parts.append(part)
+            if len(parts) == 1 and any(a.flags.writeable for a in parts[0][1:]):
+                return _copy(parts[0])._replace(item_id=item_id)
+            return arrays.concat(item_id, parts)
+
+    def _missing(self, key, start, end, step, origin=_EPOCH):
+        with self._lock:
+            gaps = self._gaps(key, start, end, time.monotonic())
+            if gaps:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return [(_floor(a, step, origin), _ceil(b, step, origin)) for a, b in gaps]
+
+    # Reading
+
+    def _fetch_raw(self, key, item, a, b, t0, need: Optional[int]):
+        """Fetch raw history in [a, b) page by page. With `need`, stop when at least that
+        many samples from `t0` are read, and store only the period before the last timestamp
+        read (more samples may share it). Returns the end of the stored period"""
+        parts = []
+        pages = item.read_raw_pages(a.item(), b.item(), self.page_size)
+        for page in pages:
+            parts.append(page)
+            if need is None:
+                continue
+            last = page.time[-1]
+            count = sum(int(np.searchsorted(p.time, last, 'left') - np.searchsorted(p.time, t0, 'left')) for p in parts)
+            if count >= need and last > a:
+                pages.close()
+                data = arrays.concat(item.item_id, parts)
+                self._store(key, a, last, data, self.raw_alignment)
+                return last
+        self._store(key, a, b, arrays.concat(item.item_id, parts), self.raw_alignment)
+        return b
+
+    def read_raw(self, item, start: datetime, end: datetime, maxpoints: Optional[int] = None) -> ArrayTimeseries:
+        """
+        Read raw history for `item` in [start, end), fetching only the uncached parts.
+        With `maxpoints`, the first `maxpoints` samples are returned, and uncached history
+        is only fetched until they are read. Bounding values outside the period are not included.
+        """
+        key = (item.item_id, RAW, None, 0)
+        t0, t1 = np.datetime64(start, 'us'), np.datetime64(end, 'us')
+        stop = t1
+        for a, b in self._missing(key, t0, t1, self.raw_alignment):
+            need = None
+            if maxpoints is not None:
+                need = maxpoints - self._lookup(key, item.item_id, t0, max(a, t0)).size
+                if need <= 0:
+                    stop = max(a, t0)
+                    break
+            fetched = self._fetch_raw(key, item, a, b, t0, need)
+            if fetched < b:
+                stop = min(fetched, t1)
+                break
+        result = self._lookup(key, item.item_id, t0, stop)
+        return result if maxpoints is None else result.select(slice(0, maxpoints))
+
+    def read_agg(self, item, start: datetime, end: datetime, span: timedelta, *aggregation: Aggregation) -> List[ArrayTimeseries]:
+        """
+        Read aggregated history for `item`, one ArrayTimeseries per aggregate, fetching
+        only the intervals that are not cached. The intervals start at `start`, as for `Item.read_agg`.
+        """
+        step = np.timedelta64(span, 'us')
+        t0, t1 = np.datetime64(start, 'us'), np.datetime64(end, 'us')
+        phase = int(((t0 - _EPOCH) % step).astype(np.int64))
+        full_end = t0 + (t1 - t0) // step * step        # The end of the last whole interval
+        keys = [(item.item_id, int(agg), span, phase) for agg in aggregation]
+
+        # Group the aggregates by missing period, so aggregates missing the same period are fetched together
+        wanted = {}
+        if full_end > t0:
+            for agg, key in zip(aggregation, keys):
+                for gap in self._missing(key, t0, full_end, step, t0):
+                    wanted.setdefault(gap, []).append(agg)
+
+        for (a, b), aggs in wanted.items():
+            pages = list(item.read_agg_pages(a.item(), b.item(), span, *aggs, page_size=self.page_size))
+            for i, agg in enumerate(aggs):
+                key = (item.item_id, int(agg), span, phase)
+                self._store(key, a, b, arrays.concat(item.item_id, [page[i] for page in pages]), step, t0)
+
+        results = [self._lookup(key, item.item_id, t0, full_end) for key in keys]
+        if full_end < t1:
+            tail = list(item.read_agg_pages(full_end.item(), t1.item(), span, *aggregation, page_size=self.page_size))
+            results = [arrays.concat(item.item_id, [r] + [page[i] for page in tail]) for i, r in enumerate(results)]
+        return results
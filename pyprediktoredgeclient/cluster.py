@@ -0,0 +1,239 @@
+"""
+Reads and writes across several hive instances, i.e. one hive per production line.
+"""
+__all__ = 'HiveCluster', 'ClusterValues'
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from .hive import Hive, Item
+from .util import Error, ItemVQT, Quality, _import_optional
+
+Target = Union[Hive, Tuple[Optional[str], Optional[str]]]
+
+
+class ClusterValues(NamedTuple):
+    """
+    Current values from several hives as columns, in the order the items were requested.
+    Items on targets that failed, timed out or were busy have value None, bad quality and
+    time None, and the target's exception is in `errors`. So have items whose module couldn't
+    be found because a target was unreachable during discovery. Their `target` is None.
+    """
+    item_id: List[str]
+    value: List[Any]
+    quality: List[Quality]
+    time: List[Optional[datetime]]
+    target: List[str]
+    errors: Dict[str, Exception]
+
+    def __len__(self):
+        return len(self.item_id)
+
+    def to_frame(self):
+        "Return the values as a pandas DataFrame indexed by item-id"
+        pd = _import_optional('pandas', 'DataFrame support')
+        return pd.DataFrame({'value': self.value, 'quality': self.quality, 'time': self.time, 'target': self.target},
+                            index=pd.Index(self.item_id, name='item_id'))
+
+
+def _target_name(target: Target) -> str:
+    if isinstance(target, Hive):
+        return target.name
+    instance, host = target
+    name = getattr(instance, 'name', instance) or 'ApisHive'
+    return f"{name}@{host}" if host else name
+
+
+class HiveCluster:
+    """
+    A set of hives, read and written concurrently. Item-id's are routed to the hives by
+    the longest matching prefix in `routes`, and otherwise by the module name (the part
+    of the item-id before the first '.'), using a map of modules discovered from the hives.
+
+    Arguments:
+    targets: The hives. A list of Hive objects or (instance, host) tuples, or a dict of
+             target name: Hive or (instance, host). Hives are connected on first use
+    routes: Optional dict of item-id prefix: target name
+    timeout: The default number of seconds to wait for the targets. Targets that don't answer
+             in time are reported in the result, and don't delay the others. A target still
+             busy with a call that timed out is reported as busy until that call returns
+
+    >>> with HiveCluster([('Line1', 'srv1'), ('Line2', 'srv2')]) as cluster:
+    ...     snapshot = cluster.get_values(['Line1Mod.Flow', 'Line2Mod.Flow'])
+    """
+    def __init__(self, targets: Union[Iterable[Target], Dict[str, Target]], routes: Optional[Dict[str, str]] = None,
+                 timeout: float = 10.0):
+        if not isinstance(targets, dict):
+            targets = {_target_name(t): t for t in targets}
+        if not targets:
+            raise Error("A HiveCluster needs at least one target")
+        self.targets = dict(targets)
+        self.routes = dict(routes or {})
+        self.timeout = timeout
+        for prefix, name in self.routes.items():
+            if name not in self.targets:
+                raise Error(f"Route '{prefix}' refers to unknown target '{name}'")
+
+        self._hives: Dict[str, Hive] = {n: t for n, t in self.targets.items() if isinstance(t, Hive)}
+        self._busy = set()          # Names of the targets with a call in progress
+        self._lock = threading.Lock()
+        self._module_map: Optional[Dict[str, str]] = None
+        self.unreachable: Dict[str, Exception] = {}     # Targets that failed the last discovery
+        self._pool = ThreadPoolExecutor(max_workers=len(self.targets), thread_name_prefix='HiveCluster')
+
+    def __repr__(self):
+        return f"<Apis.HiveCluster: {', '.join(self.targets)}>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        "Stop the worker threads. Calls that timed out are not waited for"
+        self._pool.shutdown(wait=False)
+
+    def hive(self, name: str) -> Hive:
+        "Return the Hive of the target `name`, connecting if needed"
+        hive = self._hives.get(name)
+        if hive is None:
+            instance, host = self.targets[name]
+            hive = self._hives[name] = Hive(instance, host)
+        return hive
+
+    def _run(self, calls: Dict[str, Any], timeout: Optional[float]) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        """Run `calls` (target name: function of the Hive) concurrently. Returns the results and
+        the errors by target name. Targets with a call still in progress are not called again,
+        so a hanging target holds at most one worker thread"""
+        timeout = self.timeout if timeout is None else timeout
+        results, errors = {}, {}
+
+        def call(name, func):
+            try:
+                return func(self.hive(name))
+            finally:
+                with self._lock:
+                    self._busy.discard(name)
+
+        futures = {}
+        for name, func in calls.items():
+            with self._lock:
+                if name in self._busy:
+                    errors[name] = Error(f"{name} is busy with an earlier call that hasn't returned")
+                    continue
+                self._busy.add(name)
+            futures[name] = self._pool.submit(call, name, func)
+        wait(futures.values(), timeout)
+        for name, future in futures.items():
+            if not future.done():
+                errors[name] = Error(f"Timeout after {timeout}s waiting for {name}")
+            elif future.exception() is not None:
+                errors[name] = future.exception()
+            else:
+                results[name] = future.result()
+        return results, errors
+
+    def discover(self, timeout: Optional[float] = None, targets: Optional[Iterable[str]] = None) -> Dict[str, str]:
+        """
+        Read the module names of the targets (default: all), and return the map of module name:
+        target name used for routing. Targets that fail are left out of the map, and their
+        exceptions are kept in `unreachable`. Raises Error if a module name is used by several targets.
+        """
+        names = list(self.targets if targets is None else targets)
+        results, errors = self._run({name: lambda hive: [m.name for m in hive.modules] for name in names}, timeout)
+        module_map = {mod: name for mod, name in (self._module_map or {}).items() if name not in names}
+        for name, modules in results.items():
+            for mod in modules:
+                if module_map.setdefault(mod, name) != name:
+                    raise Error(f"Module '{mod}' found on both {module_map[mod]} and {name}. Add a route")
+        unreachable = {n: e for n, e in self.unreachable.items() if n not in names}
+        unreachable.update(errors)
+        self._module_map, self.unreachable = module_map, unreachable
+        return module_map
+
+    def _route(self, item_ids: List[str]) -> Tuple[Dict[str, List[int]], List[int]]:
+        "The positions of `item_ids` grouped by target name, and the positions that can't be routed"
+        prefixes = sorted(self.routes, key=len, reverse=True)
+        groups: Dict[str, List[int]] = {}
+        unknown = []
+        for i, item_id in enumerate(item_ids):
+            name = next((self.routes[p] for p in prefixes if item_id.startswith(p)), None)
+            if name is None:
+                unknown.append(i)
+            else:
+                groups.setdefault(name, []).append(i)
+        if unknown and (self._module_map is None or self.unreachable):
+            modules = self._module_map or {}
+            if self._module_map is None or any(item_ids[i].split('.', 1)[0] not in modules for i in unknown):
+                self.discover(targets=None if self._module_map is None else list(self.unreachable))
+        unrouted = []
+        for i in unknown:
+            name = self._module_map.get(item_ids[i].split('.', 1)[0])
+            if name is None:
+                unrouted.append(i)
+            else:
+                groups.setdefault(name, []).append(i)
+        for pos in groups.values():
+            pos.sort()
+        if unrouted and not self.unreachable:
+            raise Error(f"No target found for item(s): {', '.join(item_ids[i] for i in unrouted)}")
+        return groups, unrouted
+
+    def route(self, item_ids: Iterable[str]) -> Dict[str, List[int]]:
+        """Return the positions of `item_ids` grouped by target name. Targets that were unreachable
+        during discovery are discovered again when an item-id's module is unknown. Raises Error for
+        item-id's that can't be routed"""
+        item_ids = list(item_ids)
+        groups, unrouted = self._route(item_ids)
+        if unrouted:
+            raise Error(f"No target found for item(s): {', '.join(item_ids[i] for i in unrouted)}. "
+                        f"Unreachable: {'/'.join(f'{n}: {e}' for n, e in self.unreachable.items())}")
+        return groups
+
+    def get_values(self, items, since: Optional[datetime] = None, timeout: Optional[float] = None) -> ClusterValues:
+        """
+        Read current values from all targets concurrently. Item-id's that can't be routed raise
+        Error, unless a target was unreachable during discovery: then they are returned with
+        bad quality, and the unreachable targets are in `errors`.
+
+        Arguments:
+        items: A list of Item objects or item-id's
+        since: Optional oldest time of the values. See `Hive.get_values`
+        timeout: Optional number of seconds to wait. Default: the cluster timeout
+        """
+        item_ids = [i.item_id if isinstance(i, Item) else str(i) for i in items]
+        groups, unrouted = self._route(item_ids)
+        calls = {name: (lambda hive, ids=[item_ids[i] for i in pos]: hive.get_values(ids, since))
+                 for name, pos in groups.items()}
+        results, errors = self._run(calls, timeout)
+        if unrouted:
+            errors.update((n, e) for n, e in self.unreachable.items() if n not in errors)
+
+        n = len(item_ids)
+        values, qualities, times, targets = [None]*n, [Quality(0)]*n, [None]*n, [None]*n
+        for name, pos in groups.items():
+            for i in pos:
+                targets[i] = name
+            for i, vqt in zip(pos, results.get(name, ())):
+                values[i], qualities[i], times[i] = vqt.value, vqt.quality, vqt.time
+        return ClusterValues(item_ids, values, qualities, times, targets, errors)
+
+    def set_values(self, set_vals: List[ItemVQT], timeout: Optional[float] = None) -> Dict[str, Exception]:
+        """
+        Write values to all targets concurrently. See `Hive.set_values`. Values for item-id's
+        that can't be routed because a target was unreachable during discovery are not written.
+
+        Returns:
+        A dict of target name: exception for the targets that failed, timed out, were busy or
+        were unreachable when values couldn't be routed
+        """
+        groups, unrouted = self._route([v.item_id for v in set_vals])
+        calls = {name: (lambda hive, vals=[set_vals[i] for i in pos]: hive.set_values(vals))
+                 for name, pos in groups.items()}
+        _, errors = self._run(calls, timeout)
+        if unrouted:
+            errors.update((n, e) for n, e in self.unreachable.items() if n not in errors)
+        return errors
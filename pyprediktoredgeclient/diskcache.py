@@ -0,0 +1,317 @@
+"""
+Persistent, memory-mapped history cache.
+
+Works like `cache.HistoryCache`, but the segments are stored on disk as three
+NumPy files per segment (timestamps, values and qualities), so cached history
+survives restarts of the process. Segments are memory-mapped when first read,
+and a read covered by one segment is returned as views of the mapped files
+without copying. An index file lists the segments and when they were last used,
+and the total size on disk is bounded with least-recently-used eviction.
+
+With `compress=True`, each segment is stored as one file in the `codec` format,
+which is typically several times smaller. Compressed segments are decoded on
+each read instead of memory-mapped.
+
+Segments ending close to the present time, and segments with non-numeric values,
+are only kept in memory, bounded separately from the segments on disk.
+
+Files that can't be deleted when their segment is evicted (on Windows, while a
+returned view of a mapped file is still in use) are retried on each index write.
+Files the index doesn't list, i.e. written after the last index write before the
+process ended, are removed when the cache is opened if they are more than a day old.
+
+Several processes can share a directory: each index write merges the segments
+other processes have listed, segment files are replaced atomically, and segments
+whose files were removed by another process are dropped. Each process bounds the
+segments it uses, so the directory may grow beyond `max_bytes` while several
+processes are writing to it.
+
+Requires numpy.
+"""
+__all__ = 'DiskHistoryCache',
+
+import atexit
+import hashlib
+import json
+import os
+import re
+import time
+import weakref
+from datetime import timedelta
+from typing import Optional
+
+from . import codec
+from .arrays import ArrayTimeseries, QUALITY_DTYPE, TIME_DTYPE
+from .cache import HistoryCache, _Segment
+from .util import _import_optional
+
+np = _import_optional('numpy', 'the disk history cache')
+
+_INDEX = 'index.json'
+_FLUSH_INTERVAL = 30.0      # Minimum seconds between index writes, except for invalidate and clear
+_ORPHAN_AGE = 24*3600.0     # Seconds before an unlisted file is removed, as another process may not have listed it yet
+_KEY_DIR = re.compile(r'[0-9a-f]{20}$')
+_COLUMNS = 'time', 'value', 'quality'
+
+
+class _DiskSegment(_Segment):
+    """A segment stored on disk. The files are memory-mapped on first access, or
+    decoded on each access if compressed"""
+    __slots__ = 'path', 'item_id', 'size', 'used', 'compressed', '_data'
+
+    def __init__(self, start, end, path: str, item_id: str, size: int, used: float, compressed: bool = False):
+        self.start = start
+        self.end = end
+        self.expires = None
+        self.path = path
+        self.item_id = item_id
+        self.size = size
+        self.used = used
+        self.compressed = compressed
+        self._data = None
+
+    @property
+    def data(self) -> ArrayTimeseries:
+        self.used = time.time()
+        if self.compressed:
+            with open(self.files()[0], 'rb') as f:
+                return codec.decode(f.read())._replace(item_id=self.item_id)
+        if self._data is None:
+            self._data = ArrayTimeseries(self.item_id, *(np.load(f"{self.path}.{c}.npy", mmap_mode='r') for c in _COLUMNS))
+        return self._data
+
+    @property
+    def nbytes(self):
+        return self.size
+
+    def valid(self, now):
+        "False if the files were removed, e.g. evicted by another process using the directory"
+        return (self._data is not None and not self.compressed) or all(os.path.exists(f) for f in self.files())
+
+    def files(self):
+        if self.compressed:
+            return [f"{self.path}.apc"]
+        return [f"{self.path}.{c}.npy" for c in _COLUMNS]
+
+
+def _us(t) -> int:
+    return int(t.astype(TIME_DTYPE).astype(np.int64))
+
+
+def _remove(path: str) -> bool:
+    "Delete a file. Returns False if it exists but can't be deleted"
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return False
+    return True
+
+
+def _save(path: str, write):
+    "Write a file with `write(f)` via a temporary file, so readers never see it partly written"
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def _flush_at_exit(ref):
+    cache = ref()
+    if cache is not None:
+        try:
+            cache.flush()
+        except OSError:
+            pass
+
+
+class DiskHistoryCache(HistoryCache):
+    """
+    A history cache stored in `directory`, bounded to `max_bytes` on disk. Use it as
+    the history cache of a Hive:
+
+    >>> hive.history_cache = DiskHistoryCache('~/.apis-history')
+
+    Segments kept only in memory are bounded to `max_memory_bytes`. The index is
+    written at most every 30 seconds when segments change, by `flush()`, and when
+    the process exits. New segments are stored compressed if `compress` is set.
+    Existing segments are read in the format they were stored in. See
+    `cache.HistoryCache` for the other arguments.
+    """
+    def __init__(self, directory: str, max_bytes: int = 4*1024**3, compress: bool = False,
+                 max_memory_bytes: int = 256*1024*1024, **kw):
+        super().__init__(max_bytes=max_bytes, **kw)
+        self.compress = compress
+        self.max_memory_bytes = max_memory_bytes
+        self._disk_bytes = 0
+        self._pending = set()       # Paths of files that couldn't be deleted yet
+        self._flushed = time.monotonic()
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+        atexit.register(_flush_at_exit, weakref.ref(self))
+
+    def __repr__(self):
+        return f"<Apis.DiskHistoryCache: {self.directory}, {self.stats}>"
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, _INDEX)
+
+    def _key_dir(self, key) -> str:
+        item_id, agg, span, phase = key
+        name = hashlib.sha1(f"{item_id}|{agg}|{span}|{phase}".encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.directory, name)
+
+    def _read_index(self) -> list:
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)['segments']
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def _from_record(self, r: dict):
+        "The key and segment of an index record"
+        span = None if r['span_us'] is None else timedelta(microseconds=r['span_us'])
+        key = (r['item_id'], r['agg'], span, r.get('phase_us', 0))
+        seg = _DiskSegment(np.datetime64(r['start_us'], 'us'), np.datetime64(r['end_us'], 'us'),
+                           os.path.join(self.directory, r['path']), r['item_id'], r['size'], r['used'],
+                           r.get('compressed', False))
+        return key, seg
+
+    def _load(self):
+        """Load the index, ordering the LRU by the last use of each segment, and remove unlisted
+        files older than a day"""
+        records = self._read_index()
+        with self._lock:
+            segments = []
+            for r in records:
+                key, seg = self._from_record(r)
+                if all(os.path.exists(f) for f in seg.files()):
+                    segments.append((key, seg))
+            for key, seg in sorted(segments, key=lambda ks: ks[1].used):
+                self._segments.setdefault(key, []).append(seg)
+                self._lru[(key, seg.start)] = seg
+                self._nbytes += seg.nbytes
+                self._disk_bytes += seg.nbytes
+            for segs in self._segments.values():
+                segs.sort(key=lambda s: s.start)
+
+            listed = {f for _, seg in segments for f in seg.files()}
+            oldest = time.time() - _ORPHAN_AGE
+            for entry in os.scandir(self.directory):
+                if entry.is_dir() and _KEY_DIR.match(entry.name):
+                    for f in os.scandir(entry.path):
+                        if (f.path not in listed and f.name.endswith(('.npy', '.apc', '.tmp'))
+                                and f.stat().st_mtime < oldest and not _remove(f.path)):
+                            self._pending.add(f.path)
+            self._evict()
+
+    def _delete_pending(self):
+        for path in list(self._pending):
+            if _remove(path):
+                self._pending.discard(path)
+                try:
+                    os.rmdir(os.path.dirname(path))
+                except OSError:
+                    pass
+
+    def flush(self):
+        """Write the index, including the last use of each segment, and retry deleting evicted files.
+        Segments listed by other processes using the directory are kept in the index while their
+        files exist"""
+        with self._lock:
+            self._delete_pending()
+            records = []
+            for (key, _), seg in self._lru.items():
+                if not isinstance(seg, _DiskSegment):
+                    continue
+                item_id, agg, span, phase = key
+                records.append(dict(
+                    item_id=item_id, agg=agg, span_us=None if span is None else span // timedelta(microseconds=1), phase_us=phase,
+                    start_us=_us(seg.start), end_us=_us(seg.end), path=os.path.relpath(seg.path, self.directory),
+                    size=seg.size, used=seg.used, compressed=seg.compressed))
+            own = {r['path'] for r in records}
+            for r in self._read_index():
+                if r['path'] in own:
+                    continue
+                files = self._from_record(r)[1].files()
+                if not self._pending.intersection(files) and all(os.path.exists(f) for f in files):
+                    records.append(r)
+                    own.add(r['path'])
+            tmp = f"{self._index_path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump({'segments': records}, f)
+            os.replace(tmp, self._index_path)
+            self._flushed = time.monotonic()
+
+    def _flush_due(self):
+        if time.monotonic() - self._flushed > _FLUSH_INTERVAL:
+            self.flush()
+
+    def _new_segment(self, key, start, end, data: ArrayTimeseries, expires: Optional[float]) -> _Segment:
+        if expires is not None or data.value.dtype == object:
+            return super()._new_segment(key, start, end, data, expires)
+        key_dir = self._key_dir(key)
+        os.makedirs(key_dir, exist_ok=True)
+        path = os.path.join(key_dir, f"{_us(start)}_{_us(end)}")
+        if self.compress:
+            seg = _DiskSegment(start, end, path, key[0], 0, time.time(), compressed=True)
+            data = codec.encode(ArrayTimeseries(key[0], data.time, np.asarray(data.value, dtype=np.float64), data.quality))
+            _save(seg.files()[0], lambda f: f.write(data))
+            seg.size = len(data)
+        else:
+            columns = (data.time.astype(TIME_DTYPE), np.asarray(data.value, dtype=np.float64), data.quality.astype(QUALITY_DTYPE))
+            for name, column in zip(_COLUMNS, columns):
+                _save(f"{path}.{name}.npy", lambda f: np.save(f, column))
+            seg = _DiskSegment(start, end, path, key[0], sum(c.nbytes for c in columns), time.time())
+        self._pending.difference_update(seg.files())
+        self._disk_bytes += seg.size
+        return seg
+
+    def _discard(self, key, seg: _Segment):
+        if not isinstance(seg, _DiskSegment):
+            return
+        self._disk_bytes -= seg.size
+        seg._data = None        # Unmap before deleting
+        failed = [f for f in seg.files() if not _remove(f)]
+        if failed:
+            self._pending.update(failed)
+            return
+        try:
+            os.rmdir(os.path.dirname(seg.path))     # Only succeeds when the key has no more segments
+        except OSError:
+            pass
+
+    def _evict(self):
+        "Evict the least recently used segments on disk above `max_bytes`, and in memory above `max_memory_bytes`"
+        for on_disk, limit in ((True, self.max_bytes), (False, self.max_memory_bytes)):
+            used = (lambda: self._disk_bytes) if on_disk else (lambda: self._nbytes - self._disk_bytes)
+            if used() <= limit:
+                continue
+            for lru_key in [k for k, seg in self._lru.items() if isinstance(seg, _DiskSegment) == on_disk]:
+                seg = self._lru.pop(lru_key)
+                self._nbytes -= seg.nbytes
+                self._segments[lru_key[0]].remove(seg)
+                self._evictions += 1
+                self._discard(lru_key[0], seg)
+                if used() <= limit:
+                    break
+
+    def _lookup(self, key, item_id, start, end) -> ArrayTimeseries:
+        result = super()._lookup(key, item_id, start, end)
+        self._flush_due()
+        return result
+
+    def _store(self, key, start, end, data: ArrayTimeseries, *args):
+        super()._store(key, start, end, data, *args)
+        self._flush_due()
+
+    def invalidate(self, item_id: str):
+        super().invalidate(item_id)
+        self.flush()
+
+    def clear(self):
+        super().clear()
+        self.flush()
@@ -0,0 +1,279 @@
+"""
+Streaming export of hive history to Parquet files.
+
+History is read page by page and each page is written as one Parquet row group,
+so memory use is bounded by the page size, the number of readers and the queue
+depth, and not by the length of the exported period. Completed files are
+recorded in a checkpoint file, so an interrupted export can be resumed.
+
+Requires numpy and pyarrow. Can be run from the command line as `apis-history-export`.
+"""
+__all__ = 'HistoryExporter', 'main'
+
+import argparse
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from .util import Aggregation, Error, _import_optional, get_enum_value
+
+pa = _import_optional('pyarrow', 'history export')
+pq = _import_optional('pyarrow.parquet', 'history export')
+
+CHECKPOINT_FILE = '_checkpoint.json'
+
+_end_of_unit = object()
+
+
+def _file_name(item_id: str) -> str:
+    """The file name of an item: the item-id with characters that aren't safe in file names
+    replaced, and a hash of the item-id, so item-id's differing only in those characters
+    (or in case, on Windows) get different files"""
+    safe = re.sub(r"[^\w.-]+", "_", item_id)
+    return f"{safe}-{hashlib.sha1(item_id.encode('utf-8')).hexdigest()[:8]}"
+
+
+class _Unit(NamedTuple):
+    "One output file: the items and the period it contains"
+    name: str
+    item_ids: List[str]
+    start: datetime
+    end: datetime
+
+
+class HistoryExporter:
+    """
+    Export raw or aggregated history for many items to Parquet.
+
+    Arguments:
+    hive: The Hive to read from
+    items: A list of Item objects or item-id's as strings
+    start, end: The period to export
+    directory: The output directory. Created if it does not exist
+    partition: 'item' for one file per item, named by the item-id and a hash of it, or 'day' for
+               one file per day containing all items
+    aggregation: Optional list of Aggregation values (or names). If given, aggregated history is exported
+    span: The aggregation interval. Required with `aggregation`
+    page_size: The number of samples (or intervals) read and written at a time
+    readers: The number of files exported in parallel
+    queue_depth: The number of pages buffered between a reader and its writer
+    value_type: The Arrow type of the value column(s), i.e. 'double' or 'string'
+    decoder: Optional `parallel.ParallelDecoder`. Raw pages are then decoded in its process pool
+    """
+    def __init__(self, hive, items, start: datetime, end: datetime, directory: str, partition: str = 'item',
+                 aggregation: Optional[Sequence] = None, span: Optional[timedelta] = None, page_size: int = 10000,
+                 readers: int = 4, queue_depth: int = 4, value_type: str = 'double', decoder=None):
+        if partition not in ('item', 'day'):
+            raise Error(f"Invalid partition '{partition}'. Expected 'item' or 'day'")
+        if aggregation and span is None:
+            raise Error("A span is required when exporting aggregated history")
+
+        self.hive = hive
+        self.item_ids = [getattr(i, 'item_id', str(i)) for i in items]
+        self.start = start
+        self.end = end
+        self.directory = directory
+        self.partition = partition
+        self.aggregation = [Aggregation(get_enum_value(Aggregation, a) if isinstance(a, str) else int(a)) for a in aggregation or []]
+        self.span = span
+        self.page_size = page_size
+        self.readers = readers
+        self.queue_depth = queue_depth
+        self.value_type = pa.type_for_alias(value_type)
+        self.decoder = decoder
+        self.schema = self._make_schema()
+        self._lock = threading.Lock()
+
+    def _make_schema(self):
+        fields = [pa.field('time', pa.timestamp('us')), pa.field('item_id', pa.dictionary(pa.int32(), pa.string()))]
+        if not self.aggregation:
+            return pa.schema(fields + [pa.field('value', self.value_type), pa.field('quality', pa.uint32())])
+        for agg in self.aggregation:
+            fields += [pa.field(agg.name, self.value_type), pa.field(f"{agg.name}_quality", pa.uint32())]
+        return pa.schema(fields)
+
+    def units(self) -> List[_Unit]:
+        "Return the output files of this export"
+        if self.partition == 'item':
+            return [_Unit(_file_name(i), [i], self.start, self.end) for i in dict.fromkeys(self.item_ids)]
+
+        result = []
+        day = datetime(self.start.year, self.start.month, self.start.day)
+        while day < self.end:
+            next_day = day + timedelta(days=1)
+            result.append(_Unit(day.strftime('%Y-%m-%d'), self.item_ids, max(day, self.start), min(next_day, self.end)))
+            day = next_day
+        return result
+
+    # Checkpointing
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.directory, CHECKPOINT_FILE)
+
+    def completed(self) -> List[str]:
+        "Return the names of the files completed by previous runs of this export"
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)['completed']
+        except FileNotFoundError:
+            return []
+
+    def _mark_completed(self, name):
+        with self._lock:
+            done = self.completed()
+            done.append(name)
+            tmp = self.checkpoint_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'completed': done}, f)
+            os.replace(tmp, self.checkpoint_path)
+
+    # Reading and writing
+
+    def _pages(self, unit: _Unit):
+        "Generator returning one Arrow record batch per history page"
+        for hive_item in self.hive.get_items(*unit.item_ids):
+            if self.aggregation:
+                for page in hive_item.read_agg_pages(unit.start, unit.end, self.span, *self.aggregation, page_size=self.page_size):
+                    yield self._agg_batch(hive_item.item_id, page)
+            else:
+                for page in hive_item.read_raw_pages(unit.start, unit.end, self.page_size, decoder=self.decoder):
+                    yield self._raw_batch(page)
+
+    def _item_column(self, item_id, n):
+        return pa.DictionaryArray.from_arrays(pa.array([0]*n, pa.int32()), pa.array([item_id]))
+
+    def _raw_batch(self, page):
+        return pa.record_batch([
+            pa.array(page.time),
+            self._item_column(page.item_id, page.size),
+            pa.array(page.value, self.value_type, from_pandas=True),
+            pa.array(page.quality)], schema=self.schema)
+
+    def _agg_batch(self, item_id, page):
+        n = page[0].size if page else 0
+        columns = [pa.array(page[0].time) if n else pa.array([], pa.timestamp('us')), self._item_column(item_id, n)]
+        for ts in page:
+            columns += [pa.array(ts.value, self.value_type, from_pandas=True), pa.array(ts.quality)]
+        return pa.record_batch(columns, schema=self.schema)
+
+    def _export_unit(self, unit: _Unit) -> int:
+        """Export one file. The pages are read in this thread and written from a
+        separate writer thread through a bounded queue."""
+        path = os.path.join(self.directory, unit.name + '.parquet')
+        part_path = path + '.part'
+        pages = queue.Queue(self.queue_depth)
+        written = [0]
+        failure = []
+
+        def writer():
+            try:
+                with pq.ParquetWriter(part_path, self.schema) as pw:
+                    while True:
+                        batch = pages.get()
+                        if batch is _end_of_unit:
+                            break
+                        if batch.num_rows:
+                            pw.write_batch(batch, row_group_size=batch.num_rows)
+                            written[0] += batch.num_rows
+            except Exception as e:
+                failure.append(e)
+                # Keep draining so the reader is never blocked on a full queue
+                while pages.get() is not _end_of_unit:
+                    pass
+
+        wthread = threading.Thread(target=writer, name=f"export-writer-{unit.name}", daemon=True)
+        wthread.start()
+        try:
+            for batch in self._pages(unit):
+                if failure:
+                    break
+                pages.put(batch)
+        finally:
+            pages.put(_end_of_unit)
+            wthread.join()
+
+        if failure:
+            raise failure[0]
+        os.replace(part_path, path)
+        self._mark_completed(unit.name)
+        return written[0]
+
+    def run(self, resume: bool = True) -> Dict[str, int]:
+        """
+        Run the export. Returns a dict with the number of rows written to each file.
+
+        Arguments:
+        resume: If True, files completed by a previous run are skipped. If False, the
+                checkpoint is cleared and everything is exported again.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if not resume and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        done = set(self.completed())
+        todo = [u for u in self.units() if u.name not in done]
+        with ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix='export-reader') as pool:
+            results = pool.map(self._export_unit, todo)
+            return dict(zip((u.name for u in todo), results))
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='apis-history-export', description='Export Apis Hive history to Parquet files')
+    parser.add_argument('items', nargs='*', help='The item-ids to export')
+    parser.add_argument('-f', '--items-file', help='File with one item-id per line')
+    parser.add_argument('-i', '--instance', help='The hive instance name (default: the default instance)')
+    parser.add_argument('--host', help='The host running the hive (default: localhost)')
+    parser.add_argument('-s', '--start', required=True, type=datetime.fromisoformat, help='Start time (ISO format, UTC)')
+    parser.add_argument('-e', '--end', type=datetime.fromisoformat, default=None, help='End time (ISO format, UTC). Default: now')
+    parser.add_argument('-o', '--output', required=True, help='The output directory')
+    parser.add_argument('-p', '--partition', choices=['item', 'day'], default='item')
+    parser.add_argument('-a', '--aggregate', action='append', help='Aggregate to export (i.e. AVERAGE). Can be repeated')
+    parser.add_argument('--span', type=float, help='Aggregation interval in seconds')
+    parser.add_argument('--page-size', type=int, default=10000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=0, help='Decode raw pages in this many worker processes (default: in the reader threads)')
+    parser.add_argument('--value-type', default='double', help="Arrow type of the values, i.e. 'double' or 'string'")
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and export everything again')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    "Console entry point"
+    from .hive import Hive
+
+    args = _parse_args(argv)
+    items = list(args.items)
+    if args.items_file:
+        with open(args.items_file) as f:
+            items += [line.strip() for line in f if line.strip()]
+    if not items:
+        raise SystemExit('No items to export')
+
+    decoder = None
+    if args.processes:
+        from .parallel import ParallelDecoder
+        decoder = ParallelDecoder(args.processes)
+
+    try:
+        exporter = HistoryExporter(
+            Hive(args.instance, args.host), items, args.start, args.end or datetime.utcnow(), args.output,
+            partition=args.partition, aggregation=args.aggregate,
+            span=timedelta(seconds=args.span) if args.span else None,
+            page_size=args.page_size, readers=args.readers, value_type=args.value_type, decoder=decoder)
+
+        for name, rows in exporter.run(resume=not args.restart).items():
+            print(f"{name}: {rows} rows")
+    finally:
+        if decoder is not None:
+            decoder.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,23 @@
 __all__ = 'Instances', 'Error', 'Hive', 'Module', 'Attr', 'Property', 'Item', 'ItemVQT', 'EventServer', 'Aggregation', 'VQT'
 
-from argparse import ArgumentError
 from itertools import chain
 from optparse import Option
-from typing import Optional, Tuple, List, Union, AnyStr, Dict
+from typing import Optional, Tuple, List, Union, AnyStr, Dict, Any, NamedTuple
 from xmlrpc.client import DateTime
 import pkg_resources
 import clr
 import functools
 from datetime import datetime, timedelta
 import collections
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import weakref
 import System
 
 from .util import (
 	Aggregation, AttrFlags, BaseContainer, Prediktor, Error, ItemVQT, Quality, _normalize_arguments, _normalize_input, to_pydatetime, 
-	fm_pydatetime, fm_pytimedelta, HiveAttribute, VQT, Timeseries)
+	fm_pydatetime, fm_pytimedelta, HiveAttribute, VQT, Timeseries, EnumerationCache, _import_optional)
 
 from .hiveservices import HiveInstance
 from .semantic_service import SemanticService
@@ -28,20 +31,33 @@ class Hive:
 	each module of the instance.
 
 	A Hive instance is indexable by module name.
+
+	The modules are enumerated once and kept in a registry, which is rebuilt when
+	modules are added or deleted through this client. Changes made by other clients
+	are picked up by `refresh_modules()`, or periodically if `module_revalidate` is given.
 	"""
 
 
-	def __init__(self, instance=None, host_name=None):
+	def __init__(self, instance=None, host_name=None, module_revalidate:Optional[float]=None):
 		"""Connect to a hive instance, starting the instance if needed.
 
 		Arguments:
 		instance_name: optional name of the instance (default is None, i.e. the "ApisHive" instance)
 		host_name: optional name of the server hostting the instance (default is None, i.e. "localhost")
+		module_revalidate: optional interval in seconds for checking the module registry against the server
 		"""
 		instance_name = instance.prog_id if hasattr(instance, 'prog_id') else instance
 
 		self.api = Prediktor.APIS.Hive.Hive.CreateServer(instance_name, host_name)
 		self._modtypes = { str(obj):obj for obj in self.api.ModuleTypes }
+		self._registry = _ModuleRegistry(self, module_revalidate)
+		self._items = weakref.WeakValueDictionary()
+		self._enumerations = EnumerationCache()
+		self._item_index = None
+		self._endpoint_list = None
+		self._virtual_tags = None
+		self.history_cache = None
+		self.value_cache = None
 
 	def __str__(self):
 		return self.name
@@ -50,7 +66,7 @@ class Hive:
 		return f"<Apis.Hive instance: {self}>"
 
 	def __len__(self):
-		return len(self.api.GetModules())
+		return len(self._registry.modules)
 
 	def __getitem__(self, key):
 		return self.get_module(key)
@@ -80,7 +96,42 @@ class Hive:
 	@property
 	def modules(self):
 		"""Return a list containing all the modules in this hive instance"""
-		return [ Module(self, obj) for obj in self.api.GetModules() ]
+		return list(self._registry.modules)
+
+	def refresh_modules(self):
+		"""Re-enumerate the modules and re-read enumerated attribute definitions on the
+		next access, i.e. after the configuration is changed by another client"""
+		self._registry.invalidate()
+
+	def enable_history_cache(self, directory:Optional[str]=None, **kw):
+		"""
+		Serve `Item.read_raw`, `Item.read_agg` and `read_frame` through an in-process `cache.HistoryCache`,
+		or a persistent `diskcache.DiskHistoryCache` if a `directory` is given. The keyword arguments are
+		passed to the cache. Requires numpy.
+
+		Cached raw reads don't include the bounding values before and after the period. See `cache`
+		for how recent data is kept fresh.
+		"""
+		if directory is not None:
+			from .diskcache import DiskHistoryCache
+			self.history_cache = DiskHistoryCache(directory, **kw)
+		else:
+			from .cache import HistoryCache
+			self.history_cache = HistoryCache(**kw)
+		return self.history_cache
+
+	def enable_value_cache(self, ttl:float=1.0):
+		"""
+		Serve `get_values` through a `valuecache.ValueCache`, shared by all threads using this Hive.
+		Values are kept for `ttl` seconds, and concurrent calls for overlapping items join one
+		batched read of the union. Calls with `since` bypass the cache. Items the hive returns no
+		value for are returned with quality bad | noData. Writes through this Hive (`set_values`,
+		`write_frame` and its writers) remove the cached values of the written items. See
+		`value_cache.stats` for the hit, miss and coalesced counters.
+		"""
+		from .valuecache import ValueCache
+		self.value_cache = ValueCache(ttl)
+		return self.value_cache
 
 	def get_eventserver(self):
 		return EventServer(self, self.api.GetEventServer())
@@ -88,26 +139,28 @@ class Hive:
 	def get_eventbroker(self):
 		return EventBroker(self)
 
-	def get_endpoints(self):
-		return EndpointList(self, self.api.GetEndpointsConfig())
+	def get_endpoints(self, refresh:bool=False):
+		"""Return the EndpointList. The list is kept, so endpoint data is only read once.
+		Set `refresh` to re-read the endpoints"""
+		if self._endpoint_list is None:
+			self._endpoint_list = EndpointList(self, self.api.GetEndpointsConfig())
+		elif refresh:
+			self._endpoint_list.refresh()
+		return self._endpoint_list
 
 	def get_module(self, key):
 		"""Return the module with the specified name or index"""
 		if isinstance(key, Module):
 			return key
 
-		modules = self.api.GetModules()
-
 		if isinstance(key, int):
-			return Module(self, modules[key])
+			return self._registry.modules[key]
 
 		if isinstance(key, str):
-			search_key = _normalize_input(key)
-			for mod in modules:
-				if _normalize_input(mod.Name) == search_key:
-					return Module(self, mod)
-
-			raise Error(f"Invalid module name: '{key}'")
+			try:
+				return self._registry.modules[self._registry.index(key)]
+			except KeyError:
+				raise Error(f"Invalid module name: '{key}'")
 		raise Error(f"Invalid index type: {type(key).__name__}")
 
 
@@ -132,10 +185,48 @@ class Hive:
 
 	def get_items(self, *itemids:List[str])->List["Item"]:
 		"""
-		Get a list of items from item-id's
+		Get a list of items from item-id's. Raises Error for virtual item-id's, see `add_virtual_tag`
 		"""
+		if self._virtual_tags:
+			virtual = [i for i in itemids if i in self._virtual_tags]
+			if virtual:
+				raise Error(f"Virtual tag(s) {', '.join(virtual)} are not items in the hive. Read them with get_values or read_frame")
 		items = self.api.LookupItems(list(itemids))
-		return [Item(Module(self, it.Module), it) for it in items]
+		return [self._item(self._module_of(it.Module), it) for it in items]
+
+	def _module_of(self, raw_mod):
+		"""Internal. Return the registry's Module for the raw module `raw_mod`. The registry is
+		rebuilt once if the module is not found (i.e. added by another client), and if it is still
+		missing, `raw_mod` is wrapped directly"""
+		for attempt in range(2):
+			try:
+				return self._registry.modules[self._registry.index(raw_mod.Name)]
+			except KeyError:
+				if attempt == 0:
+					self._registry.invalidate()
+		return Module(self, raw_mod)
+
+	def _item(self, module, api):
+		"""Internal. Return the Item wrapper for the raw item `api`. Wrappers are interned
+		by item-id, so the same Item object is returned while it is referenced. An existing
+		wrapper is updated to the latest raw item. Raw items without a handle are looked up
+		by name in the module"""
+		item_id = api.ItemID
+		item = self._items.get(item_id)
+		if item is not None:
+			if api.Handle != -1 and item.api is not api:
+				item.api = api
+				item._type_key = None
+			return item
+		if api.Handle == -1:
+			return module.get_item(api.Name)
+		item = self._items[item_id] = Item(module, api)
+		return item
+
+	def _forget_items(self, module):
+		"""Internal. Drop the interned Item wrappers of a module"""
+		for item_id in [k for k, item in self._items.items() if item.module is module]:
+			self._items.pop(item_id, None)
 
 
 	@property
@@ -174,40 +265,56 @@ class Hive:
 			module_type.api.InstanceName = name
 
 		raw_mod = self.api.AddModule(module_type.api)
-		mod = Module(self, raw_mod)
+		self._registry.invalidate()
+		mod = self._module_of(raw_mod)
 		mod.set_properties(properties, **kw)
 		mod.api.ApplyCurrentRunningState()
 		return mod
 
 	def find_module_index(self, mod_name):
-		if isinstance(mod_name, Module):
-			search_name = _normalize_input(mod_name.name)
-		else:
-			search_name = _normalize_input(mod_name)
-
-		for i, mod in enumerate(self.modules):
-			if _normalize_input(mod.name) == search_name:
-				return i
-
-		raise Error(f"Module not found: {mod_name}")
+		try:
+			return self._registry.index(mod_name.name if isinstance(mod_name, Module) else mod_name)
+		except KeyError:
+			raise Error(f"Module not found: {mod_name}")
 
 	# def get_module(self, key):
 	# 	if isinstance(key, str):
 	# 		key = self.find_module_index(key)
 	# 	return self.modules[key]
 
-	def get_values(self, items, since=None)->List[ItemVQT]:
+	def get_values(self, items, since=None, quality_policy:str='all')->List[ItemVQT]:
 		"""
 		Get a list of value-quality-itmestamps from the connected hive
 
 		Arguments:
 		items: A list of Item objects of itemId's as stings
 		since (Optional): the oldest time of the values to retrieve
+		quality_policy (Optional): 'good' or 'usable' to leave out values with bad quality, see
+		                           `quality.mask`. Requires numpy. Default: 'all'
 		"""
+		itemIds = [i.item_id if isinstance(i, Item) else str(i) for i in items]
+		if self._virtual_tags and any(i in self._virtual_tags for i in itemIds):
+			result = self._virtual_tags.get_values(self, itemIds, since)
+		else:
+			result = self._read_values(itemIds, since)
+
+		if quality_policy != 'all':
+			from .quality import mask
+			keep = mask([int(r.quality) for r in result], quality_policy, [r.value for r in result] if quality_policy == 'usable' else None)
+			return [r for r, k in zip(result, keep) if k]
+		return result
+
+	def _read_values(self, itemIds:List[str], since)->List[ItemVQT]:
+		"""Internal. Read the current values of real items, through the value cache if enabled"""
+		if self.value_cache is not None and not since:
+			return self.value_cache.get(itemIds, lambda ids: self._read_items(ids, since))
+		return self._read_items(itemIds, since)
+
+	def _read_items(self, itemIds:List[str], since)->List[ItemVQT]:
+		"""Internal. Read current values with one ReadItems call"""
 		if not since:
 			since = System.DateTime.MinValue
 
-		itemIds = [i.item_id if isinstance(i, Item) else str(i) for i in items]
 		handles = self.api.LookupItemHandles(itemIds)
 
 		#argument placeholders
@@ -231,34 +338,347 @@ class Hive:
 		Set several values or value/quality/timestamps to items.
 
 		Arguments:
-		values: Dict of item-id keys and values. Values can either be single object values or tuples representing a VQT
-		        If a single value is used or andy of the quality/timestamps are None, the arguments given in timestamp 
-				or quality is used as a substitute.
-		def_time: the common timestamp to use if the timestamp is not supplied for each item.
-		quality: 
+		set_vals: List of ItemVQT's to write. See `ItemVQT.from_dict` to create the list from a dict of item-id keys and values.
+
+		For many small writes, consider buffering them in a `writer.HiveWriter` (see `Hive.writer()`).
 		"""
 
 		handles = self.api.LookupItemHandles([v.item_id for v in set_vals])
-		h_in = System.Array[System.Int32](handles)
-		v_in = System.Array[System.Object]([v.value for v in set_vals])
-		q_in = System.Array[System.UInt16]([v.quality for v in set_vals])
 		t_in = System.Array[System.DateTime]([fm_pydatetime(v.time) for v in set_vals])
+		failed = self._write_items([v.item_id for v in set_vals], handles, [v.value for v in set_vals], [v.quality for v in set_vals], t_in)
+
+		if failed:
+			errors = [f"Tag:{set_vals[i].item_id}, error ({err})" for i, err in failed]
+			raise Error(f"Error(s) during set_values: {'/'.join(errors)}")
+
+	def writer(self, **kw):
+		"""
+		Return a `writer.HiveWriter`, a write-behind buffer that coalesces values per item
+		and writes them in large batches from a background thread. The keyword arguments
+		are passed to the HiveWriter.
+		"""
+		from .writer import HiveWriter
+		return HiveWriter(self, **kw)
+
+	def publish_values(self, items, name:Optional[str]=None, interval:float=1.0):
+		"""
+		Start a `sharedvalues.ValuePublisher`, polling `items` every `interval` seconds into a
+		shared memory block other local processes can read with `sharedvalues.ValueTable(name)`.
+		Call `close()` on the publisher to stop it and remove the block. Requires numpy.
+		"""
+		from .sharedvalues import ValuePublisher
+		publisher = ValuePublisher(self, items, name, interval)
+		publisher.start()
+		return publisher
+
+	def _write_items(self, item_ids, handles, values, qualities, times):
+		"""Internal. Write one batch of values through WriteItemsEx. The `times`
+		argument must be a .NET DateTime array. Returns a list of (index, error code)
+		tuples for the entries that failed. The cached current values of `item_ids`,
+		the item-id's of the handles, are removed even if the write fails.
+		"""
+		h_in = System.Array[System.Int32](handles)
+		v_in = System.Array[System.Object](values)
+		q_in = System.Array[System.UInt16](qualities)
 		err_out =  System.Array[System.Int32]([])
 		check_out = System.Boolean(False)
 
-		self.api.WriteItemsEx(h_in, v_in, q_in, t_in, check_out, err_out)
+		try:
+			void, check, err = self.api.WriteItemsEx(h_in, v_in, q_in, times, check_out, err_out)
+		finally:
+			if self.value_cache is not None:
+				self.value_cache.invalidate(item_ids)
+		if not check:
+			return []
+		return [(i, e) for i, e in enumerate(err) if e != 0]
+
+	def read_frame(self, items, start:Optional[datetime]=None, end:Optional[datetime]=None, maxpoints:int=1000, quality:bool=False):
+		"""
+		Read raw history for several items into a wide pandas DataFrame indexed by timestamp,
+		with one column per item. The frame is built directly from the arrays returned by
+		the hive. Requires pandas.
+
+		Arguments:
+		items: A list of Item objects or itemId's as strings
+		start: The start of the period. Default: two hours ago (UTC)
+		end: The end of the period. Default: now (UTC)
+		maxpoints: The maximum number of samples to read for each item
+		quality: If True, the columns are a MultiIndex with a 'value' and a 'quality' column for each item
+		"""
+		from . import arrays
+		series = list(self._read_raw_arrays(items, start, end, maxpoints))
+		return arrays.to_frame(series, quality)
+
+	def _read_raw_arrays(self, items, start, end, maxpoints):
+		"""Internal. Generator reading raw history for several items as ArrayTimeseries"""
+		from .arrays import ArrayTimeseries
+		start, end = _default_range(start, end)
+		if self._virtual_tags and any(isinstance(i, str) and i in self._virtual_tags for i in items):
+			yield from self._virtual_tags.read_raw_arrays(self, items, start, end, maxpoints)
+			return
+		if self.history_cache is not None:
+			ids = [i for i in items if not isinstance(i, Item)]
+			looked_up = iter(self.get_items(*ids) if ids else [])
+			for item in items:
+				item = item if isinstance(item, Item) else next(looked_up)
+				yield self.history_cache.read_raw(item, start, end, maxpoints)
+			return
+
+		itemIds = [i.item_id if isinstance(i, Item) else str(i) for i in items]
+		handles = self.api.LookupItemHandles(itemIds)
+		tsapi = self.api.GetTimeseriesAccess()
+		for item_id, hndl in zip(itemIds, handles):
+			if not tsapi.IsItemLogged(hndl):
+				raise Error(f"Item {item_id} is not logged")
+			raw_ts = tsapi.ReadHistoryRaw(hndl, fm_pydatetime(start), fm_pydatetime(end), maxpoints, True)
+			yield ArrayTimeseries.from_hive_TS(item_id, raw_ts)
+
+	def write_frame(self, frame, quality=None, batch_size:int=10000):
+		"""
+		Write a wide, timestamp-indexed pandas DataFrame to the hive, one column (item) at a time
+		in batches of `batch_size` samples. Missing (NaN) cells are skipped. Requires pandas.
+
+		Arguments:
+		frame: DataFrame with item-id's as columns, or a MultiIndex of (item_id, 'value'|'quality') as
+		       produced by `read_frame(..., quality=True)`
+		quality: Optional string, int or Quality object. The quality to write when the frame has no
+		         quality columns. Default: 192 (good)
+		batch_size: The maximum number of samples in each call to the hive
+		"""
+		from . import arrays
+		series = arrays.from_frame(frame, quality)
+		handles = self.api.LookupItemHandles([s.item_id for s in series])
+
+		errors = []
+		for s, hndl in zip(series, handles):
+			for i in range(0, s.size, batch_size):
+				chunk = slice(i, i + batch_size)
+				values = s.value[chunk].tolist()
+				failed = self._write_items([s.item_id], [hndl]*len(values), values, s.quality[chunk].tolist(), arrays.numpy_times_to_net(s.time[chunk]))
+				errors.extend(f"Tag:{s.item_id}@{s.time[i+idx]}, error ({err})" for idx, err in failed)
+		if errors:
+			raise Error(f"Error(s) during write_frame: {'/'.join(errors)}")
+
+	@property
+	def virtual_tags(self):
+		"The virtual tags of this hive, see `add_virtual_tag`. Created on first use"
+		if self._virtual_tags is None:
+			from .virtual import VirtualTags
+			self._virtual_tags = VirtualTags()
+		return self._virtual_tags
+
+	def add_virtual_tag(self, item_id:str, expression:str):
+		"""
+		Register a virtual tag: a formula over other items, evaluated client-side. The
+		virtual item-id can be read like a real item-id with `get_values` and `read_frame`
+		of this Hive. It is not an item in the hive, so it can't be looked up with `get_items`
+		or in modules, queried or written. See `virtual` for reading it through a cluster.
+		The formula is compiled once and evaluated with numpy over the whole batch or
+		history read, and the quality is the worst quality of the inputs. Requires numpy.
+
+		Arguments:
+		item_id: The item-id of the virtual tag
+		expression: The formula, with item-id's in braces. See `virtual.VirtualTag`
+
+		>>> hive.add_virtual_tag('Calc.Power', '{Pump.Flow} * {Pump.Head} * 9.81')
+		"""
+		return self.virtual_tags.add(item_id, expression)
+
+	def remove_virtual_tag(self, item_id:str):
+		"""Remove a virtual tag"""
+		self.virtual_tags.remove(item_id)
+
+	@property
+	def item_index(self):
+		"The local item index used by `query_items`. Created on first use"
+		if self._item_index is None:
+			from .query import ItemIndex
+			self._item_index = ItemIndex(self)
+		return self._item_index
+
+	def query_items(self, pattern:str='*', where:Optional[dict]=None, **kw)->List["Item"]:
+		"""
+		Find items by item-id pattern and attribute values, using a local index of the hive.
+		The index is updated when modules, items or attributes are changed through this client.
+		Use `item_index.refresh()` after changes made by other clients. Attribute values are
+		cached for `item_index.max_age` seconds. Patterns with a literal start or end are answered
+		from sorted indexes, while patterns like '*Flow*' test every item-id.
+
+		Arguments:
+		pattern: A case insensitive glob pattern for the item-id's, i.e. '*.FlowRate' or 'Worker.Signal?'
+		where: Optional dict of attribute name: value or predicate function. Enumerated attributes
+		       are compared by name. Keyword arguments are added to `where`
+
+		>>> hive.query_items('*.FlowRate', Logger=True)
+		>>> hive.query_items('Worker.*', Amplitude=lambda v: v is not None and v > 10)
+		"""
+		return self.item_index.query(pattern, _normalize_arguments(where, kw))
+
+	def read_attributes(self, names:List[str], modules=None, frame:bool=False):
+		"""
+		Read attributes from all items in several modules as one table. See `Module.read_attributes`.
+
+		Arguments:
+		names: The attribute names (columns)
+		modules: Optional list of Module objects or module names. Default: all modules
+		frame: If True, return a pandas DataFrame indexed by item-id
+		"""
+		modules = self.modules if modules is None else [self.get_module(m) for m in modules]
+		items = [item for mod in modules for item in mod.items]
+		return _attribute_table(items, names, frame)
 
-		if err_out:
-			errors = []
-			for (id, chk) in zip(set_vals.keys(), check_out):
-				if chk>0:
-					errors.append(f"Tag:{id}, error ({chk})")
-			raise ArgumentError(f"Error(s) during set_values: {'/'.join(errors)}")
-				
 	@property
 	def semantics_service(self):
 		return SemanticService(self)
 
+class _ModuleRegistry:
+	"""Internal. The modules of a hive, with indexes by name and position. The registry
+	is rebuilt on first access after `invalidate()`, which bumps the generation."""
+
+	def __init__(self, hive, revalidate:Optional[float]=None):
+		self.hive = hive
+		self.revalidate = revalidate
+		self.generation = 0
+		self._built = -1
+		self._validated = 0.0
+		self._modules = []
+		self._by_name = {}
+		self._lock = threading.RLock()
+
+	def invalidate(self):
+		with self._lock:
+			self.generation += 1
+
+	def _check(self):
+		"Rebuild if invalidated, or if the periodic revalidation finds that the modules have changed"
+		if self._built == self.generation and self.revalidate is not None and time.monotonic() - self._validated > self.revalidate:
+			self._validated = time.monotonic()
+			if [mod.Name for mod in self.hive.api.GetModules()] != [mod.name for mod in self._modules]:
+				self.invalidate()
+
+		if self._built != self.generation:
+			with self._lock:
+				generation = self.generation
+				# Reuse the existing wrappers, so the same Module object is returned for the same module
+				existing = {_normalize_input(mod.name):mod for mod in self._modules}
+				modules = [self._wrap(existing, obj) for obj in self.hive.api.GetModules()]
+				self._by_name = {_normalize_input(mod.name):i for i, mod in reversed(list(enumerate(modules)))}
+				self._modules = modules
+				self._built = generation
+				self._validated = time.monotonic()
+
+	def _wrap(self, existing, obj):
+		mod = existing.get(_normalize_input(obj.Name))
+		if mod is None:
+			return Module(self.hive, obj)
+		object.__setattr__(mod, 'api', obj)
+		return mod
+
+	@property
+	def modules(self) -> List["Module"]:
+		self._check()
+		return self._modules
+
+	def index(self, name:str) -> int:
+		"Return the position of the module `name`. Raises KeyError if not found"
+		self._check()
+		return self._by_name[_normalize_input(name)]
+
+
+def _default_range(start:Optional[datetime], end:Optional[datetime])->Tuple[datetime, datetime]:
+	"""Internal function. Return the history period to read, defaulting to the last two hours (UTC)"""
+	if start is None:
+		start = datetime.utcnow() - timedelta(hours=2)
+
+	if end is None:
+		end = datetime.utcnow()
+
+	return start, end
+
+def _attribute_table(items:List["Item"], names:List[str], frame:bool):
+	"""
+	Internal. Read the attributes `names` of `items` into a dict of columns, or a DataFrame.
+	Each item's attribute collection is enumerated once, and enumerated and DateTime values
+	are translated per column.
+	"""
+	keys = [_normalize_input(n, True) for n in names]
+	columns = {n: [None]*len(items) for n in names}
+	enumerated = {n: {} for n in names}		# column -> {row: (type key, raw attr)}
+	for row, item in enumerate(items):
+		wanted = dict(zip(keys, names))
+		for raw_attr in item.api.GetAttributes():
+			name = wanted.pop(_normalize_input(raw_attr.Name, True), None)
+			if name is None:
+				continue
+			columns[name][row] = raw_attr.Value
+			if raw_attr.Flag & AttrFlags.Enumerated:
+				enumerated[name][row] = (item.type_key, raw_attr)
+			if not wanted:
+				break
+
+	if items:
+		hive = items[0].module.hive
+		generation = hive._registry.generation
+		for name, col in columns.items():
+			for row, (type_key, raw_attr) in enumerated[name].items():
+				enum_map = hive._enumerations.get((type_key, raw_attr.Name), raw_attr, generation)
+				col[row] = enum_map.names.get(col[row], col[row])
+			if any(isinstance(v, System.DateTime) for v in col):
+				columns[name] = [to_pydatetime(v) if isinstance(v, System.DateTime) else v for v in col]
+
+	item_ids = [item.item_id for item in items]
+	if frame:
+		pd = _import_optional('pandas', 'DataFrame support')
+		return pd.DataFrame(columns, index=pd.Index(item_ids, name='item_id'), columns=names)
+	return dict(item_id=item_ids, **columns)
+
+
+class AttributeChange(NamedTuple):
+	"""A changed attribute value from `Module.write_attributes`"""
+	item_id: str
+	name: str
+	old: Any
+	new: Any
+
+
+class AttributeWriteError(NamedTuple):
+	"""An attribute value that could not be written by `Module.write_attributes`"""
+	item_id: str
+	name: str
+	value: Any
+	error: Exception
+
+
+class AttributeWriteResult(NamedTuple):
+	changes: List[AttributeChange]
+	errors: List[AttributeWriteError]
+
+
+def _prepare_attribute(item:"Item", raw_attr, value):
+	"""
+	Internal. Validate and convert `value` for the raw attribute of `item` without writing it.
+	Returns (old value, new value, new raw value), or raises Error if the value can't be written.
+	"""
+	flag = raw_attr.Flag
+	if flag & AttrFlags.ReadOnly:
+		raise Error(f"Attribute {raw_attr.Name} is read only")
+	old = raw_attr.Value
+	if flag & AttrFlags.Enumerated:
+		hive = item.module.hive
+		enum_map = hive._enumerations.get((item.type_key, raw_attr.Name), raw_attr, hive._registry.generation)
+		try:
+			new_raw = enum_map.values[str(value).lower()]
+		except KeyError:
+			raise Error(f"Enumerated property for {value} not found on attribute {raw_attr.Name}.")
+		return enum_map.names.get(old, old), enum_map.names[new_raw], new_raw
+	if isinstance(old, System.DateTime):
+		if isinstance(value, str):
+			value = datetime.fromisoformat(value)
+		new_raw = fm_pydatetime(value)
+		return to_pydatetime(old), to_pydatetime(new_raw), new_raw
+	return old, value, value
+
+
 class ModuleType:
 	"""
 	The class wraps an Apis module-type
@@ -277,9 +697,12 @@ class Module(BaseContainer):
 	Module is a wrapper around Prediktor.APIS.HiveWrapper.Module, which can
 	be accessed through the 'Module.api' member.
 	"""
+	__slots__ = 'hive', 'api', '_properties'
+
 	def __init__(self, hive, api):
 		super().__setattr__('hive', hive)
 		super().__setattr__('api', api)
+		super().__setattr__('_properties', {})
 
 	def __str__(self):
 		return self.name
@@ -294,7 +717,10 @@ class Module(BaseContainer):
 		return self.get_item(key)
 
 	def __delitem__(self, key):
-		self.get_item(key).api.DeleteItem()
+		item = self.get_item(key)
+		item.api.DeleteItem()
+		self.hive._items.pop(item.item_id, None)
+		self._forget_index()
 
 	def __iter__(self):
 		return self.api.GetItems()
@@ -303,6 +729,8 @@ class Module(BaseContainer):
 		return self.get_property(key).value
 
 	def __setattr__(self, key, value):
+		if key in Module.__slots__:
+			return super().__setattr__(key, value)
 		try:
 			prop = self.get_property(key)
 			prop.value = value
@@ -315,7 +743,7 @@ class Module(BaseContainer):
 		for raw_prop in self.api.GetProperties():
 			prop_name = _normalize_input(raw_prop.Name, True)
 			if prop_name in new_val:
-				prop = Property(self, raw_prop)
+				prop = self._property(raw_prop)
 				prop.value = new_val[prop_name]
 
 	@property
@@ -325,7 +753,7 @@ class Module(BaseContainer):
 	@property
 	def items(self):
 		"""Return a list containing all the items in this module"""
-		return [ Item(self, obj) for obj in list(self.api.GetItems()) ]
+		return [ self.hive._item(self, obj) for obj in list(self.api.GetItems()) ]
 
 	def get_item(self, key):
 		"""Return the item with the specified name or index"""
@@ -333,17 +761,117 @@ class Module(BaseContainer):
 			return key
 
 		if isinstance(key, int):
-			return Item(self, self.api.GetItems()[key])
+			return self.hive._item(self, self.api.GetItems()[key])
 
 		if isinstance(key, str):
 			search_key = _normalize_input(key)
 			for obj in self.api.GetItems():
 				if _normalize_input(obj.Name, True) == key:
-					return Item(self, obj)
+					return self.hive._item(self, obj)
 			raise Error(f"Invalid item name: '{key}'")
 
 		raise Error(f"Invalid index type: {type(key).__name__}")
 
+	def read_attributes(self, names:List[str], items=None, frame:bool=False):
+		"""
+		Read several attributes from many items as a table with one row per item. Each
+		item's attributes are enumerated once, and enumerated values are translated through
+		the cached enumeration maps. Missing attributes are None, and enumerated values without
+		a name are returned untranslated.
+
+		Arguments:
+		names: The attribute names (columns)
+		items: Optional list of Item objects, item names or indexes. Default: all items in the module
+		frame: If True, return a pandas DataFrame indexed by item-id. Requires pandas
+
+		Returns:
+		A dict of columns {'item_id': [...], name: [...], ...}, or a DataFrame
+		"""
+		items = self.items if items is None else [self.get_item(i) for i in items]
+		return _attribute_table(items, names, frame)
+
+	def write_attributes(self, table, dry_run:bool=False, workers:int=4) -> AttributeWriteResult:
+		"""
+		Write attributes on many items. All values are validated against the attribute
+		definitions (read only, enumerations) before anything is written, and unchanged
+		values are skipped. The changed attributes of each item are written with one
+		SetAttributes call, and the items are written by parallel workers.
+
+		Arguments:
+		table: A dict of item: {attribute name: value}, where the item is an Item object, an item name
+		       or an item-id. Or a pandas DataFrame with items as index and attributes as columns,
+		       where missing (NaN) cells are skipped
+		dry_run: If True, nothing is written and the changes are only returned
+		workers: The number of parallel workers
+
+		Returns:
+		An AttributeWriteResult with the changed (or, on dry run, to be changed) values, and an
+		AttributeWriteError for each value that couldn't be validated or written
+		"""
+		if hasattr(table, 'iterrows'):
+			pd = _import_optional('pandas', 'DataFrame support')
+			table = {idx: {k: v for k, v in row.items() if not pd.isna(v)} for idx, row in table.iterrows()}
+
+		raw_items = list(self.api.GetItems())
+		by_name = {_normalize_input(obj.Name): obj for obj in raw_items}
+		by_id = {obj.ItemID: obj for obj in raw_items}
+		rows = []
+		errors = []
+		for key, values in table.items():
+			if isinstance(key, Item):
+				rows.append((key, values))
+				continue
+			obj = by_id.get(key) or by_name.get(_normalize_input(str(key)))
+			if obj is None:
+				errors.extend(AttributeWriteError(str(key), name, value, Error(f"Invalid item name: '{key}'")) for name, value in values.items())
+			else:
+				rows.append((self.hive._item(self, obj), values))
+
+		def prepare(item, values):
+			changes, failed, changed = [], [], []
+			wanted = {_normalize_input(name, True): (name, value) for name, value in values.items()}
+			for raw_attr in item.api.GetAttributes():
+				cell = wanted.pop(_normalize_input(raw_attr.Name, True), None)
+				if cell is None:
+					continue
+				name, value = cell
+				try:
+					old, new, new_raw = _prepare_attribute(item, raw_attr, value)
+				except Exception as e:
+					failed.append(AttributeWriteError(item.item_id, name, value, e))
+					continue
+				if old != new:
+					changes.append(AttributeChange(item.item_id, raw_attr.Name, old, new))
+					changed.append((raw_attr, new_raw))
+			failed.extend(AttributeWriteError(item.item_id, name, value, Error(f"Invalid item attribute: {repr(name)}")) for name, value in wanted.values())
+			return item, changes, failed, changed
+
+		def apply(item, changes, changed):
+			try:
+				for raw_attr, new_raw in changed:
+					raw_attr.Value = new_raw
+				attr_array = System.Array[Prediktor.APIS.Hive.IAttribute]([raw_attr for raw_attr, _ in changed])
+				item.api.SetAttributes(attr_array)
+				return changes, []
+			except Exception as e:
+				return [], [AttributeWriteError(c.item_id, c.name, c.new, e) for c in changes]
+
+		changes = []
+		if not dry_run:
+			self._forget_index()
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			prepared = list(pool.map(lambda row: prepare(*row), rows))
+			for _, item_changes, item_errors, _ in prepared:
+				errors.extend(item_errors)
+				if dry_run:
+					changes.extend(item_changes)
+			if not dry_run:
+				pending = [(item, c, changed) for item, c, _, changed in prepared if changed]
+				for item_changes, item_errors in pool.map(lambda row: apply(*row), pending):
+					changes.extend(item_changes)
+					errors.extend(item_errors)
+		return AttributeWriteResult(changes, errors)
+
 	@property
 	def item_types(self):
 		"""Return the available item types for this  module"""
@@ -358,12 +886,13 @@ class Module(BaseContainer):
 
 	def _add_items(self, template):
 		raw_items, item_error, attr_error, check = self.api.AddItems(template, None, None, None)
+		self._forget_index()
 		if check:
 			for i, a_e in enumerate(attr_error):
 				if a_e > 0:
 					t_attr = template.Attributes[i]
 					raise Error(f"Error setting {t_attr.Name}")
-		return [Item(self, it) for it in raw_items]
+		return [self.hive._item(self, it) for it in raw_items]
 
 	def add_item(self, item_type, item_name:str, attrs: dict = None, **kw):
 		"""Add a new item to the hive"""
@@ -389,6 +918,12 @@ class Module(BaseContainer):
 				item.set_attributes(attrs, **kw)
 		return items
 
+	def _forget_index(self, attribute:Optional[str]=None):
+		"""Internal. Drop the module from the hive's item index after items or attributes are changed,
+		or only the cached values of `attribute` after it is written"""
+		if self.hive._item_index is not None:
+			self.hive._item_index.invalidate(self, attribute)
+
 	def _get_property(self, name:str):
 		norm_name = _normalize_input(name)
 		for obj in self.api.GetProperties():
@@ -396,30 +931,53 @@ class Module(BaseContainer):
 				return obj
 		raise Error(f"property '{name}' not found")
 
+	def _property(self, obj):
+		"""Internal. Return the Property wrapper for the raw property `obj`. Wrappers are
+		kept per module, and refreshed with the latest raw property"""
+		prop = self._properties.get(obj.Name)
+		if prop is None:
+			prop = self._properties[obj.Name] = Property(self, obj)
+		else:
+			prop.api = obj
+		return prop
+
 	@property
 	def properties(self):
-		return [ Property(self, obj) for obj in self.api.GetProperties() ]
+		return [ self._property(obj) for obj in self.api.GetProperties() ]
 
 	def get_property(self, name:str):
-		return Property(self, self._get_property(name))
+		return self._property(self._get_property(name))
 
 	def delete(self):
-		return self.api.DeleteModule()
+		try:
+			return self.api.DeleteModule()
+		finally:
+			self.hive._forget_items(self)
+			self.hive._registry.invalidate()
 
 class Property(HiveAttribute):
+	__slots__ = 'module', 'api'
+
 	def __init__(self, module, api):
 		self.module = module
 		self.api = api
 
+	def _enumeration(self):
+		hive = self.module.hive
+		return hive._enumerations.get((self.module.name, self.name), self.api, hive._registry.generation)
+
 	def __repr__(self):
 		return f"<Apis.Hive.Module.Property: {self}>"
 
 class Item(BaseContainer):
+	__slots__ = 'module', 'api', '_type_key', '__weakref__'
+
 	def __init__(self, module, api):
 		super().__setattr__('module', module)		#due to __settattr__
 		if (api.Handle == -1):
-			api = module.get_item(api.Name).api
+			api = module.hive._item(module, api).api
 		super().__setattr__('api', api)
+		super().__setattr__('_type_key', None)
 
 	def __str__(self):
 		return self.name
@@ -440,6 +998,8 @@ class Item(BaseContainer):
 		attr.value = value
 
 	def __setattr__(self, key, value):
+		if key in Item.__slots__:
+			return super().__setattr__(key, value)
 		try:
 			attr = self.get_attr(key)
 			attr.value = value
@@ -468,6 +1028,13 @@ class Item(BaseContainer):
 		"The item-id. Unique within a hive"
 		return self.api.ItemID
 
+	@property
+	def type_key(self):
+		"(module name, item-type id). Items with the same type key share attribute definitions"
+		if self._type_key is None:
+			super().__setattr__('_type_key', (self.module.name, self.api.ItemTypeID))
+		return self._type_key
+
 	@property
 	def itemtype(self):
 		"The item-type of the item"
@@ -538,10 +1105,10 @@ class Item(BaseContainer):
 		"""
 		Get the external items from an item and return as a list of `Item`s
 		"""
-		modules = {mod.name:mod for mod in self.module.hive.modules}
+		hive = self.module.hive
 		def getitems():
 			for extitem in self.api.GetExternalItems():
-				yield Item(modules[extitem.Item.Module.Name], extitem.Item)
+				yield hive._item(hive._module_of(extitem.Item.Module), extitem.Item)
 		return list(getitems())
 
 	def set_externalitems(self, ext_items):
@@ -571,26 +1138,42 @@ class Item(BaseContainer):
 		if not tsapi.IsItemLogged(hndl):
 			raise Error(f"Item {self.name} is not logged")
 
-		if start is None:
-			start = datetime.utcnow() - timedelta(hours=2)
-
-		if end is None:
-			end = datetime.utcnow()
-
+		start, end = _default_range(start, end)
 		return func(hndl, fm_pydatetime(start), fm_pydatetime(end), *extraparam)
 
 	def read_raw(self, start:Optional[datetime]=None, end:Optional[datetime]=None, maxpoints:int=1000):
 		"""
-		Read raw samples from the history database.
+		Read raw samples from the history database. If the hive has a history cache,
+		the samples are read through the cache and bounding values are not included.
 		"""
+		cache = self.module.hive.history_cache
+		if cache is not None:
+			start, end = _default_range(start, end)
+			return cache.read_raw(self, start, end, maxpoints).to_timeseries()
+
 		tsapi = self.module.hive.api.GetTimeseriesAccess()
 		raw_ts = self._get_hist(tsapi, tsapi.ReadHistoryRaw, start, end, maxpoints, True)
 		return Timeseries.from_hive_TS(self.item_id, raw_ts)
 
+	def read_raw_arrays(self, start:Optional[datetime]=None, end:Optional[datetime]=None, maxpoints:int=1000):
+		"""
+		Read raw samples, including the bounding values, from the history database
+		as an `arrays.ArrayTimeseries`. Requires numpy.
+		"""
+		from .arrays import ArrayTimeseries
+		tsapi = self.module.hive.api.GetTimeseriesAccess()
+		raw_ts = self._get_hist(tsapi, tsapi.ReadHistoryRaw, start, end, maxpoints, True)
+		return ArrayTimeseries.from_hive_TS(self.item_id, raw_ts)
+
 	def read_agg(self, start:Optional[datetime]=None, end:Optional[datetime]=None, span:Optional[timedelta]=None, *aggregation:Optional[Aggregation]):
 		"""
 		Read aggregated data from the History database
 		"""
+		cache = self.module.hive.history_cache
+		if cache is not None:
+			start, end = _default_range(start, end)
+			return [ts.to_timeseries() for ts in cache.read_agg(self, start, end, span, *aggregation)]
+
 		wspan = fm_pytimedelta(span)
 		agg = list(map(int, aggregation))
 		tsapi = self.module.hive.api.GetTimeseriesAccess()
@@ -598,15 +1181,83 @@ class Item(BaseContainer):
 		agg_ts, err = self._get_hist(tsapi, tsapi.ReadHistoryAggregated, start, end, wspan, agg, err_out)
 		return [Timeseries.from_hive_TS(self.item_id, ts) for ts in agg_ts]
 
+	def read_raw_pages(self, start:Optional[datetime]=None, end:Optional[datetime]=None, page_size:int=10000, decoder=None):
+		"""
+		Generator reading raw samples from the history database in pages of at most
+		`page_size` samples. Each page is an `arrays.ArrayTimeseries`. Requires numpy.
+
+		If a `parallel.ParallelDecoder` is given as `decoder`, the pages are decoded in
+		its process pool while the next pages are read.
+		"""
+		from .arrays import ArrayTimeseries, _raw_pages
+		start, end = _default_range(start, end)
+		if decoder is not None:
+			yield from decoder.read_raw_pages(self, start, end, page_size)
+			return
+		tsapi = self.module.hive.api.GetTimeseriesAccess()
+
+		def read(page_start, size):
+			page = ArrayTimeseries.from_hive_TS(self.item_id, self._get_hist(tsapi, tsapi.ReadHistoryRaw, page_start, end, size, False))
+			return page.time, page.value, page.quality
+
+		for time, value, quality in _raw_pages(read, start, end, page_size):
+			yield ArrayTimeseries(self.item_id, time, value, quality)
+
+	def read_preview(self, start:Optional[datetime]=None, end:Optional[datetime]=None, target_points:int=1500, method:str='lttb', page_size:int=10000, raw_limit:Optional[int]=None):
+		"""
+		Read a downsampled preview of the history, i.e. for plotting, with at most `target_points`
+		samples keeping the peaks. Returns an `arrays.ArrayTimeseries`. Requires numpy.
+
+		Raw history is streamed page by page through a decimator ('lttb' or 'minmax', see `preview`).
+		If the first page shows that the period has more than `raw_limit` raw samples (default:
+		20 * target_points), the hive computes the minimum and maximum of each interval instead.
+		"""
+		from .preview import read_preview
+		start, end = _default_range(start, end)
+		return read_preview(self, start, end, target_points, method, page_size, raw_limit)
+
+	def read_agg_pages(self, start:Optional[datetime]=None, end:Optional[datetime]=None, span:Optional[timedelta]=None, *aggregation:Optional[Aggregation], page_size:int=10000):
+		"""
+		Generator reading aggregated data from the history database in windows of
+		`page_size` spans. Each page is a list with one `arrays.ArrayTimeseries` per aggregate.
+		Requires numpy.
+		"""
+		from .arrays import ArrayTimeseries
+		wspan = fm_pytimedelta(span)
+		agg = list(map(int, aggregation))
+		tsapi = self.module.hive.api.GetTimeseriesAccess()
+		start, end = _default_range(start, end)
+		while start < end:
+			page_end = min(start + span*page_size, end)
+			err_out =  System.Array[System.Int32]([])
+			agg_ts, err = self._get_hist(tsapi, tsapi.ReadHistoryAggregated, start, page_end, wspan, agg, err_out)
+			yield [ArrayTimeseries.from_hive_TS(self.item_id, ts) for ts in agg_ts]
+			start = page_end
+
 
 class Attr(HiveAttribute):
+	__slots__ = 'item', 'api'
+
 	def __init__(self, item, api):
 		self.item = item
 		self.api = api
 
+	def _enumeration(self):
+		if self.item is None:
+			return super()._enumeration()
+		hive = self.item.module.hive
+		return hive._enumerations.get((self.item.type_key, self.name), self.api, hive._registry.generation)
+
 	def __repr__(self):
 		return f"<Apis.Hive.Item.Attr: {self}>"
 
+	def set_value(self, value):
+		super().set_value(value)
+		if self.item is not None:
+			self.item.module._forget_index(self.name)
+
+	value = property(HiveAttribute.get_value, set_value, doc="Access the attribute value")
+
 
 class EventServer:
 	"""Class used to access the EventServer (and Chronical) in an APIS HIVE instance"""
@@ -724,56 +1375,185 @@ class EventServer:
 		self.api.QueryDone(qry.Handle)
 		return list.Detach()
 
+class EndpointChange(NamedTuple):
+	"""A changed endpoint property value from `EndpointList.diff`/`EndpointList.apply`"""
+	endpoint: str
+	name: str
+	old: Any
+	new: Any
+
+
 class EndpointList:
-	"""Class used to access the EventServer (and Chronical) in an APIS HIVE instance"""
+	"""Class used to access the OPC UA endpoints in an APIS HIVE instance.
+
+	The endpoint list is read once and the endpoint data is read on first access to each
+	endpoint. Use `refresh()` after endpoints are changed by another client.
+	Endpoints are indexable by position (like `all`) or name. Use `by_id` to look up an endpoint id."""
 	def __init__(self, hive, api):
 		self.hive = hive
 		self.api = api
+		self._infos = None
+		self._endpoints = {}
 
 	def __len__(self):
-		return len(self.all)
+		return len(self._get_infos())
+
+	def __iter__(self):
+		return (self.by_id(ep_id) for ep_id in list(self._get_infos()))
 
 	def __getitem__(self, key):
-		return all[key]
+		if isinstance(key, slice):
+			return [self.by_id(ep_id) for ep_id in list(self._get_infos())[key]]
+		if isinstance(key, int):
+			return self.by_id(list(self._get_infos())[key])
+		return self.by_name(key)
+
+	def _get_infos(self):
+		if self._infos is None:
+			self._infos = {e.Id: e for e in self.api.GetApisEndpointInfos()}
+		return self._infos
+
+	def refresh(self):
+		"Re-read the endpoint list and endpoint data on the next access"
+		self._infos = None
+		self._endpoints = {}
 
 	@property
 	def all(self):
-		return [Endpoint(self, self.api.GetEndpointData(e.Id)) for e in self.api.GetApisEndpointInfos()]
+		return list(self)
+
+	def by_id(self, ep_id):
+		"Return the endpoint with the id `ep_id`"
+		endpoint = self._endpoints.get(ep_id)
+		if endpoint is None:
+			if ep_id not in self._get_infos():
+				raise Error(f"Endpoint with id {ep_id} not found")
+			endpoint = self._endpoints[ep_id] = Endpoint(self, self.api.GetEndpointData(ep_id))
+		return endpoint
+
+	def by_name(self, name:str):
+		"Return the endpoint named `name`"
+		norm_name = _normalize_input(str(name))
+		for ep_id, info in self._get_infos().items():
+			info_name = getattr(info, 'Name', None)
+			if info_name is None:
+				info_name = self.by_id(ep_id).name
+			if info_name is not None and _normalize_input(str(info_name)) == norm_name:
+				return self.by_id(ep_id)
+		raise Error(f"Endpoint '{name}' not found")
 
 	def add(self):
 		tmp = self.api.AddEndpoint()
-		return Endpoint(self, self.api.GetEndpointData(tmp.Id))
+		self._infos = None
+		return self.by_id(tmp.Id)
+
+	def diff(self, desired:Dict) -> List[EndpointChange]:
+		"""
+		Compare the endpoints with a desired state, and return the property values that differ.
+
+		Arguments:
+		desired: A dict of endpoint (Endpoint, id, position or name): {property name: value}
+		"""
+		changes = []
+		for key, values in desired.items():
+			endpoint = key if isinstance(key, Endpoint) else self[key]
+			for name, value in values.items():
+				old = endpoint[name].Value
+				if old != value:
+					changes.append(EndpointChange(endpoint.name or str(endpoint.api.Id), name, old, value))
+		return changes
+
+	def apply(self, desired:Dict, dry_run:bool=False) -> List[EndpointChange]:
+		"""
+		Bring the endpoints to a desired state. Only the properties that differ are written, with
+		one WriteEndpointData call per endpoint. Raises Error listing the endpoints that could not
+		be written, after all the endpoints are tried.
+
+		Arguments:
+		desired: A dict of endpoint (Endpoint, id, position or name): {property name: value}
+		dry_run: If True, nothing is written and the changes are only returned
+
+		Returns:
+		The changed (or, on dry run, to be changed) property values
+		"""
+		endpoints = {}
+		for key, values in desired.items():
+			endpoint = key if isinstance(key, Endpoint) else self[key]
+			endpoints.setdefault(endpoint.api.Id, (endpoint, {}))[1].update(values)
+
+		changes, errors = [], []
+		for endpoint, values in endpoints.values():
+			ep_changes = self.diff({endpoint: values})
+			if dry_run or not ep_changes:
+				changes.extend(ep_changes)
+				continue
+			try:
+				for change in ep_changes:
+					endpoint[change.name] = change.new
+				endpoint.save()
+				changes.extend(ep_changes)
+			except Exception as e:
+				endpoint.reload()
+				errors.append(f"Endpoint:{endpoint.name}, error ({e})")
+		if errors:
+			raise Error(f"Error(s) during apply: {'/'.join(errors)}")
+		return changes
+
 
 class Endpoint:
 	def __init__(self, eplist, api):
 		self.eplist = eplist
 		self.api = api
 		self.props = {p.Name:p for p in api.Properties}
-		self.writer = Prediktor.APIS.Hive.EndpointWriter(self.api.Id)
+		self.writer = None
+
+	def __repr__(self):
+		return f"<Apis.Hive.Endpoint: {self.name}>"
 
 	def __getitem__(self, key):
-		return self.props[key]
+		try:
+			return self.props[key]
+		except KeyError:
+			raise Error(f"Endpoint property '{key}' not found")
 
 	def __setitem__(self, key, value):
 		prop = self[key]
 		prop.Value = value
+		if self.writer is None:
+			self.writer = Prediktor.APIS.Hive.EndpointWriter(self.api.Id)
 		self.writer.AddPropVal(prop.Id, prop.Value)
 
 	def __len__(self):
 		return len(self.props)
 
 	def __iter__(self):
-		return self.props()
+		return iter(self.props.values())
+
+	@property
+	def name(self):
+		"The endpoint name, from the 'Name' property. None if the endpoint has no name"
+		prop = self.props.get('Name')
+		return None if prop is None else prop.Value
 
 	@property
 	def properties(self):
 		return self.props
 
 	def get_property(self, key):
-		return self.props[key]
+		return self[key]
+
+	def reload(self):
+		"Re-read the endpoint data, discarding unsaved changes"
+		self.api = self.eplist.api.GetEndpointData(self.api.Id)
+		self.props = {p.Name:p for p in self.api.Properties}
+		self.writer = None
 
 	def save(self):
+		"Write the changed properties in one call"
+		if self.writer is None:
+			return
 		self.eplist.api.WriteEndpointData(self.writer)
+		self.writer = None
 
 class EventBroker:
 	def __init__(self, hive):
@@ -1,10 +1,13 @@
-__all__ = 'instance_identifiers', 'list_instances', 'get_instance', 'remove_instance', 'add_instance', 'HiveInstance'
+__all__ = 'instance_identifiers', 'list_instances', 'get_instance', 'remove_instance', 'add_instance', 'HiveInstance', 'start_all', 'stop_all', 'InstanceResult', 'refresh'
 
 from .util import Prediktor, Error
 import os
+import threading
 import time
 import clr
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional, Union
 from System import Action, Func
 
 InstanceService = Prediktor.APIS.Hive.HiveInstanceService
@@ -20,21 +23,57 @@ def _create_instance_service():
     pathfinder = Prediktor.APIS.Utilities.ComServerPathFinder()
     return Prediktor.APIS.Hive.HiveInstanceService(pathfinder, Func[Prediktor.APIS.Utilities.IApisInstance, bool] (isrunning))
 
-def _get_instance(service, name):
-    for inst in service.GetInstances():
-        if inst.InstanceName == name:
-            return inst
-    raise Error('Instance not found')
+
+class _InstanceCache:
+    """
+    Internal. The instance service is created once, and the instances are indexed
+    by name. The index is rebuilt after instances are added or removed, or after `refresh()`
+    """
+    def __init__(self):
+        self._service = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def service(self):
+        with self._lock:
+            if self._service is None:
+                self._service = _create_instance_service()
+            return self._service
+
+    def index(self):
+        service = self.service()
+        with self._lock:
+            if self._index is None:
+                self._index = {inst.InstanceName: inst for inst in service.GetInstances()}
+            return self._index
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+_instances = _InstanceCache()
+
+def _get_instance(name):
+    inst = _instances.index().get(name)
+    if inst is None:
+        raise Error('Instance not found')
+    return inst
 
 
+def refresh():
+    """
+    Re-read the registered instances on the next call, i.e. after instances are added
+    or removed by another client
+    """
+    _instances.invalidate()
+
 def list_instances():
     """
     Return a list of all registered hive instances
 
     Returns: List[HiveInstance]
     """
-    service = _create_instance_service()
-    return [HiveInstance(inst) for inst in service.GetInstances()]
+    return [HiveInstance(inst) for inst in _instances.index().values()]
 
 def get_instance(name):
     """
@@ -45,7 +84,7 @@ def get_instance(name):
 
     Returns: HiveInstance
     """
-    return HiveInstance(_get_instance(_create_instance_service(), name))    
+    return HiveInstance(_get_instance(name))
 
 def remove_instance(instance):
     """
@@ -54,10 +93,13 @@ def remove_instance(instance):
     Arguments:
     inst: string or HiveInstance. the instance that should be removed
     """
-    service = _create_instance_service()
+    service = _instances.service()
     instance_name = instance.name if isinstance(instance, HiveInstance) else instance
-    instance = _get_instance(service, instance_name)
-    service.RemoveInstance(instance.CLSID)
+    instance = _get_instance(instance_name)
+    try:
+        service.RemoveInstance(instance.CLSID)
+    finally:
+        _instances.invalidate()
 
 def add_instance(name, as_service=True):
     """
@@ -67,15 +109,66 @@ def add_instance(name, as_service=True):
     name: string. The name of the new service
     as_service: Optional bool. Switch that determines whether the instance is created as a service or COM-server
     """
-    service = _create_instance_service()
-    service.AddInstance(name, as_service)
+    service = _instances.service()
+    try:
+        service.AddInstance(name, as_service)
+    finally:
+        _instances.invalidate()
     return get_instance(name)
 
 
+class InstanceResult(NamedTuple):
+    """
+    The result of starting or stopping one instance with `start_all`/`stop_all`.
+    `elapsed` is the number of seconds until the instance reached the wanted state,
+    and `error` is None on success.
+    """
+    name: str
+    elapsed: Optional[float]
+    error: Optional[Exception]
+
+
+def _run_all(action: str, instances, timeout: float, workers: int) -> List[InstanceResult]:
+    if instances is None:
+        instances = list_instances()
+    instances = [inst if isinstance(inst, HiveInstance) else get_instance(inst) for inst in instances]
+
+    def run(inst):
+        try:
+            return InstanceResult(inst.name, getattr(inst, action)(timeout), None)
+        except Exception as e:
+            return InstanceResult(inst.name, None, e)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(instances)))) as pool:
+        return list(pool.map(run, instances))
+
+def start_all(instances: Optional[Iterable[Union[str, "HiveInstance"]]] = None, timeout: float = 60.0, workers: int = 8) -> List[InstanceResult]:
+    """
+    Start several instances concurrently, and wait until they are running
+
+    Arguments:
+    instances: Optional list of HiveInstance objects or instance names. Default: all registered instances
+    timeout: The maximum number of seconds to wait for each instance
+    workers: The number of instances started at the same time
+
+    Returns: A list of InstanceResult with the startup time of each instance
+    """
+    return _run_all('start', instances, timeout, workers)
+
+def stop_all(instances: Optional[Iterable[Union[str, "HiveInstance"]]] = None, timeout: float = 60.0, workers: int = 8) -> List[InstanceResult]:
+    """
+    Stop several instances concurrently, and wait until they are stopped. See `start_all`
+    """
+    return _run_all('stop', instances, timeout, workers)
+
+
 class HiveInstance:
     """
-    A class representing an installed Hive service. The service can be started or stopped from the running property. 
+    A class representing an installed Hive service. The service can be started or stopped from the running property.
     """
+    POLL_INTERVAL = 0.05        # The first wait between checks of the running state
+    MAX_POLL_INTERVAL = 1.0     # The wait is doubled for each check, up to this limit
+
     def __init__(self, api):
         self.api = api
 
@@ -85,23 +178,50 @@ class HiveInstance:
     def __repr__(self):
         return f"<Apis.Hive instance-service: {self.prog_id}>"
 
-    
+
     prog_id = property(lambda self:self.api.ProgId)
     is_default = property(lambda self:self.api.IsDefaultInstance)
     name = property(lambda self:self.api.InstanceName)
     CLSID = property(lambda self:uuid.UUID(self.api.CLSID.ToString()))
 
-    def start(self):
-        if not self.running:
-            self.api.Start()
-            while not self.running:
-                time.sleep(0.1)
-
-    def stop(self):
+    def _wait(self, running: bool, timeout: Optional[float], started: float) -> float:
+        "Wait with backoff until the running state is `running`. Returns the seconds since `started`"
+        interval = self.POLL_INTERVAL
+        while self.running != running:
+            elapsed = time.monotonic() - started
+            if timeout is not None and elapsed >= timeout:
+                state = 'start' if running else 'stop'
+                raise Error(f"Timeout waiting for instance {self.name} to {state} after {elapsed:.1f}s")
+            if timeout is not None:
+                interval = min(interval, max(timeout - elapsed, 0.0))
+            time.sleep(interval)
+            interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+        return time.monotonic() - started
+
+    def start(self, timeout: Optional[float] = 60.0) -> float:
+        """
+        Start the instance and wait until it is running. Raises Error if it is not
+        running within `timeout` seconds (None waits forever).
+
+        Returns: The startup time in seconds (0 if the instance was running)
+        """
         if self.running:
-            self.api.Stop()
-            while self.running:
-                time.sleep(0.1)
+            return 0.0
+        started = time.monotonic()
+        self.api.Start()
+        return self._wait(True, timeout, started)
+
+    def stop(self, timeout: Optional[float] = 60.0) -> float:
+        """
+        Stop the instance and wait until it is stopped. See `start`
+
+        Returns: The shutdown time in seconds (0 if the instance was stopped)
+        """
+        if not self.running:
+            return 0.0
+        started = time.monotonic()
+        self.api.Stop()
+        return self._wait(False, timeout, started)
 
     def _running(self):
         return self.api.IsRunning
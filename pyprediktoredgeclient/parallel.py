@@ -0,0 +1,215 @@
+"""
+Decoding and aggregation of large history results in a process pool.
+
+The .NET result arrays can only be read in the process that owns the hive
+connection, so the parent process copies each raw page out as flat buffers
+(.NET ticks as int64, values as float64 and qualities as uint32) into a block
+of `multiprocessing.shared_memory`. The worker processes decode, quality-filter
+and aggregate the buffers, and hand the result back in a new shared memory
+block. Only the small block descriptors are pickled.
+
+The copying is done in bulk by the .NET runtime where possible, see
+`arrays.net_to_numpy` and `arrays.net_ticks`. Timestamps are copied element by
+element, holding the GIL, where DateTime[] can't be pinned (.NET Framework),
+and so are values that are not all doubles. That part of the work stays in the
+parent process and limits the speedup of the pool.
+
+Pages with non-numeric values (strings, arrays) can't be shared as flat buffers,
+and are decoded in the parent process.
+
+Requires numpy.
+"""
+__all__ = 'ParallelDecoder',
+
+import collections
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import shared_memory
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from . import arrays
+from . import quality as _quality
+from .arrays import ArrayTimeseries, EPOCH_TICKS, QUALITY_DTYPE, TICKS_PER_US, TIME_DTYPE
+from .util import Aggregation, Error, _import_optional
+
+np = _import_optional('numpy', 'parallel decoding')
+
+class _Block(NamedTuple):
+    "A picklable descriptor of arrays stored back to back in a shared memory block"
+    name: str
+    layout: List[Tuple[str, int, int]]      # (dtype, length, offset) per array
+
+
+def _share(parts: Sequence['np.ndarray']) -> Tuple[shared_memory.SharedMemory, _Block]:
+    "Copy arrays into a new shared memory block"
+    layout, offset = [], 0
+    for a in parts:
+        offset = -(-offset // 8) * 8        # 8 byte alignment
+        layout.append((a.dtype.str, len(a), offset))
+        offset += a.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for a, (dtype, n, off) in zip(parts, layout):
+        np.ndarray(n, dtype=dtype, buffer=shm.buf, offset=off)[:] = a
+    return shm, _Block(shm.name, layout)
+
+
+def _views(shm: shared_memory.SharedMemory, block: _Block) -> List['np.ndarray']:
+    return [np.ndarray(n, dtype=dtype, buffer=shm.buf, offset=off) for dtype, n, off in block.layout]
+
+
+def _receive(block: _Block) -> List['np.ndarray']:
+    "Copy the arrays out of a block returned by a worker, and release the block"
+    shm = shared_memory.SharedMemory(name=block.name)
+    try:
+        return [v.copy() for v in _views(shm, block)]
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _decode(ticks, values, quality, policy: str) -> ArrayTimeseries:
+    if policy != 'all':
+        keep = _quality.mask(quality, policy, values)
+        ticks, values, quality = ticks[keep], values[keep], quality[keep]
+    time = ((ticks - EPOCH_TICKS) // TICKS_PER_US).astype(TIME_DTYPE)
+    return ArrayTimeseries('', time, values, quality)
+
+
+def _work(block: _Block, policy: str, aggregate) -> _Block:
+    """Worker process. Decode the (ticks, values, quality) buffers of `block`, and aggregate
+    if `aggregate` is (start, end, span, aggregations). Returns the result block"""
+    shm = shared_memory.SharedMemory(name=block.name)
+    try:
+        ts = _decode(*_views(shm, block), policy)
+        if aggregate is None:
+            results = [ts]
+        else:
+            from .aggregate import Aggregator
+            start, end, span, aggs = aggregate
+            results = Aggregator(ts).compute(start, end, span, *aggs)
+        parts = [a for r in results for a in (r.time.view(np.int64), r.value, r.quality)]
+        out, out_block = _share(parts)
+        out.close()
+        return out_block
+    finally:
+        shm.close()
+
+
+def _flatten(raw_ts) -> Tuple['np.ndarray', 'np.ndarray', 'np.ndarray']:
+    "Copy a .NET history result into flat (ticks, values, quality) arrays"
+    return arrays.net_ticks(raw_ts.Timestamps), arrays.net_to_numpy(raw_ts.Values), arrays.net_to_numpy(raw_ts.Qualities, QUALITY_DTYPE)
+
+
+class ParallelDecoder:
+    """
+    A process pool decoding and aggregating raw history pages. Use it as a context
+    manager, or call `close()` when done.
+
+    Arguments:
+    processes: The number of worker processes. Default: the number of CPUs
+    quality_policy: Which samples are kept when decoding: 'all', 'usable' (skip bad samples and NaN's)
+                    or 'good'. Aggregation applies its own quality rules to the kept samples
+    pipeline: The maximum number of pages being decoded while the next pages are read
+
+    >>> with ParallelDecoder() as decoder:
+    ...     for page in item.read_raw_pages(start, end, decoder=decoder):
+    ...         ...
+    """
+    def __init__(self, processes: Optional[int] = None, quality_policy: str = 'all', pipeline: Optional[int] = None,
+                 mp_context=None):
+        if quality_policy not in _quality.POLICIES:
+            raise Error(f"Invalid quality policy '{quality_policy}'. Expected one of {', '.join(_quality.POLICIES)}")
+        self.quality_policy = quality_policy
+        self.processes = processes or os.cpu_count() or 1
+        self.pipeline = pipeline or 2 * self.processes
+        self._pool = ProcessPoolExecutor(self.processes, mp_context=mp_context)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._pool.shutdown()
+
+    def _submit(self, item_id: str, flat, aggregate=None) -> Future:
+        """Decode (and aggregate) flat buffers. Returns a future of a list of ArrayTimeseries.
+        All samples are kept for aggregation, which applies its own quality rules"""
+        ticks, values, quality = flat
+        policy = self.quality_policy if aggregate is None else 'all'
+        result = Future()
+        if values.dtype == object:
+            try:
+                if aggregate is not None:
+                    raise Error(f"Item {item_id} has non-numeric values and can't be aggregated")
+                result.set_result([_decode(ticks, values, quality, policy)._replace(item_id=item_id)])
+            except Exception as e:
+                result.set_exception(e)
+            return result
+
+        shm, block = _share([ticks, values.astype(np.float64, copy=False), quality])
+
+        def done(f):
+            shm.close()
+            shm.unlink()
+            if f.exception() is not None:
+                result.set_exception(f.exception())
+                return
+            try:
+                parts = _receive(f.result())
+                result.set_result([ArrayTimeseries(item_id, parts[i].view(TIME_DTYPE), parts[i+1], parts[i+2])
+                                   for i in range(0, len(parts), 3)])
+            except Exception as e:
+                result.set_exception(e)
+
+        self._pool.submit(_work, block, policy, aggregate).add_done_callback(done)
+        return result
+
+    def decode(self, item_id: str, raw_ts) -> ArrayTimeseries:
+        "Decode one .NET history result (i.e. from ReadHistoryRaw) in the pool"
+        return self._submit(item_id, _flatten(raw_ts)).result()[0]
+
+    def read_raw_pages(self, item, start: datetime, end: datetime, page_size: int = 10000) -> Iterator[ArrayTimeseries]:
+        """
+        Generator reading raw history for `item` in pages, like `Item.read_raw_pages`. The
+        next pages are read from the hive while the previous pages are decoded in the pool.
+        """
+        tsapi = item.module.hive.api.GetTimeseriesAccess()
+        read = lambda page_start, size: _flatten(item._get_hist(tsapi, tsapi.ReadHistoryRaw, page_start, end, size, False))
+        pending = collections.deque()
+        for flat in arrays._raw_pages(read, start, end, page_size):
+            pending.append(self._submit(item.item_id, flat))
+            while len(pending) >= self.pipeline:
+                yield from self._pages(pending.popleft())
+        while pending:
+            yield from self._pages(pending.popleft())
+
+    @staticmethod
+    def _pages(future: Future) -> Iterator[ArrayTimeseries]:
+        page = future.result()[0]
+        if page.size:
+            yield page
+
+    def aggregate(self, items, start: datetime, end: datetime, span: timedelta, *aggregation: Aggregation,
+                  page_size: int = 100000) -> List[List[ArrayTimeseries]]:
+        """
+        Read raw history for several items and compute aggregates client-side in the pool,
+        one task per item. See `aggregate.Aggregator` for the aggregate semantics.
+
+        Returns:
+        A list per item with one ArrayTimeseries per aggregate
+        """
+        futures = []
+        for item in items:
+            tsapi = item.module.hive.api.GetTimeseriesAccess()
+            read = lambda page_start, size, item=item, tsapi=tsapi: \
+                _flatten(item._get_hist(tsapi, tsapi.ReadHistoryRaw, page_start, end, size, True))
+            pages = list(arrays._raw_pages(read, start, end, page_size))
+            if pages:
+                flat = tuple(np.concatenate(parts) for parts in zip(*pages))
+            else:
+                flat = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty(0, dtype=QUALITY_DTYPE))
+            futures.append(self._submit(item.item_id, flat, (start, end, span, aggregation)))
+        return [f.result() for f in futures]
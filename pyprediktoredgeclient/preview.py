@@ -0,0 +1,225 @@
+"""
+Downsampled previews of long history periods, i.e. for plotting trends.
+
+A preview has at most a given number of samples, chosen to keep the shape and
+the peaks of the raw history:
+- 'minmax' keeps the minimum and the maximum sample of each of `target_points / 2`
+  intervals of equal length.
+- 'lttb' (Largest-Triangle-Three-Buckets) keeps the first and last samples and one
+  sample per interval, the one making the largest triangle with the sample kept in
+  the previous interval and the average of the next interval.
+
+The decimators work on time intervals, so raw history is streamed through them
+page by page, and only the samples of the intervals not yet decided are held.
+Samples with bad quality or NaN values are left out.
+
+`read_preview` decides between decimating raw history and letting the hive compute
+MINIMUMACTUALTIME/MAXIMUMACTUALTIME aggregates, from the density of the first raw page.
+
+Requires numpy.
+"""
+__all__ = 'read_preview', 'lttb', 'minmax', 'METHODS'
+
+from datetime import datetime, timedelta
+from typing import Optional
+
+from . import arrays
+from . import quality as _quality
+from .arrays import ArrayTimeseries, QUALITY_DTYPE, TIME_DTYPE
+from .util import Aggregation, Error, _import_optional
+
+np = _import_optional('numpy', 'history previews')
+
+METHODS = 'lttb', 'minmax'
+RAW_LIMIT_FACTOR = 20       # By default, raw history is decimated client-side up to this many samples per preview point
+
+
+def _usable(page: ArrayTimeseries):
+    "The (time as int64 us, value, quality) arrays of the usable samples of a page"
+    if page.value.dtype == object:
+        raise Error(f"Item {page.item_id} has non-numeric values and can't be previewed")
+    keep = _quality.mask(page.quality, 'usable', page.value)
+    return (page.time[keep].astype(TIME_DTYPE).astype(np.int64),
+            np.asarray(page.value[keep], dtype=np.float64),
+            page.quality[keep].astype(QUALITY_DTYPE))
+
+
+def _segments(b):
+    "Start and end positions of the runs of equal bucket numbers in the sorted `b`"
+    starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]]) if len(b) else np.empty(0, dtype=np.int64)
+    return starts, np.r_[starts[1:], len(b)]
+
+
+class _Decimator:
+    "Internal. Assigns samples to `buckets` intervals of equal length in [start, end)"
+    def __init__(self, item_id: str, start, end, buckets: int):
+        self.item_id = item_id
+        self.t0 = int(np.datetime64(start, 'us').astype(np.int64))
+        self.width = max(int(np.datetime64(end, 'us').astype(np.int64)) - self.t0, 1)
+        self.buckets = max(int(buckets), 1)
+
+    def bucket(self, t):
+        return np.clip((t - self.t0) * self.buckets // self.width, 0, self.buckets - 1)
+
+    def _result(self, t, v, q) -> ArrayTimeseries:
+        return ArrayTimeseries(self.item_id, t.astype(TIME_DTYPE), v, q.astype(QUALITY_DTYPE))
+
+
+class _MinMax(_Decimator):
+    "Internal. Keeps the first minimum and maximum sample of each interval"
+    def __init__(self, item_id: str, start, end, buckets: int):
+        super().__init__(item_id, start, end, buckets)
+        self.t = np.zeros((2, self.buckets), dtype=np.int64)
+        self.v = np.full((2, self.buckets), np.nan)
+        self.q = np.zeros((2, self.buckets), dtype=QUALITY_DTYPE)
+
+    def add(self, page: ArrayTimeseries):
+        t, v, q = _usable(page)
+        if not len(t):
+            return
+        b = self.bucket(t)
+        starts, ends = _segments(b)
+        bs = b[starts]
+        for row, ufunc, better in ((0, np.minimum, np.less), (1, np.maximum, np.greater)):
+            ext = ufunc.reduceat(v, starts)
+            hits = np.flatnonzero(v == np.repeat(ext, ends - starts))
+            pos = hits[np.searchsorted(hits, starts)]      # The first extreme sample of each run
+            cur = self.v[row, bs]
+            update = np.isnan(cur) | better(ext, cur)
+            sel, at = bs[update], pos[update]
+            self.t[row, sel], self.v[row, sel], self.q[row, sel] = t[at], v[at], q[at]
+
+    def result(self) -> ArrayTimeseries:
+        used = ~np.isnan(self.v[0])
+        t, v, q = self.t[:, used], self.v[:, used], self.q[:, used]
+        order = np.argsort(t, axis=0, kind='stable')        # The earlier of min/max first in each interval
+        t, v, q = (np.take_along_axis(a, order, axis=0).T.ravel() for a in (t, v, q))
+        keep = np.r_[True, t[1:] != t[:-1]] if len(t) else np.empty(0, dtype=bool)
+        return self._result(t[keep], v[keep], q[keep])
+
+
+class _LTTB(_Decimator):
+    """Internal. Largest-Triangle-Three-Buckets over time intervals. An interval is decided
+    when the next non-empty interval is complete, so only those samples are buffered"""
+    def __init__(self, item_id: str, start, end, buckets: int):
+        super().__init__(item_id, start, end, buckets)
+        self.pending = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=QUALITY_DTYPE))
+        self.selected = []
+        self.prev = None        # (time, value) of the last selected sample
+        self.last = None        # The last sample seen
+
+    def _select(self, t, v, q, i):
+        self.selected.append((t[i:i+1], v[i:i+1], q[i:i+1]))
+        self.prev = (float(t[i]), float(v[i]))
+
+    def add(self, page: ArrayTimeseries):
+        t, v, q = _usable(page)
+        if not len(t):
+            return
+        if self.prev is None:
+            self._select(t, v, q, 0)        # The first sample is always kept
+            t, v, q = t[1:], v[1:], q[1:]
+        self.last = (t[-1:], v[-1:], q[-1:]) if len(t) else self.last
+        self.pending = tuple(np.concatenate(pair) for pair in zip(self.pending, (t, v, q)))
+        self._decide(final=False)
+
+    def _decide(self, final: bool):
+        t, v, q = self.pending
+        starts, ends = _segments(self.bucket(t))
+        n = len(starts)
+        ready = n if final else max(n - 2, 0)
+        for j in range(ready):
+            if j + 1 < n:
+                nxt = slice(starts[j+1], ends[j+1])
+                nt, nv = t[nxt].mean(), v[nxt].mean()
+            else:
+                nt, nv = float(self.last[0][0]), float(self.last[1][0])
+            seg = slice(starts[j], ends[j])
+            pt, pv = self.prev
+            area = np.abs((pt - nt) * (v[seg] - pv) - (pt - t[seg]) * (nv - pv))
+            self._select(t, v, q, starts[j] + int(np.argmax(area)))
+        rest = starts[ready] if ready < n else len(t)
+        self.pending = (t[rest:], v[rest:], q[rest:])
+
+    def result(self) -> ArrayTimeseries:
+        self._decide(final=True)
+        parts = list(self.selected)
+        if self.last is not None and parts and parts[-1][0][0] != self.last[0][0]:
+            parts.append(self.last)         # The last sample is always kept
+        if not parts:
+            return ArrayTimeseries.empty(self.item_id)
+        return self._result(*(np.concatenate(c) for c in zip(*parts)))
+
+
+def _decimator(method: str, item_id: str, start, end, target_points: int) -> _Decimator:
+    if method not in METHODS:
+        raise Error(f"Invalid preview method '{method}'. Expected one of {', '.join(METHODS)}")
+    if target_points < 2:
+        raise Error("A preview needs at least 2 points")
+    if method == 'minmax':
+        return _MinMax(item_id, start, end, target_points // 2)
+    return _LTTB(item_id, start, end, target_points - 2)
+
+
+def _decimate(ts: ArrayTimeseries, target_points: int, method: str) -> ArrayTimeseries:
+    if not ts.size:
+        return ts
+    start, end = ts.time[0], ts.time[-1] + np.timedelta64(1, 'us')
+    dec = _decimator(method, ts.item_id, start, end, target_points)
+    dec.add(ts)
+    return dec.result()
+
+
+def lttb(ts: ArrayTimeseries, target_points: int) -> ArrayTimeseries:
+    "Downsample a time ordered series to at most `target_points` samples with Largest-Triangle-Three-Buckets"
+    return _decimate(ts, target_points, 'lttb')
+
+
+def minmax(ts: ArrayTimeseries, target_points: int) -> ArrayTimeseries:
+    "Downsample a time ordered series to the minimum and maximum samples of `target_points / 2` intervals"
+    return _decimate(ts, target_points, 'minmax')
+
+
+def _server_minmax(item, start: datetime, end: datetime, buckets: int, page_size: int) -> ArrayTimeseries:
+    "The usable MINIMUMACTUALTIME and MAXIMUMACTUALTIME samples of `buckets` intervals, in time order"
+    span = max((end - start) / buckets, timedelta(milliseconds=1))
+    parts = [p for page in item.read_agg_pages(start, end, span, Aggregation.MINIMUMACTUALTIME,
+                                                  Aggregation.MAXIMUMACTUALTIME, page_size=page_size)
+             for p in page]
+    if not parts:
+        return ArrayTimeseries.empty(item.item_id)
+    ts = arrays.concat(item.item_id, parts)
+    t, v, q = _usable(ts)
+    order = np.argsort(t, kind='stable')
+    t, v, q = t[order], v[order], q[order]
+    keep = np.r_[True, t[1:] != t[:-1]] if len(t) else np.empty(0, dtype=bool)
+    return ArrayTimeseries(item.item_id, t[keep].astype(TIME_DTYPE), v[keep], q[keep])
+
+
+def read_preview(item, start: datetime, end: datetime, target_points: int = 1500, method: str = 'lttb',
+                 page_size: int = 10000, raw_limit: Optional[int] = None) -> ArrayTimeseries:
+    """
+    Read a preview of at most `target_points` samples of `item` in [start, end). See `Item.read_preview`.
+    """
+    dec = _decimator(method, item.item_id, start, end, target_points)
+    raw_limit = RAW_LIMIT_FACTOR * target_points if raw_limit is None else raw_limit
+
+    pages = item.read_raw_pages(start, end, page_size)
+    first = next(pages, None)
+    if first is None:
+        return ArrayTimeseries.empty(item.item_id)
+
+    if first.size >= page_size:
+        covered = (first.time[-1] - first.time[0]) / np.timedelta64(1, 'us')
+        period = (np.datetime64(end, 'us') - np.datetime64(start, 'us')) / np.timedelta64(1, 'us')
+        estimate = page_size * period / covered if covered > 0 else np.inf
+        if estimate > raw_limit:
+            pages.close()
+            if method == 'minmax':
+                return _server_minmax(item, start, end, target_points // 2, page_size)
+            return lttb(_server_minmax(item, start, end, target_points, page_size), target_points)
+
+    dec.add(first)
+    for page in pages:
+        dec.add(page)
+    return dec.result()
@@ -0,0 +1,138 @@
+"""
+Vectorized operations on arrays of quality codes.
+
+The functions take NumPy arrays (uint16 or uint32), sequences of ints/`util.Quality`
+or single values, and work on whole arrays at once. A quality code is an OPC DA
+quality in the low byte (status in the two top bits, then substatus and limit)
+and OPC HDA flags in the upper bits, see `util.OPC_quality`.
+
+Requires numpy.
+"""
+__all__ = ('isgood', 'is_uncertain', 'is_bad', 'status', 'da_code', 'hda_code', 'has_flag',
+           'mask', 'worst', 'names', 'NODATA')
+
+from typing import Union
+
+from .util import Error, OPC_quality, OPC_quality_index, _import_optional
+
+np = _import_optional('numpy', 'vectorized quality operations')
+
+STATUS_MASK = 0xC0
+DA_MASK = 0xff
+HDA_MASK = 0x8fffff00       # The same mask as `Quality.get_codes`
+
+GOOD = int(OPC_quality.good)
+UNCERTAIN = int(OPC_quality.uncertain)
+BAD = int(OPC_quality.bad)
+NODATA = BAD | int(OPC_quality.noData)     # The quality of intervals or grid points without data
+
+POLICIES = 'all', 'usable', 'good'
+
+
+def _codes(q):
+    return np.asarray(q, dtype=np.uint32)
+
+
+def status(q):
+    "The OPC DA status bits (good 0xC0, uncertain 0x40 or bad 0)"
+    return _codes(q) & STATUS_MASK
+
+
+def isgood(q):
+    "True where the DA status is good"
+    return status(q) == GOOD
+
+
+def is_uncertain(q):
+    "True where the DA status is uncertain"
+    return status(q) == UNCERTAIN
+
+
+def is_bad(q):
+    "True where the DA status is bad"
+    return status(q) == BAD
+
+
+def da_code(q):
+    "The OPC DA part of the codes (low byte)"
+    return _codes(q) & DA_MASK
+
+
+def hda_code(q):
+    "The OPC HDA flags of the codes"
+    return _codes(q) & HDA_MASK
+
+
+def has_flag(q, flag: Union[OPC_quality, int, str]):
+    """
+    True where the code has `flag`. HDA flags (i.e. OPC_quality.interpolated) are
+    tested as bits. DA qualities (i.e. OPC_quality.badSensorFailure) match the whole
+    DA part, and the statuses good, uncertain and bad match the status bits.
+    """
+    flag = int(OPC_quality[flag] if isinstance(flag, str) else flag)
+    if flag > DA_MASK:
+        return (_codes(q) & flag) != 0
+    if flag in (GOOD, UNCERTAIN, BAD):
+        return status(q) == flag
+    return da_code(q) == flag
+
+
+def mask(q, policy: str = 'usable', values=None):
+    """
+    Boolean mask of the samples to keep:
+    'all' keeps every sample, 'usable' skips bad samples (and NaN `values` if given),
+    and 'good' keeps only good samples.
+    """
+    if policy not in POLICIES:
+        raise Error(f"Invalid quality policy '{policy}'. Expected one of {', '.join(POLICIES)}")
+    q = _codes(q)
+    if policy == 'all':
+        return np.ones(q.shape, dtype=bool)
+    if policy == 'good':
+        return isgood(q)
+    keep = ~is_bad(q)
+    if values is not None:
+        keep &= ~_isnan(values)
+    return keep
+
+
+def _isnan(values):
+    "True where a value is a float NaN. Non-numeric values (strings, None, arrays) are never NaN"
+    if isinstance(values, np.ndarray) and values.dtype != object:
+        return np.isnan(values) if values.dtype.kind in 'fc' else np.zeros(values.shape, dtype=bool)
+    return np.fromiter((isinstance(v, (float, np.floating)) and v != v for v in values), dtype=bool, count=len(values))
+
+
+def worst(*q):
+    """
+    The worst of several codes (or arrays of codes, broadcast together), element-wise:
+    bad before uncertain before good. The first code wins between equal statuses.
+    """
+    if not q:
+        raise Error("worst() needs at least one quality code")
+    stacked = np.stack(np.broadcast_arrays(*(_codes(c) for c in q)))
+    pick = np.argmin(stacked & STATUS_MASK, axis=0)
+    return np.take_along_axis(stacked, pick[np.newaxis], axis=0)[0]
+
+
+# DA code -> name, and HDA flag bits -> name
+_da_names = {int(k): v for k, v in OPC_quality_index.items() if int(k) <= DA_MASK}
+_hda_flags = [(int(k), v) for k, v in OPC_quality_index.items() if int(k) > DA_MASK]
+
+
+def _name(code: int) -> str:
+    da = code & DA_MASK
+    name = _da_names.get(da) or _da_names.get(da & STATUS_MASK, f"0x{da:02x}")
+    flags = [n for bit, n in _hda_flags if code & bit]
+    return ' | '.join([name] + flags)
+
+
+def names(q):
+    """
+    The names of the codes as an object array, i.e. 'good | raw'. Each distinct
+    code is named once, so large arrays with few distinct codes are fast.
+    """
+    q = _codes(q)
+    unique, inverse = np.unique(q, return_inverse=True)
+    table = np.array([_name(int(c)) for c in unique] or [''], dtype=object)
+    return table[inverse].reshape(q.shape)
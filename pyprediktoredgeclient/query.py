@@ -0,0 +1,157 @@
+"""
+Local index of the items in a hive, for fast item queries.
+
+The index holds the item-id's of each module in a sorted list, and the reversed
+item-id's in another, so glob patterns are answered by a range search on the
+longer of the literal prefix and the literal suffix of the pattern (i.e. '*.FlowRate'),
+followed by a compiled regular expression on the range. Patterns with neither,
+like '*Flow*', test every item-id. Attribute values used in queries are cached per
+module as columns, and re-read when they are older than `max_age` or written
+through this client. Modules are re-indexed individually when their item set changes.
+"""
+__all__ = 'ItemIndex',
+
+import bisect
+import fnmatch
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from .util import _normalize_input
+
+Predicate = Union[Any, Callable[[Any], bool]]
+
+
+def _literal_prefix(pattern: str) -> str:
+    "The part of a glob pattern before the first wildcard"
+    m = re.search(r'[*?\[]', pattern)
+    return pattern if m is None else pattern[:m.start()]
+
+
+def _literal_suffix(pattern: str) -> str:
+    "The part of a glob pattern after the last wildcard or character set"
+    m = re.search(r'[*?\[\]][^*?\[\]]*$', pattern)
+    return pattern if m is None else pattern[m.start() + 1:]
+
+
+def _range(keys: List[str], prefix: str) -> List[str]:
+    "The keys of the sorted `keys` starting with `prefix`"
+    return keys[bisect.bisect_left(keys, prefix):bisect.bisect_left(keys, prefix + '\U0010ffff')]
+
+
+class _ModuleIndex:
+    __slots__ = 'module', 'keys', 'reversed', 'raw', 'columns', 'read_at'
+
+    def __init__(self, module, raw_items):
+        self.module = module
+        self.raw = {_normalize_input(obj.ItemID): obj for obj in raw_items}
+        self.keys = sorted(self.raw)
+        self.reversed = sorted(k[::-1] for k in self.raw)
+        self.columns = {}       # normalized attribute name -> {key: value}
+        self.read_at = {}       # normalized attribute name -> time.monotonic() of the read
+
+    def match(self, regex, prefix: str, suffix: str = '') -> List[str]:
+        if len(suffix) > len(prefix):
+            return sorted(k for k in (r[::-1] for r in _range(self.reversed, suffix[::-1])) if regex.match(k))
+        return [k for k in _range(self.keys, prefix) if regex.match(k)]
+
+
+class ItemIndex:
+    """
+    An index of the items in a hive. Usually used through `Hive.query_items`.
+
+    Arguments:
+    hive: The Hive to index
+    max_age: The maximum age in seconds of cached attribute values
+    """
+    def __init__(self, hive, max_age: float = 60.0):
+        self.hive = hive
+        self.max_age = max_age
+        self._modules: Dict[str, _ModuleIndex] = {}
+        self._generation = None
+        self._dirty = set()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return sum(len(m.keys) for m in self._modules.values())
+
+    def invalidate(self, module=None, attribute: Optional[str] = None):
+        """Drop the index and the cached attribute values of `module` (a Module or module
+        name), so it is re-indexed on the next query. If `module` is None, all modules are dropped.
+        If `attribute` is given, only the cached values of that attribute are dropped"""
+        with self._lock:
+            if attribute is not None:
+                key = _normalize_input(attribute, True)
+                indexes = self._modules.values() if module is None else [self._modules.get(str(module))]
+                for index in indexes:
+                    if index is not None:
+                        index.columns.pop(key, None)
+                        index.read_at.pop(key, None)
+            elif module is None:
+                self._modules.clear()
+            else:
+                self._modules.pop(str(module), None)
+
+    def refresh(self):
+        """Re-read the item set of every module, and re-index the modules where it
+        has changed. Cached attribute values of unchanged modules are kept"""
+        with self._lock:
+            self._dirty.update(self._modules)
+            self._sync()
+
+    def _sync(self):
+        "Bring the index in line with the module registry. Must be called with the lock held"
+        generation = self.hive._registry.generation
+        modules = {mod.name: mod for mod in self.hive.modules}
+        if generation != self._generation:
+            self._dirty.update(self._modules)
+            self._generation = generation
+        for name in list(self._modules):
+            if name not in modules:
+                del self._modules[name]
+        for name, mod in modules.items():
+            index = self._modules.get(name)
+            if index is None or name in self._dirty:
+                raw_items = list(mod.api.GetItems())
+                if index is None or set(index.raw) != {_normalize_input(obj.ItemID) for obj in raw_items}:
+                    self._modules[name] = _ModuleIndex(mod, raw_items)
+                else:
+                    index.module = mod
+        self._dirty.clear()
+
+    def _column(self, index: _ModuleIndex, name: str, now: float) -> Dict[str, Any]:
+        "The cached values of the attribute `name` in a module, re-read if too old"
+        key = _normalize_input(name, True)
+        if key not in index.columns or now - index.read_at[key] > self.max_age:
+            table = index.module.read_attributes([name], [self.hive._item(index.module, obj) for obj in index.raw.values()])
+            index.columns[key] = dict(zip((_normalize_input(i) for i in table['item_id']), table[name]))
+            index.read_at[key] = now
+        return index.columns[key]
+
+    def query(self, pattern: str = '*', where: Optional[Dict[str, Predicate]] = None) -> List:
+        """
+        Return the items matching the item-id `pattern` and the attribute conditions in `where`.
+        See `Hive.query_items`.
+        """
+        pattern = _normalize_input(pattern)
+        regex = re.compile(fnmatch.translate(pattern))
+        prefix, suffix = _literal_prefix(pattern), _literal_suffix(pattern)
+        where = where or {}
+
+        with self._lock:
+            self._sync()
+            now = time.monotonic()
+            result = []
+            for index in self._modules.values():
+                keys = index.match(regex, prefix, suffix)
+                for attr, cond in where.items():
+                    if not keys:
+                        break
+                    column = self._column(index, attr, now)
+                    test = cond if callable(cond) else (lambda v, cond=cond: v == cond)
+                    keys = [k for k in keys if test(column.get(k))]
+                result.extend(self.hive._item(index.module, index.raw[k]) for k in keys)
+            return result
@@ -1,22 +1,87 @@
+import codecs
 import io
+import os
 import re
+import time
 
 import uuid
 import xml.etree.ElementTree as ET
-from typing import Optional, TextIO, Union
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, TextIO, Tuple, Union
 
 from .util import Error, _normalize_arguments
 
+NodesetSource = Union[TextIO, io.IOBase, str, os.PathLike]
+ProgressCallback = Callable[[int, Optional[int]], None]
+
+_BOM = '\ufeff'
+
+
+class _UriDetector:
+    """
+    Incrementally parse the start of a nodeset until the model URI and the URIs of
+    the required models are found. The parsing stops at the end of the first Model
+    element, or at the first element that can't precede the models.
+    """
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self.model_uri = None
+        self.namespace_uri = None
+        self.required = []
+        self.done = False
+
+    @property
+    def uri(self):
+        return self.model_uri or self.namespace_uri
+
+    def feed(self, data: str):
+        if self.done:
+            return
+        self._parser.feed(data)
+        for event, elem in self._parser.read_events():
+            tag = elem.tag.rsplit('}', 1)[-1]
+            if event == 'end' and tag == 'Uri' and self.namespace_uri is None:
+                self.namespace_uri = elem.text
+            elif tag == 'Model' and 'ModelUri' in elem.attrib:
+                self.model_uri = elem.attrib['ModelUri']
+                self.done = event == 'end'
+            elif event == 'start' and tag == 'RequiredModel' and self.model_uri is not None:
+                self.required.append(elem.attrib.get('ModelUri'))
+            elif event == 'start' and (tag == 'Aliases' or (tag.startswith('UA') and tag != 'UANodeSet')):
+                self.done = True
+            if self.done:
+                self._parser = None
+                return
+
+
+class NamespaceImport(NamedTuple):
+    """
+    The result of importing one nodeset with `SemanticService.load_namespaces`.
+    `error` is None if the import succeeded.
+    """
+    uri: str
+    module: Any
+    result: Any
+    error: Optional[Exception]
+
+
 class SemanticService:
+    MIN_CHUNK = 64*1024             # Characters in the first AppendXmlFile call
+    MAX_CHUNK = 16*1024*1024        # Upper limit for the adaptive chunk size
+    CHUNK_TARGET_TIME = 0.5         # The chunk size is adapted towards this duration (s) per AppendXmlFile call
+
     def __init__(self, hive):
         self.hive = hive
 
     semantic_service = property(lambda self:self.hive.api.GetSemanticService(), doc="Get the semantic service")
 
-    def load_namespace(self, nodeset: Union[TextIO, str], module_name: Optional[str]=None, properties=None, **kw):
+    def load_namespace(self, nodeset: NodesetSource, module_name: Optional[str]=None, properties=None,
+                       progress: Optional[ProgressCallback]=None, **kw):
         """
-        Load a namespace from an nodeset-file. The `nodeset` must either be
-        an open, file-like object or a string containing the nodeset definition.
+        Load a namespace from an nodeset-file. The `nodeset` can be a file path, an open,
+        file-like object (text or binary) or a string containing the nodeset definition.
+        The nodeset is streamed to the hive, so large nodesets are never held in memory.
 
         The loader will search for a Semantics module that has the appropriate URI.
         If the module is not found, a module will be created. The created module
@@ -25,94 +90,246 @@ class SemanticService:
         will have properties given by the `properties` argument
 
         Arguments:
-        nodeset: The nodeset XML source. Either a open, file-like object or a string
+        nodeset: The nodeset XML source. Either a file path, an open, file-like object or a string
         URI: The nodeset model-URI. If not given it is extracted from the source
         modulename: The name of the created module
         properties: The properties of the created module
+        progress: Optional callback, called after each uploaded chunk with the number of bytes
+                  (UTF-8) sent and the total size in bytes (None if unknown)
 
         Returns:
         The created or exisiting Semantics module corresponding to the URI
         """
-        node_xml_str = self.load_xml(nodeset)
+        props = _normalize_arguments(properties, kw)
+        accessLoader = self.semantic_service.AccessLoader()
+
+        filename, detector = self._upload(accessLoader, nodeset, progress)
+        try:
+            uri = props.get('uri') or detector.uri
+            if uri is None:
+                raise Error('Malformed nodeset file.')
+            module = self._semantic_module(uri, module_name, props)
+            importResult = accessLoader.ImportAndCheckNamespace(uri, [], False, filename, False)
+            # print(f"Import namespace result '{importResult.Value}' on ({self.hive.name})")
+        finally:
+            accessLoader.DeleteXmlFile(filename)
+        return module
+
+    def load_namespaces(self, sources: Sequence[NodesetSource], module_names: Optional[Dict[str, str]]=None,
+                        properties=None, workers: int=4, **kw) -> List[NamespaceImport]:
+        """
+        Load several nodesets. The nodesets are uploaded to the hive in parallel, and
+        imported in dependency order given by the RequiredModel elements of the nodesets.
+        Required models that are not among the sources are assumed to be loaded already.
+        If an import fails, the nodesets depending on it are not imported.
+
+        Arguments:
+        sources: The nodeset sources. See `load_namespace`
+        module_names: Optional dict of model-URI: module name for the created modules
+        properties: The properties of the created modules
+        workers: The number of parallel uploads
 
+        Returns:
+        A list of NamespaceImport results, in import order
+        """
         props = _normalize_arguments(properties, kw)
-        uri = props.get('uri') or self.find_URI(node_xml_str)
+        module_names = module_names or {}
 
+        def upload(source):
+            loader = self.semantic_service.AccessLoader()
+            filename, detector = self._upload(loader, source)
+            return loader, filename, detector
 
-        def sem_module():
-            for mod in self.hive.modules:
-                for prop in mod.properties:
-                    if prop.name == 'Uri' and prop.value==uri:
-                        return mod
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(upload, source) for source in sources]
+        uploads = [f.result() for f in futures if f.exception() is None]
 
-            mod_name = module_name or re.sub(r"\W+", "_", uri).strip('_')
-            return self.hive.add_module("ApisSemantics", mod_name, props, Uri=uri)
+        try:
+            for f in futures:
+                if f.exception() is not None:
+                    raise f.exception()
 
-        module = sem_module()
+            by_uri = {}
+            for loader, filename, detector in uploads:
+                if detector.uri is None:
+                    raise Error('Malformed nodeset file.')
+                if detector.uri in by_uri:
+                    raise Error(f"Model {detector.uri} is given more than once")
+                by_uri[detector.uri] = (loader, filename, detector.required)
 
-        def nodeset_chunker(max_len:int=4096)->str:
-            buff = []
-            chunk_len=0
+            index = self._semantic_module_index()
+            results = []
+            failed = set()
+            for uri in _load_order({u: req for u, (_, _, req) in by_uri.items()}):
+                loader, filename, required = by_uri[uri]
+                missing = failed.intersection(required)
+                if missing:
+                    failed.add(uri)
+                    results.append(NamespaceImport(uri, None, None, Error(f"Required model(s) failed: {', '.join(sorted(missing))}")))
+                    continue
+                try:
+                    module = self._semantic_module(uri, module_names.get(uri), props, index)
+                    importResult = loader.ImportAndCheckNamespace(uri, [], False, filename, False)
+                    results.append(NamespaceImport(uri, module, importResult, None))
+                except Exception as e:
+                    failed.add(uri)
+                    results.append(NamespaceImport(uri, None, None, e))
+            return results
+        finally:
+            for loader, filename, _ in uploads:
+                loader.DeleteXmlFile(filename)
 
-            with io.StringIO(node_xml_str) as inputf:
-                for line in inputf:
-                    if chunk_len+len(line)>max_len:
-                        yield ''.join(buff)
-                        buff = [line]
-                        chunk_len = len(line)
-                    else:
-                        buff.append(line)
-                        chunk_len += len(line)
-                yield ''.join(buff)
+    def _semantic_module_index(self) -> Dict[str, Any]:
+        "Return a dict of model-URI: module for all modules with a Uri property"
+        index = {}
+        for mod in self.hive.modules:
+            for prop in mod.properties:
+                if prop.name == 'Uri':
+                    index.setdefault(prop.value, mod)
+                    break
+        return index
 
-        accessLoader = self.semantic_service.AccessLoader()
+    def _semantic_module(self, uri, module_name, props, index: Optional[Dict[str, Any]]=None):
+        """Return the ApisSemantics module for `uri`, creating it if needed. If `index`
+        is given, it is used for the search and updated with created modules"""
+        if index is None:
+            index = self._semantic_module_index()
+        if uri in index:
+            return index[uri]
+
+        mod_name = module_name or re.sub(r"\W+", "_", uri).strip('_')
+        index[uri] = self.hive.add_module("ApisSemantics", mod_name, props, Uri=uri)
+        return index[uri]
+
+    @contextmanager
+    def _open_nodeset(self, nodeset: NodesetSource) -> Iterator[Tuple[TextIO, Optional[int]]]:
+        """Open a nodeset source as a text stream. Yields the stream and the total size in UTF-8
+        bytes if known. Line endings are kept as they are, so the size matches the text read"""
+        if isinstance(nodeset, str) and nodeset.lstrip(_BOM + ' \t\r\n')[:1] == '<':
+            text = nodeset[1:] if nodeset.startswith(_BOM) else nodeset
+            with io.StringIO(text, newline='') as f:
+                yield f, len(text.encode('utf-8'))
+        elif isinstance(nodeset, (str, os.PathLike)):
+            with open(nodeset, 'rb') as raw:
+                total = os.fstat(raw.fileno()).st_size
+                if raw.peek(len(codecs.BOM_UTF8)).startswith(codecs.BOM_UTF8):
+                    total -= len(codecs.BOM_UTF8)
+                with io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as f:
+                    yield f, total
+        elif isinstance(nodeset, io.TextIOBase):
+            yield nodeset, None
+        elif isinstance(nodeset, io.IOBase) or hasattr(nodeset, 'read'):
+            text = io.TextIOWrapper(nodeset, encoding='utf-8-sig', newline='')
+            try:
+                yield text, None
+            finally:
+                text.detach()
+        else:
+            raise Error('nodeset must be a path, file-like or string')
+
+    @staticmethod
+    def _chunks(source: TextIO, chunk_size: Callable[[], int]) -> Iterator[str]:
+        """
+        Generator splitting the source into chunks after the last line end or tag end ('>')
+        read, or at the size read if there is neither. The size of each chunk is read from
+        the `chunk_size` callable, so it can change between chunks. The text carried over
+        to the next chunk is always shorter than one read, also for single-line nodesets.
+        """
+        rest = ''
+        while True:
+            data = source.read(chunk_size())
+            if not data:
+                break
+            data = rest + data
+            cut = max(data.rfind('\n'), data.rfind('>')) + 1 or len(data)
+            rest = data[cut:]
+            yield data[:cut]
+        if rest:
+            yield rest
 
+    def _upload(self, accessLoader, nodeset: NodesetSource, progress: Optional[ProgressCallback]=None) -> Tuple[str, _UriDetector]:
+        """
+        Stream a nodeset to a temp file on the hive with AppendXmlFile, detecting the model
+        URI on the way. The chunks are split at line or tag ends, and the chunk size grows
+        or shrinks towards CHUNK_TARGET_TIME per call.
+
+        Returns the temp file name and the URI detector holding the model URI (None if not found)
+        and the required models
+        """
         filename = uuid.uuid4().hex + ".xml"
         if accessLoader.CreateXmlFile(filename, "") != 0:
             raise Error('Access loader unable to create temp file for loading')
 
-        for chunk in nodeset_chunker(): 
-            accessLoader.AppendXmlFile(filename, chunk)
-            
-        importResult = accessLoader.ImportAndCheckNamespace(uri, [], False, filename, False)
-        # print(f"Import namespace result '{importResult.Value}' on ({self.hive.name})")
-
-        res = accessLoader.DeleteXmlFile(filename)
-        return module
+        detector = _UriDetector()
+        chunk_size = self.MIN_CHUNK
+        sent = 0
+        try:
+            with self._open_nodeset(nodeset) as (source, total):
+                for chunk in self._chunks(source, lambda: chunk_size):
+                    detector.feed(chunk)
+                    started = time.perf_counter()
+                    accessLoader.AppendXmlFile(filename, chunk)
+                    elapsed = time.perf_counter() - started
+                    if elapsed < self.CHUNK_TARGET_TIME/2:
+                        chunk_size = min(chunk_size*2, self.MAX_CHUNK)
+                    elif elapsed > self.CHUNK_TARGET_TIME*2:
+                        chunk_size = max(chunk_size//2, self.MIN_CHUNK)
+                    sent += len(chunk.encode('utf-8'))
+                    if progress is not None:
+                        progress(sent, total)
+        except Exception:
+            accessLoader.DeleteXmlFile(filename)
+            raise
+        return filename, detector
 
     def load_xml(self, nodeset):
         """
-        Load an xml file given in the `nodeset` argument. 
-        nodeset: The nodeset XML source. Either a open, file-like object or a string
+        Load an xml file given in the `nodeset` argument.
+        nodeset: The nodeset XML source. Either a file path, an open, file-like object or a string
 
         Returns:
         The nodeset file as string
         """
-        if isinstance(nodeset, io.IOBase):
-            return nodeset.read()
-        elif isinstance(nodeset, str):
-            return nodeset
-        raise Error('nodeset must be file-like or string')
-
+        with self._open_nodeset(nodeset) as (source, total):
+            return source.read()
 
-    def find_URI(self, nodeset:str):
+    def find_URI(self, nodeset: NodesetSource):
         """
-        Find the model URI in a nodeset file.
+        Find the model URI in a nodeset. Only the start of the nodeset is parsed.
         """
-        root = ET.fromstring(nodeset)
-
-        model = root.find('./{*}Models/{*}Model/[@ModelUri]')
-        if model is not None:
-            return model.attrib['ModelUri']
-        
-        
-        model=root.find('./{*}NamespaceUris/{*}Uri')
-        if model is not None:
-            return model.text
-
-        raise Error('Malformed nodeset file.')
+        detector = _UriDetector()
+        with self._open_nodeset(nodeset) as (source, total):
+            while not detector.done:
+                data = source.read(self.MIN_CHUNK)
+                if not data:
+                    break
+                detector.feed(data)
 
+        if detector.uri is None:
+            raise Error('Malformed nodeset file.')
+        return detector.uri
 
 
+def _load_order(required: Dict[str, List[str]]) -> List[str]:
+    """
+    Order model URIs so each model comes after the models it requires. Requirements
+    outside `required` are ignored. Raises Error on circular requirements.
+    """
+    order = []
+    state = {}      # uri -> 'visiting' | 'done'
 
+    def visit(uri, path):
+        if state.get(uri) == 'done':
+            return
+        if state.get(uri) == 'visiting':
+            raise Error(f"Circular model requirements: {' -> '.join(path + [uri])}")
+        state[uri] = 'visiting'
+        for dep in required[uri]:
+            if dep in required:
+                visit(dep, path + [uri])
+        state[uri] = 'done'
+        order.append(uri)
 
+    for uri in required:
+        visit(uri, [])
+    return order
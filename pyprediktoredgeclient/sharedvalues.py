@@ -0,0 +1,339 @@
+"""
+Current values shared between the processes of one machine.
+
+A `ValuePublisher` polls a fixed set of items from one Hive and writes the
+values into a `multiprocessing.shared_memory` block. Any local process opens the
+block by name with a `ValueTable` and reads the values without a hive
+connection, i.e. the workers of a web server or a multiprocessing pool.
+
+The block has a fixed layout: a header of int64 fields, the item-id's as JSON,
+and two slots of arrays (time as datetime64[us], value as float64 and quality
+as uint32), one element per item. Publish number n is written to slot n % 2,
+so the slot readers are looking at is not overwritten by the next publish. The
+header holds the number of the last complete publish and of the publish being
+written, and the publish time of each slot, so a reader can tell that a slot it
+holds views of has been reused.
+Non-numeric values are published as NaN.
+
+Requires numpy.
+"""
+__all__ = 'ValuePublisher', 'ValueTable', 'ValueSnapshot'
+
+import json
+import threading
+import time
+from datetime import datetime
+from multiprocessing import shared_memory
+from typing import List, NamedTuple, Optional
+
+from . import quality as _quality
+from .arrays import QUALITY_DTYPE, TIME_DTYPE
+from .util import Error, ItemVQT, Quality, _import_optional
+
+np = _import_optional('numpy', 'shared current values')
+
+_MAGIC = 0x41504953564c5331      # 'APISVLS1'
+# Header fields (int64). _H_SLOT_AT + k is the publish time of the values in slot k
+_H_MAGIC, _H_COUNT, _H_IDS_LEN, _H_PUBLISHED, _H_WRITING, _H_PUBLISHED_AT, _H_SLOT_AT = range(7)
+_HEADER_SIZE = 64
+
+_attach_lock = threading.Lock()
+_attaching = threading.local()      # Set while _attach creates a SharedMemory in this thread
+_register_wrapped = False
+
+
+def _align(n: int) -> int:
+    return -(-n // 8) * 8
+
+
+def _layout(count: int, ids_len: int):
+    "The offset of the first slot and the size of each slot"
+    first = _align(_HEADER_SIZE + ids_len)
+    return first, _align(count * (8 + 8 + 4))
+
+
+def _slot(shm, first: int, slot_size: int, count: int, k: int):
+    "Views of the (time, value, quality) arrays of slot `k`"
+    base = first + k * slot_size
+    return (np.ndarray(count, dtype=TIME_DTYPE, buffer=shm.buf, offset=base),
+            np.ndarray(count, dtype=np.float64, buffer=shm.buf, offset=base + 8*count),
+            np.ndarray(count, dtype=QUALITY_DTYPE, buffer=shm.buf, offset=base + 16*count))
+
+
+def _header(shm):
+    return np.ndarray(_HEADER_SIZE // 8, dtype=np.int64, buffer=shm.buf)
+
+
+def _wrap_register():
+    """Wrap resource_tracker.register (once) to skip the registrations made by `_attach`.
+    Other registrations, also from other threads attaching at the same time, are passed on"""
+    global _register_wrapped
+    from multiprocessing import resource_tracker
+    with _attach_lock:
+        if _register_wrapped:
+            return
+        register = resource_tracker.register
+
+        def _register(name, rtype):
+            if rtype == 'shared_memory' and getattr(_attaching, 'active', False):
+                return
+            return register(name, rtype)
+
+        resource_tracker.register = _register
+        _register_wrapped = True
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    "Attach to an existing block without letting this process unlink it at exit"
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers every attached block with the resource tracker, which
+        # unlinks it when this process exits. Skip the registration for this thread only
+        _wrap_register()
+        _attaching.active = True
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            _attaching.active = False
+
+
+def _number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class ValuePublisher:
+    """
+    Poll `items` from `hive` every `interval` seconds in a background thread, and
+    publish the values in a shared memory block named `name` (default: a generated
+    name, see `name`). The block is removed by `close()`.
+
+    >>> with ValuePublisher(hive, item_ids, 'plant-values') as publisher:
+    ...     publisher.start()
+    ...     ...
+
+    Errors during polling are kept in `last_error`, and polling goes on.
+    """
+    def __init__(self, hive, items, name: Optional[str] = None, interval: float = 1.0):
+        self.hive = hive
+        self.item_ids = [i if isinstance(i, str) else i.item_id for i in items]
+        self.interval = interval
+        self.last_error: Optional[Exception] = None
+        self._index = {item_id: i for i, item_id in enumerate(self.item_ids)}
+        if len(self._index) != len(self.item_ids):
+            raise Error("The published item-id's must be unique")
+
+        ids = json.dumps(self.item_ids).encode('utf-8')
+        count = len(self.item_ids)
+        self._first, self._slot_size = _layout(count, len(ids))
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=self._first + 2*self._slot_size)
+        header = _header(self._shm)
+        header[:] = 0
+        self._shm.buf[_HEADER_SIZE:_HEADER_SIZE + len(ids)] = ids
+        for k in (0, 1):
+            t, v, q = _slot(self._shm, self._first, self._slot_size, count, k)
+            t[:], v[:], q[:] = np.datetime64('NaT'), np.nan, _quality.NODATA
+        header[_H_COUNT], header[_H_IDS_LEN] = count, len(ids)
+        header[_H_MAGIC] = _MAGIC
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Apis.ValuePublisher: {self.name}, {len(self.item_ids)} items>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def name(self) -> str:
+        "The name of the shared memory block, to open with `ValueTable(name)`"
+        return self._shm.name
+
+    @property
+    def sequence(self) -> int:
+        "The number of the last publish"
+        return int(_header(self._shm)[_H_PUBLISHED])
+
+    def publish(self, values: Optional[List[ItemVQT]] = None) -> int:
+        """
+        Read the items from the hive (or take `values`) and publish them. Items missing
+        from the result are published as NaN with quality bad | noData.
+
+        Returns: The publish number
+        """
+        if values is None:
+            values = self.hive.get_values(self.item_ids)
+        count = len(self.item_ids)
+        new_t = np.full(count, np.datetime64('NaT'), dtype=TIME_DTYPE)
+        new_v = np.full(count, np.nan)
+        new_q = np.full(count, _quality.NODATA, dtype=QUALITY_DTYPE)
+        for vqt in values:
+            i = self._index.get(vqt.item_id)
+            if i is not None:
+                new_v[i], new_q[i] = _number(vqt.value), int(vqt.quality)
+                if vqt.time is not None:
+                    new_t[i] = np.datetime64(vqt.time, 'us')
+
+        with self._lock:
+            header = _header(self._shm)
+            n = int(header[_H_PUBLISHED]) + 1
+            header[_H_WRITING] = n      # Readers of slot n % 2 (publish n - 2) can see it is being reused
+            t, v, q = _slot(self._shm, self._first, self._slot_size, count, n % 2)
+            t[:], v[:], q[:] = new_t, new_v, new_q
+            header[_H_SLOT_AT + n % 2] = header[_H_PUBLISHED_AT] = np.datetime64(datetime.utcnow(), 'us').astype(np.int64)
+            header[_H_PUBLISHED] = n
+        return n
+
+    def _run(self):
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                self.last_error = e
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        "Start polling in a background thread"
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"ValuePublisher-{self.name}", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        "Stop polling. The published values stay readable until `close()`"
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        "Stop polling and remove the shared memory block"
+        self.stop()
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class ValueSnapshot(NamedTuple):
+    """
+    The values of a ValueTable at one publish. The arrays have one element per item in
+    `item_ids`, and are views of the shared memory unless copied.
+    """
+    item_ids: List[str]
+    time: 'np.ndarray'
+    value: 'np.ndarray'
+    quality: 'np.ndarray'
+    sequence: int
+    published: Optional[datetime]
+
+    def __repr__(self):
+        return f"<Apis.ValueSnapshot: {len(self.item_ids)} items, sequence {self.sequence}>"
+
+    def to_frame(self):
+        "Return the values as a pandas DataFrame indexed by item-id"
+        pd = _import_optional('pandas', 'DataFrame support')
+        return pd.DataFrame({'value': self.value, 'quality': self.quality, 'time': self.time},
+                            index=pd.Index(self.item_ids, name='item_id'))
+
+
+class ValueTable:
+    """
+    Read access to the values published by a `ValuePublisher` in another (or the same)
+    process, by the name of its shared memory block.
+
+    >>> table = ValueTable('plant-values')
+    >>> snap = table.snapshot()
+    >>> snap.value[table.index('Pump.Flow')]
+    """
+    def __init__(self, name: str):
+        self._shm = _attach(name)
+        header = _header(self._shm)
+        if header[_H_MAGIC] != _MAGIC:
+            self._shm.close()
+            raise Error(f"Shared memory block {name} is not a value table")
+        count, ids_len = int(header[_H_COUNT]), int(header[_H_IDS_LEN])
+        self.item_ids: List[str] = json.loads(bytes(self._shm.buf[_HEADER_SIZE:_HEADER_SIZE + ids_len]).decode('utf-8'))
+        self._index = {item_id: i for i, item_id in enumerate(self.item_ids)}
+        first, slot_size = _layout(count, ids_len)
+        self._slots = [_slot(self._shm, first, slot_size, count, k) for k in (0, 1)]
+
+    def __repr__(self):
+        return f"<Apis.ValueTable: {self._shm.name}, {len(self.item_ids)} items>"
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def sequence(self) -> int:
+        "The number of the last publish. 0 if nothing is published yet"
+        return int(_header(self._shm)[_H_PUBLISHED])
+
+    def index(self, item_id: str) -> int:
+        "The position of `item_id` in the arrays"
+        try:
+            return self._index[item_id]
+        except KeyError:
+            raise Error(f"Item {item_id} is not published in {self._shm.name}")
+
+    def intact(self, snapshot: ValueSnapshot) -> bool:
+        "True while the views of an uncopied `snapshot` have not been overwritten by a later publish"
+        return int(_header(self._shm)[_H_WRITING]) < snapshot.sequence + 2
+
+    def snapshot(self, copy: bool = True) -> ValueSnapshot:
+        """
+        Return the values of the last publish. With `copy=False` the arrays are views of the
+        shared memory, valid until the publish after the next one begins (see `intact`).
+        The header is read again after reading (and copying), and the read is retried if the
+        slot was reused meanwhile, so the values and `published` are from the same publish.
+        """
+        header = _header(self._shm)
+        while True:
+            n = int(header[_H_PUBLISHED])
+            published_at = int(header[_H_SLOT_AT + n % 2])
+            t, v, q = self._slots[n % 2]
+            if copy:
+                t, v, q = t.copy(), v.copy(), q.copy()
+            published = np.datetime64(published_at, 'us').item() if n else None
+            snap = ValueSnapshot(self.item_ids, t, v, q, n, published)
+            if self.intact(snap):
+                return snap
+
+    def get(self, item_id: str) -> ItemVQT:
+        "The last published value of one item"
+        i = self.index(item_id)
+        while True:
+            snap = self.snapshot(copy=False)
+            t, v, q = snap.time[i], float(snap.value[i]), int(snap.quality[i])
+            if self.intact(snap):
+                return ItemVQT(item_id, v, Quality(q), None if np.isnat(t) else t.item())
+
+    def wait(self, after: int, timeout: Optional[float] = None) -> bool:
+        "Wait until a publish later than number `after`. Returns False on timeout"
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.sequence <= after:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        "Detach from the shared memory block. Views from uncopied snapshots must not be used after this"
+        self._slots = None
+        self._shm.close()
@@ -6,6 +6,8 @@ import pkg_resources
 from datetime import datetime, timedelta
 import functools
 import collections
+import collections.abc
+import importlib
 import os
 import io
 import sys
@@ -316,6 +318,15 @@ class Error(Exception):
 	def __str__(self):
 		return self.msg
 
+def _import_optional(name: str, feature: str):
+    """Internal function. Import and return the optional dependency `name`. Raise
+    an Error naming the `feature` that needs it if it is not installed.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        raise Error(f"The package '{name}' is required for {feature}. Install it with 'pip install {name}'")
+
 
 class Quality(int):
     def __new__(cls, value=192):
@@ -352,8 +363,8 @@ class Quality(int):
             return Quality(name)
         if isinstance(name, str):
             return Quality(OPC_quality[name])
-        if isinstance(name, collections.Sequence):
-            functools.reduce(lambda a,b: a | b, map(Quality.factory, name))
+        if isinstance(name, collections.abc.Sequence):
+            return Quality(functools.reduce(lambda a,b: a | b, map(Quality.factory, name)))
 
 
 class VQT(NamedTuple):
@@ -417,8 +428,79 @@ class Timeseries(NamedTuple):
         ts = [VQT(v,Quality(q),to_pydatetime(t)) for v,q,t in zip(raw_ts.Values, raw_ts.Qualities, raw_ts.Timestamps)]
         return Timeseries(item_id, None, ts)
 
+    def filter(self, quality_policy='good'):
+        """
+        Return a Timeseries with the samples kept by `quality_policy`: 'good', 'usable'
+        (not bad, not NaN) or 'all'. Requires numpy. See `quality.mask`
+        """
+        from .quality import mask
+        keep = mask([vqt.quality for vqt in self.ts], quality_policy, [vqt.value for vqt in self.ts] if quality_policy == 'usable' else None)
+        return Timeseries(self.item_id, self.hs_database, [vqt for vqt, k in zip(self.ts, keep.tolist()) if k])
+
+    def to_arrays(self):
+        """
+        Return the timeseries as an `arrays.ArrayTimeseries` (requires numpy)
+        """
+        from .arrays import ArrayTimeseries
+        return ArrayTimeseries.from_timeseries(self)
+
+    @staticmethod
+    def align(series_list, grid=None, freq=None, method='previous', quality_policy='usable', **kw):
+        """
+        Resample several Timeseries (or ArrayTimeseries) onto a common time grid, as dense
+        2-D arrays with one column per series. Requires numpy. See `arrays.align` for the
+        arguments.
+
+        >>> aligned = Timeseries.align([a.read_raw(), b.read_raw()], freq=timedelta(seconds=10))
+        >>> aligned.value.shape
+        (721, 2)
+        """
+        from .arrays import align
+        return align(series_list, grid, freq, method=method, quality_policy=quality_policy, **kw)
+
+
+class EnumerationMap(NamedTuple):
+    """
+    Two-way translation between the values and names of an enumerated attribute
+    """
+    names: Dict[Any, str]       # value -> name
+    values: Dict[str, Any]      # lower case name -> value
+
+    @staticmethod
+    def from_api(attr_enum) -> "EnumerationMap":
+        names = list(attr_enum.Names)
+        values = list(attr_enum.Values)
+        return EnumerationMap(
+            {v: n for n, v in reversed(list(zip(names, values)))},
+            {str(n).lower(): v for n, v in reversed(list(zip(names, values)))})
+
+
+class EnumerationCache:
+    """
+    Cache of EnumerationMaps, shared by all attributes with the same definition. The
+    cache is cleared when it is used with a new configuration `generation`.
+    """
+    def __init__(self):
+        self._maps = {}
+        self._generation = None
+
+    def get(self, key, api, generation=None) -> EnumerationMap:
+        "Return the map for the attribute definition `key`, reading it from the attribute `api` if needed"
+        if generation != self._generation:
+            self._maps = {}
+            self._generation = generation
+        enum_map = self._maps.get(key)
+        if enum_map is None:
+            enum_map = self._maps[key] = EnumerationMap.from_api(api.GetEnumeration())
+        return enum_map
+
+    def clear(self):
+        self._maps = {}
+
 
 class BaseAttribute:
+	__slots__ = ()
+
 	def __str__(self):
 		return self.name
 
@@ -430,31 +512,32 @@ class BaseAttribute:
 	def flag(self):
 		return self.api.Flag
 
+	def _enumeration(self) -> EnumerationMap:
+		"""Return the value/name translation of an enumerated attribute. Subclasses
+		that know the attribute definition return a cached map"""
+		return EnumerationMap.from_api(self.api.GetEnumeration())
+
 	def get_value(self):
 		v = self.api.Value
 		if self.flag & AttrFlags.Enumerated:
-			attr_enum = self.api.GetEnumeration()
-			for i,val in enumerate(attr_enum.Values):
-				if val==v:
-					return attr_enum.Names[i]
-			raise Error(f"Enumerated property with value '{v}' not found on {self.name}")
+			try:
+				return self._enumeration().names[v]
+			except KeyError:
+				raise Error(f"Enumerated property with value '{v}' not found on {self.name}")
 		if isinstance(v, System.DateTime):
 			return to_pydatetime(v)
 		return v
 
 	def set_value(self, value):
-		if self.flag & AttrFlags.ReadOnly:
+		flag = self.flag
+		if flag & AttrFlags.ReadOnly:
 			raise AttributeError(f"Attribute {self.name} is read only")
 
-		if self.flag & AttrFlags.Enumerated:
-			attr_enum = self.api.GetEnumeration()
-            
+		if flag & AttrFlags.Enumerated:
 			normval = str(value).lower() #Normalized value
-			for i,val in enumerate(attr_enum.Names):
-				if str(val).lower()==normval:
-					self.api.Value = attr_enum.Values[i]
-					break
-			else:
+			try:
+				self.api.Value = self._enumeration().values[normval]
+			except KeyError:
 				raise Error(f"Enumerated property for {value} not found on attribute {self.name}.")
 		elif isinstance(self.api.Value, System.DateTime):
 			if isinstance(value, str):
@@ -473,12 +556,14 @@ class HiveAttribute(BaseAttribute):
 	"""
 	Attribtes/properties for use in Hive-module propertiess and Hive Item attributes
 	"""
+	__slots__ = ()
+
 	def __str__(self):
 		return f"{self.name}={self.value}"
 
 
 class BaseContainer:
-    pass
+    __slots__ = ()
 
 
 
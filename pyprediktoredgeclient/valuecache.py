@@ -0,0 +1,161 @@
+"""
+Short-lived cache of current values, shared by the threads of a process.
+
+Values read by `Hive.get_values` are kept for a short time-to-live. Items that
+are not cached, or have expired, are read in one batch. Concurrent requests
+join reads already in flight for their items instead of reading them again
+(single-flight), so threads polling overlapping item sets in the same moment
+cause one read of the union. Values written through `Hive.set_values` are
+dropped from the cache, so they are read back from the hive. A read already in
+flight when its items are dropped is not joined by later requests, and its
+values are not cached.
+
+Items the hive doesn't return a value for are returned with value None,
+quality bad | noData and time None, and are not cached.
+"""
+__all__ = 'ValueCache', 'ValueCacheStats'
+
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from . import quality as _quality
+from .util import ItemVQT, Quality
+
+
+class ValueCacheStats(NamedTuple):
+    """
+    Counters of a ValueCache, per item requested. `hits` were served from the cache,
+    `misses` were read from the hive and `coalesced` joined a read in flight for another
+    request. `reads` is the number of batched reads from the hive.
+    """
+    entries: int
+    hits: int
+    misses: int
+    coalesced: int
+    reads: int
+
+
+class _Flight:
+    "A batched read in progress"
+    __slots__ = 'done', 'values', 'error', 'epoch'
+
+    def __init__(self, epoch: int):
+        self.done = threading.Event()
+        self.epoch = epoch
+        self.values: Dict[str, ItemVQT] = {}
+        self.error: Optional[Exception] = None
+
+
+class ValueCache:
+    """
+    A current-value cache with single-flight reads. Usually enabled with
+    `Hive.enable_value_cache()`.
+
+    Arguments:
+    ttl: The number of seconds a value is served from the cache
+    """
+    def __init__(self, ttl: float = 1.0):
+        self.ttl = ttl
+        self._entries: Dict[str, tuple] = {}           # item-id -> (expires, ItemVQT)
+        self._inflight: Dict[str, _Flight] = {}
+        self._epoch = 0                                 # Incremented by each invalidate and clear
+        self._invalidated: Dict[str, int] = {}          # item-id -> epoch, while reads are in flight
+        self._cleared = 0
+        self._flights = 0                               # Reads in flight
+        self._pruned = time.monotonic()
+        self._hits = self._misses = self._coalesced = self._reads = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Apis.ValueCache: {self.stats}>"
+
+    @property
+    def stats(self) -> ValueCacheStats:
+        return ValueCacheStats(len(self._entries), self._hits, self._misses, self._coalesced, self._reads)
+
+    def clear(self):
+        "Remove all cached values. Reads in flight are not cached"
+        with self._lock:
+            self._epoch += 1
+            self._cleared = self._epoch
+            self._entries.clear()
+            self._inflight.clear()
+
+    def invalidate(self, item_ids: Iterable[str]):
+        "Remove the cached values of `item_ids`. Reads of them in flight are not cached"
+        with self._lock:
+            self._epoch += 1
+            for item_id in item_ids:
+                self._entries.pop(item_id, None)
+                if self._inflight.pop(item_id, None) is not None:
+                    self._invalidated[item_id] = self._epoch
+
+    def _prune(self, now: float):
+        "Remove expired entries, at most once per ttl. Must be called with the lock held"
+        if now - self._pruned >= self.ttl:
+            self._pruned = now
+            for item_id in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+                del self._entries[item_id]
+
+    def get(self, item_ids: List[str], read: Callable[[List[str]], List[ItemVQT]]) -> List[ItemVQT]:
+        """
+        Return the current values of `item_ids`, calling `read` with the item-id's that are
+        neither cached nor being read by another request. Raises the error of a failed read,
+        also in the requests that joined it. Returns one value per item-id, with quality
+        bad | noData for items `read` didn't return.
+        """
+        now = time.monotonic()
+        found: Dict[str, ItemVQT] = {}
+        joined: Dict[_Flight, List[str]] = {}
+        missing: List[str] = []
+        with self._lock:
+            for item_id in dict.fromkeys(item_ids):
+                entry = self._entries.get(item_id)
+                if entry is not None and entry[0] > now:
+                    found[item_id] = entry[1]
+                    self._hits += 1
+                elif item_id in self._inflight:
+                    joined.setdefault(self._inflight[item_id], []).append(item_id)
+                    self._coalesced += 1
+                else:
+                    missing.append(item_id)
+                    self._misses += 1
+            if missing:
+                flight = _Flight(self._epoch)
+                self._reads += 1
+                self._flights += 1
+                for item_id in missing:
+                    self._inflight[item_id] = flight
+
+        if missing:
+            try:
+                flight.values = {vqt.item_id: vqt for vqt in read(missing)}
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                now = time.monotonic()
+                with self._lock:
+                    for item_id in missing:
+                        if self._inflight.get(item_id) is flight:
+                            del self._inflight[item_id]
+                    if self._cleared <= flight.epoch:
+                        for item_id, vqt in flight.values.items():
+                            if self._invalidated.get(item_id, 0) <= flight.epoch:
+                                self._entries[item_id] = (now + self.ttl, vqt)
+                    self._flights -= 1
+                    if not self._flights:
+                        self._invalidated.clear()
+                    self._prune(now)
+                flight.done.set()
+            found.update(flight.values)
+
+        for other, ids in joined.items():
+            other.done.wait()
+            if other.error is not None:
+                raise other.error
+            found.update((item_id, other.values[item_id]) for item_id in ids if item_id in other.values)
+
+        return [found[item_id] if item_id in found else ItemVQT(item_id, None, Quality(_quality.NODATA), None)
+                for item_id in item_ids]
@@ -0,0 +1,197 @@
+"""
+Client-side virtual (derived) tags.
+
+A virtual tag is a formula over other item-id's, registered on a Hive with
+`Hive.add_virtual_tag`. The formula is parsed and compiled once, and evaluated
+with NumPy over whole arrays: once per batch of current values read by
+`Hive.get_values`, and once per history read by `Hive.read_frame`, where the
+inputs are first aligned on the union of their timestamps (the last value of each
+input at or before each timestamp). The quality of a result is the worst quality
+of its inputs, see `quality.worst`. Virtual tags may refer to other virtual tags.
+Inputs the hive returns no current value for are evaluated as NaN with quality
+bad | noData.
+
+Virtual item-id's are only known to `Hive.get_values` and `Hive.read_frame` of the
+Hive they are registered on. They are not items in the hive, so `Hive.get_items`,
+module item lookups, item queries and writes don't find them. A `cluster.HiveCluster`
+reads them when a route sends their prefix to that Hive.
+
+Requires numpy.
+"""
+__all__ = 'VirtualTag', 'VirtualTags'
+
+import ast
+import re
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from . import arrays
+from . import quality as _quality
+from .arrays import ArrayTimeseries, QUALITY_DTYPE
+from .util import Error, ItemVQT, Quality, _import_optional
+
+np = _import_optional('numpy', 'virtual tags')
+
+_REFERENCE = re.compile(r'\{([^{}]+)\}')
+
+# The functions and constants available in expressions
+_FUNCTIONS = {name: getattr(np, name) for name in (
+    'abs', 'sqrt', 'exp', 'log', 'log10', 'sin', 'cos', 'tan', 'arctan2', 'floor', 'ceil', 'round',
+    'minimum', 'maximum', 'clip', 'where', 'isnan', 'nan', 'pi', 'e')}
+
+
+class VirtualTag:
+    """
+    A formula over other items, with the item-id's written in braces:
+
+    >>> VirtualTag('Calc.Power', '{Pump.Flow} * {Pump.Head} * 9.81')
+
+    Expressions can use arithmetic, comparisons, `&`, `|`, `~` and the functions
+    abs, sqrt, exp, log, log10, sin, cos, tan, arctan2, floor, ceil, round, minimum,
+    maximum, clip, where and isnan, and the constants nan, pi and e. They are evaluated
+    element-wise over arrays, so use `where(cond, a, b)` rather than `a if cond else b`.
+    """
+    def __init__(self, item_id: str, expression: str):
+        self.item_id = item_id
+        self.expression = expression
+        self.inputs: List[str] = []
+
+        def reference(m):
+            ref = m.group(1).strip()
+            if ref not in self.inputs:
+                self.inputs.append(ref)
+            return f"_{self.inputs.index(ref)}"
+
+        source = _REFERENCE.sub(reference, expression).strip()
+        if not self.inputs:
+            raise Error(f"Virtual tag {item_id} doesn't refer to any items. Write the item-id's in braces, i.e. {{Module.Item}}")
+        try:
+            tree = ast.parse(source, mode='eval')
+        except SyntaxError as e:
+            raise Error(f"Invalid expression for virtual tag {item_id}: {e.msg}")
+        variables = {f"_{i}" for i in range(len(self.inputs))}
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Attribute):
+                raise Error(f"Attribute access is not allowed in virtual tag {item_id}")
+            if isinstance(node, ast.Name) and node.id not in variables and node.id not in _FUNCTIONS:
+                raise Error(f"Unknown name '{node.id}' in virtual tag {item_id}")
+        self._code = compile(tree, f"<virtual tag {item_id}>", 'eval')
+
+    def __repr__(self):
+        return f"<Apis.VirtualTag: {self.item_id} = {self.expression}>"
+
+    def evaluate(self, values: Sequence) -> 'np.ndarray':
+        "Evaluate the formula over the input values (arrays or scalars, in the order of `inputs`)"
+        namespace = {f"_{i}": v for i, v in enumerate(values)}
+        try:
+            with np.errstate(all='ignore'):
+                return np.asarray(eval(self._code, {'__builtins__': {}, **_FUNCTIONS}, namespace))
+        except Exception as e:
+            raise Error(f"Error evaluating virtual tag {self.item_id}: {e}")
+
+
+def _as_values(result: 'np.ndarray') -> 'np.ndarray':
+    "The result of a formula as a float64 array, or an object array for non-numeric results"
+    return result.astype(np.float64 if result.dtype.kind in 'biuf' else object, copy=False)
+
+
+class VirtualTags:
+    """
+    The virtual tags of a Hive, by item-id. Usually used through `Hive.add_virtual_tag`.
+    """
+    def __init__(self):
+        self._tags: Dict[str, VirtualTag] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Apis.VirtualTags: {len(self._tags)} tags>"
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __contains__(self, item_id):
+        return item_id in self._tags
+
+    def __iter__(self):
+        return iter(list(self._tags.values()))
+
+    def __getitem__(self, item_id: str) -> VirtualTag:
+        return self._tags[item_id]
+
+    def add(self, item_id: str, expression: str) -> VirtualTag:
+        "Register (or replace) the virtual tag `item_id`. Raises Error for invalid or circular formulas"
+        tag = VirtualTag(item_id, expression)
+        with self._lock:
+            pending, seen = list(tag.inputs), set()
+            while pending:
+                ref = pending.pop()
+                if ref == item_id:
+                    raise Error(f"Virtual tag {item_id} refers to itself")
+                if ref not in seen and ref in self._tags:
+                    seen.add(ref)
+                    pending.extend(self._tags[ref].inputs)
+            self._tags[item_id] = tag
+        return tag
+
+    def remove(self, item_id: str):
+        with self._lock:
+            if self._tags.pop(item_id, None) is None:
+                raise Error(f"Virtual tag {item_id} not found")
+
+    def _resolve(self, item_ids: Iterable[str]) -> Tuple[List[str], List[VirtualTag]]:
+        "The real item-id's needed for `item_ids`, and the virtual tags to evaluate in dependency order"
+        real, order, seen = [], [], set()
+
+        def visit(item_id):
+            if item_id in seen:
+                return
+            seen.add(item_id)
+            tag = self._tags.get(item_id)
+            if tag is None:
+                real.append(item_id)
+                return
+            for ref in tag.inputs:
+                visit(ref)
+            order.append(tag)
+
+        with self._lock:
+            for item_id in item_ids:
+                visit(item_id)
+        return real, order
+
+    def get_values(self, hive, item_ids: List[str], since=None) -> List[ItemVQT]:
+        """Read the current values of real and virtual `item_ids`. The real inputs are read
+        in one batch. The time of a virtual value is the latest time of its inputs. Items
+        without a value are returned with value None and quality bad | noData"""
+        real, order = self._resolve(item_ids)
+        current = {vqt.item_id: vqt for vqt in hive._read_values(real, since)} if real else {}
+        nodata = Quality(_quality.NODATA)
+        for tag in order:
+            inputs = [current.get(ref) or ItemVQT(ref, np.nan, nodata, None) for ref in tag.inputs]
+            value = _as_values(tag.evaluate([np.nan if v.value is None else v.value for v in inputs])).tolist()
+            quality = Quality(int(_quality.worst(*[int(v.quality) for v in inputs])))
+            time = max((v.time for v in inputs if v.time is not None), default=None)
+            current[tag.item_id] = ItemVQT(tag.item_id, value, quality, time)
+        return [current.get(item_id) or ItemVQT(item_id, None, nodata, None) for item_id in item_ids]
+
+    def read_raw_arrays(self, hive, items, start: datetime, end: datetime, maxpoints: int) -> List[ArrayTimeseries]:
+        """Read raw history of real and virtual items. Each virtual tag is evaluated over its
+        inputs aligned on the union of their timestamps, and returns at most `maxpoints` samples"""
+        keys = [i if isinstance(i, str) else i.item_id for i in items]
+        real, order = self._resolve(keys)
+        requested = dict(zip(keys, items))
+        series = {}
+        if real:
+            series = dict(zip(real, hive._read_raw_arrays([requested.get(k, k) for k in real], start, end, maxpoints)))
+        for tag in order:
+            inputs = [series[ref] for ref in tag.inputs]
+            grid = arrays.union_index(inputs)
+            dtype = object if any(s.value.dtype == object for s in inputs) else np.float64
+            aligned = arrays.align(inputs, grid=grid, quality_policy='all', dtype=dtype)
+            value = _as_values(tag.evaluate(list(aligned.value.T)))
+            if value.shape != grid.shape:
+                value = np.array(np.broadcast_to(value, grid.shape))
+            quality = _quality.worst(*aligned.quality.T).astype(QUALITY_DTYPE)
+            series[tag.item_id] = ArrayTimeseries(tag.item_id, grid, value, quality).select(slice(0, maxpoints))
+        return [series[k] for k in keys]
@@ -0,0 +1,191 @@
+"""
+Write-behind buffering of values written to a hive.
+"""
+__all__ = 'HiveWriter', 'WriteError'
+
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Union
+
+import System
+
+from .util import Error, ItemVQT, fm_pydatetime
+
+
+class WriteError(NamedTuple):
+    """
+    A value that could not be written. `error` is the error code from the hive,
+    or the exception raised while writing the batch.
+    """
+    item_id: str
+    error: Union[int, Exception]
+    vqt: ItemVQT
+
+
+class HiveWriter:
+    """
+    A write-behind buffer for `Hive.set_values`. Values are buffered and coalesced
+    per item, and written in large batches from a background thread when the buffer
+    reaches `batch_size` values or `flush_interval` seconds have passed.
+
+    Arguments:
+    hive: The Hive to write to
+    keep: 'last' to keep only the latest value of each item between flushes, or 'all'
+          to keep every value (i.e. when the history matters)
+    batch_size: Flush when this many values are buffered. Also the size of each write
+    flush_interval: The maximum number of seconds a value is buffered
+    max_buffered: The maximum number of buffered values. `write` blocks when the buffer is full
+    on_error: Optional callback, called from the writer thread with a list of WriteError's.
+              If not given, or if it raises, the errors are collected and returned by
+              `pop_errors()`. An exception raised by the callback is kept in `last_error`
+
+    The writer can be used as a context manager, which flushes and stops it on exit:
+
+    >>> with hive.writer(keep='all') as w:
+    ...     w.write_values({'worker.temp': 21.5, 'worker.flow': 3.2})
+    """
+    def __init__(self, hive, keep: str = 'last', batch_size: int = 5000, flush_interval: float = 1.0,
+                 max_buffered: int = 100000, on_error: Optional[Callable[[List[WriteError]], Any]] = None):
+        if keep not in ('last', 'all'):
+            raise Error(f"Invalid keep value '{keep}'. Expected 'last' or 'all'")
+        self.hive = hive
+        self.keep = keep
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.on_error = on_error
+        self.last_error: Optional[Exception] = None
+
+        self._buffer: Dict[str, List[ItemVQT]] = {}
+        self._count = 0
+        self._handles: Dict[str, int] = {}
+        self._errors: List[WriteError] = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='HiveWriter', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        "The number of buffered values"
+        return self._count
+
+    def write(self, vqts: Union[ItemVQT, Iterable[ItemVQT]], timeout: Optional[float] = None):
+        """
+        Buffer one or more ItemVQT's. Blocks while the buffer is full.
+
+        Arguments:
+        vqts: An ItemVQT or a sequence of ItemVQT's
+        timeout: Optional maximum number of seconds to wait for room in the buffer. Raises Error on timeout
+        """
+        if isinstance(vqts, ItemVQT):
+            vqts = [vqts]
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            for vqt in vqts:
+                if self._closed:
+                    raise Error("The HiveWriter is closed")
+                items = self._buffer.get(vqt.item_id)
+                if items and self.keep == 'last':
+                    items[0] = vqt
+                    continue
+                while self._count >= self.max_buffered:
+                    self._cond.notify_all()
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Error("Timeout waiting for room in the HiveWriter buffer")
+                    self._cond.wait(remaining)
+                self._buffer.setdefault(vqt.item_id, []).append(vqt)
+                self._count += 1
+            if self._count >= self.batch_size:
+                self._cond.notify_all()
+
+    def write_values(self, values: Dict[str, object], quality=None, time=None, timeout: Optional[float] = None):
+        "Buffer a dict of item-id's and values. See `ItemVQT.from_dict` for the arguments"
+        self.write(ItemVQT.from_dict(values, quality, time), timeout)
+
+    def flush(self):
+        "Write all buffered values now"
+        self._flush()
+
+    def close(self):
+        "Flush the buffer and stop the background thread"
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.flush()
+
+    def pop_errors(self) -> List[WriteError]:
+        "Return and clear the errors collected since the last call"
+        with self._cond:
+            errors, self._errors = self._errors, []
+        return errors
+
+    def _take(self) -> List[ItemVQT]:
+        "Take all buffered values. Must be called with the condition held"
+        batch = [vqt for vqts in self._buffer.values() for vqt in vqts]
+        self._buffer = {}
+        self._count = 0
+        self._cond.notify_all()
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and self._count < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+            self._flush()
+
+    def _lookup(self, item_ids: List[str]):
+        "Look up handles for item-id's not seen before"
+        new_ids = [i for i in dict.fromkeys(item_ids) if i not in self._handles]
+        if new_ids:
+            self._handles.update(zip(new_ids, self.hive.api.LookupItemHandles(new_ids)))
+        return [self._handles[i] for i in item_ids]
+
+    def _flush(self):
+        """Take the buffered values and write them. The values are taken with the write lock
+        held, so batches taken by concurrent flushes are written in the order they were taken"""
+        with self._write_lock:
+            with self._cond:
+                batch = self._take()
+            errors = self._write(batch)
+        if not errors:
+            return
+        if self.on_error is not None:
+            try:
+                self.on_error(errors)
+                return
+            except Exception as e:
+                self.last_error = e
+        with self._cond:
+            self._errors.extend(errors)
+
+    def _write(self, batch: List[ItemVQT]) -> List[WriteError]:
+        "Write a batch. Must be called with the write lock held. Returns the values that failed"
+        errors = []
+        batch.sort(key=lambda v: v.time)
+        for i in range(0, len(batch), self.batch_size):
+            chunk = batch[i:i + self.batch_size]
+            try:
+                handles = self._lookup([v.item_id for v in chunk])
+                times = System.Array[System.DateTime]([fm_pydatetime(v.time) for v in chunk])
+                failed = self.hive._write_items([v.item_id for v in chunk], handles, [v.value for v in chunk], [v.quality for v in chunk], times)
+                errors.extend(WriteError(chunk[j].item_id, err, chunk[j]) for j, err in failed)
+            except Exception as e:
+                errors.extend(WriteError(v.item_id, e, v) for v in chunk)
+        return errors
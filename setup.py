@@ -5,6 +5,16 @@ setup(
     setup_requires=[
         "pythonnet>=2.5.2,<3.0"
         ],
+    extras_require={
+        "numpy": ["numpy"],
+        "pandas": ["numpy", "pandas"],
+        "arrow": ["numpy", "pyarrow"],
+        },
+    entry_points={
+        "console_scripts": [
+            "apis-history-export=pyprediktoredgeclient.export:main",
+            ],
+        },
     package_data={
         "": ["dlls/*.dll"]
     },